@@ -106,11 +106,28 @@ def database_config(config):
                                              None)
     settings['mongo_replicaset'] = mongo_replicaset
 
+    mongo_options = {}
+    for setting_name, option_name in (('mongo_max_pool_size', 'max_pool_size'),
+                                      ('mongo_socket_timeout_ms', 'socketTimeoutMS'),
+                                      ('mongo_connect_timeout_ms', 'connectTimeoutMS'),
+                                      ('mongo_wait_queue_timeout_ms', 'waitQueueTimeoutMS')):
+        value = read_setting_from_env(settings, setting_name, None)
+        if value:
+            mongo_options[option_name] = int(value)
+
+    mongo_ensure_indexes = read_setting_from_env(settings, 'mongo_ensure_indexes', 'true')
+    mongo_options['ensure_indexes'] = str(mongo_ensure_indexes).lower() == 'true'
+
+    jobs_archive_ttl_days = read_setting_from_env(settings, 'jobs.archive_ttl_days', None)
+    if jobs_archive_ttl_days:
+        mongo_options['jobs_archive_ttl'] = int(jobs_archive_ttl_days) * 24 * 60 * 60
+
     if mongo_replicaset is not None:
         mongodb = MongoDB(settings['mongo_uri'],
-                          replicaSet=mongo_replicaset)
+                          replicaSet=mongo_replicaset,
+                          **mongo_options)
     else:
-        mongodb = MongoDB(settings['mongo_uri'])
+        mongodb = MongoDB(settings['mongo_uri'], **mongo_options)
     config.registry.settings['mongodb'] = mongodb
     config.registry.settings['db_conn'] = mongodb.get_connection()
 
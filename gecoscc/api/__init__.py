@@ -10,17 +10,23 @@
 # https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
 #
 
+import base64
 import cgi
 import os
+import threading
+import time
 
-from bson import ObjectId
-from copy import deepcopy
+import pymongo
+
+from bson import ObjectId, json_util
+from copy import copy, deepcopy
 
 from cornice.schemas import CorniceSchema
 from pymongo.errors import DuplicateKeyError
 from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest
 from webob.multidict import MultiDict
 
+from gecoscc.cache import policy_catalogue
 from gecoscc.models import Node
 from gecoscc.permissions import (can_access_to_this_path, nodes_path_filter,
                                  is_gecos_master_or_403,
@@ -30,7 +36,7 @@ from gecoscc.tasks import object_created, object_changed, object_deleted, object
 from gecoscc.utils import (get_computer_of_user, get_filter_nodes_parents_ou,
                            oids_filter, check_unique_node_name_by_type_at_domain,
                            visibility_object_related, visibility_group,
-                           RESOURCES_EMITTERS_TYPES, get_object_related_list)
+                           RESOURCES_EMITTERS_TYPES, get_object_related_list, set_node_ancestors)
 
 import gettext
 import logging
@@ -40,6 +46,54 @@ SAFE_METHODS = ('GET', 'OPTIONS', 'HEAD',)
 UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE', )
 SCHEMA_METHODS = ('POST', 'PUT', )
 
+COUNT_EXACT = 'exact'
+COUNT_CACHED = 'cached'
+COUNT_NONE = 'none'
+COUNT_CACHE_MAX_ITEMS = 1000
+COUNT_CACHE = {}
+COUNT_CACHE_LOCK = threading.Lock()
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json_util.dumps(values))
+
+
+def decode_cursor(token):
+    try:
+        return json_util.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise HTTPBadRequest('Invalid cursor')
+
+
+def get_order_value(obj, field):
+    value = obj
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+
+def get_cursor_filter(order_fields, values):
+    '''
+    Filter of the objects after the values of the order fields
+    (lexicographic order). Null values are the lowest values in mongo.
+    '''
+    or_filters = []
+    for i, (field, direction) in enumerate(order_fields):
+        value = values[i]
+        if direction == pymongo.ASCENDING:
+            condition = {'$ne': None} if value is None else {'$gt': value}
+        elif value is None:
+            continue
+        else:
+            condition = {'$lt': value}
+        field_filter = dict((previous_field, previous_value) for (previous_field, _), previous_value
+                            in zip(order_fields[:i], values[:i]))
+        field_filter[field] = condition
+        or_filters.append(field_filter)
+    return {'$or': or_filters}
+
 
 class BaseAPI(object):
 
@@ -137,7 +191,47 @@ class ResourcePaginatedReadOnly(BaseAPI):
             can_access_to_this_path(self.request, self.collection, oid)
         return {self.key: ObjectId(oid)}
 
+    def get_order_fields(self):
+        '''
+        Order fields as a list of (field, direction), with _id as the last
+        field, so the order is total and usable by the cursor pagination
+        '''
+        order_field = self.order_field
+        if isinstance(order_field, basestring):
+            order_field = [(order_field, pymongo.ASCENDING)]
+        order_fields = list(order_field)
+        if '_id' not in [field for field, _ in order_fields]:
+            order_fields.append(('_id', pymongo.ASCENDING))
+        return order_fields
+
+    def get_total(self, mongo_query):
+        count = self.request.GET.get('count', COUNT_EXACT)
+        if count == COUNT_NONE:
+            return None
+        elif count == COUNT_CACHED:
+            cache_key = (self.collection_name, json_util.dumps(mongo_query, sort_keys=True))
+            cache_seconds = int(self.request.registry.settings.get('api.count_cache_seconds', 60))
+            cached = COUNT_CACHE.get(cache_key, None)
+            if cached is not None and cached[1] > time.time():
+                return cached[0]
+        elif count != COUNT_EXACT:
+            raise HTTPBadRequest('Unknown count: %s' % count)
+
+        nodes_count = self.collection.find(
+            mongo_query,
+            {'type': 1}
+        ).count()
+
+        if count == COUNT_CACHED:
+            with COUNT_CACHE_LOCK:
+                if len(COUNT_CACHE) >= COUNT_CACHE_MAX_ITEMS:
+                    COUNT_CACHE.clear()
+                COUNT_CACHE[cache_key] = (nodes_count, time.time() + cache_seconds)
+        return nodes_count
+
     def collection_get(self):
+        if 'cursor' in self.request.GET:
+            return self.collection_get_cursor()
         page = int(self.request.GET.get('page', 1))
         pagesize = int(self.request.GET.get('pagesize', self.default_pagesize))
         if pagesize <= 0 or page <= 0:
@@ -147,27 +241,16 @@ class ResourcePaginatedReadOnly(BaseAPI):
             'limit': pagesize,
         }
 
-        objects_filter = self.get_objects_filter()
-        if self.mongo_filter:
-            objects_filter.append(self.mongo_filter)
-
-        if objects_filter:
-            mongo_query = {
-                '$and': objects_filter,
-            }
-        else:
-            mongo_query = {}
-
-        nodes_count = self.collection.find(
-            mongo_query,
-            {'type': 1}
-        ).count()
+        mongo_query = self.get_mongo_query()
+        nodes_count = self.get_total(mongo_query)
 
         objects = self.collection.find(mongo_query, **extraargs).sort(self.order_field)
         objects = self.get_distinct_filter(objects)
-        pages = int(nodes_count / pagesize)
-        if nodes_count % pagesize > 0:
-            pages += 1
+        pages = None
+        if nodes_count is not None:
+            pages = int(nodes_count / pagesize)
+            if nodes_count % pagesize > 0:
+                pages += 1
         parsed_objects = self.parse_collection(list(objects))
         return {
             'pagesize': pagesize,
@@ -177,6 +260,66 @@ class ResourcePaginatedReadOnly(BaseAPI):
             'total': nodes_count,
         }
 
+    def collection_get_cursor(self):
+        '''
+        Keyset pagination: the "cursor" parameter is empty for the first page
+        and the "next" value of the previous page for the following pages
+        '''
+        pagesize = int(self.request.GET.get('pagesize', self.default_pagesize))
+        if pagesize <= 0:
+            raise HTTPBadRequest()
+
+        mongo_query = self.get_mongo_query()
+        nodes_count = self.get_total(mongo_query)
+
+        order_fields = self.get_order_fields()
+        cursor = self.request.GET.get('cursor')
+        if cursor:
+            values = decode_cursor(cursor)
+            if not isinstance(values, list) or len(values) != len(order_fields):
+                raise HTTPBadRequest('Invalid cursor')
+            cursor_filter = get_cursor_filter(order_fields, values)
+            if mongo_query:
+                mongo_query = {'$and': [mongo_query, cursor_filter]}
+            else:
+                mongo_query = cursor_filter
+
+        objects = self.collection.find(mongo_query, limit=pagesize + 1).sort(order_fields)
+        objects = list(self.get_distinct_filter(objects))
+        next_cursor = None
+        if len(objects) > pagesize:
+            objects = objects[:pagesize]
+            last_object = objects[-1]
+            if '_id' in last_object:
+                next_cursor = encode_cursor([get_order_value(last_object, field)
+                                             for field, _ in order_fields])
+        pages = None
+        if nodes_count is not None:
+            pages = int(nodes_count / pagesize)
+            if nodes_count % pagesize > 0:
+                pages += 1
+        parsed_objects = self.parse_collection(objects)
+        return {
+            'pagesize': pagesize,
+            'pages': pages,
+            'next': next_cursor,
+            self.collection_name: parsed_objects,
+            'total': nodes_count,
+        }
+
+    def get_mongo_query(self):
+        objects_filter = self.get_objects_filter()
+        if self.mongo_filter:
+            objects_filter.append(self.mongo_filter)
+
+        if objects_filter:
+            mongo_query = {
+                '$and': objects_filter,
+            }
+        else:
+            mongo_query = {}
+        return mongo_query
+
     def get(self):
         oid = self.request.matchdict['oid']
         collection_filter = self.get_oid_filter(oid)
@@ -221,7 +364,7 @@ class ResourcePaginated(ResourcePaginatedReadOnly):
             policies = obj['policies']
             for policy in policies:
                 # Get the policy
-                policyobj = self.request.db.policies.find_one({"_id": ObjectId(str(policy))})
+                policyobj = policy_catalogue.get(self.request.db, policy)
                 if policyobj is None:
                     logger.warning("Unknown policy: %s" % (str(policy)))
                 else:
@@ -330,7 +473,8 @@ class ResourcePaginated(ResourcePaginatedReadOnly):
         real_obj = self.collection.find_one(obj_filter)
         if not real_obj:
             raise HTTPNotFound()
-        old_obj = deepcopy(real_obj)
+        # real_obj is only updated at the first level (real_obj.update)
+        old_obj = copy(real_obj)
 
         if not self.integrity_validation(obj, real_obj=real_obj):
             if len(self.request.errors) < 1:
@@ -369,7 +513,8 @@ class ResourcePaginated(ResourcePaginatedReadOnly):
         obj = self.collection.find_one(filters)
         if not obj:
             raise HTTPNotFound()
-        old_obj = deepcopy(obj)
+        # pre_save only sets first level fields of obj
+        old_obj = copy(obj)
 
         obj = self.pre_save(obj)
         if obj is None:
@@ -402,6 +547,12 @@ class TreeResourcePaginated(ResourcePaginated):
                                     "Name must be unique in domain.")
         return unique
 
+    def pre_save(self, obj, old_obj=None):
+        obj = super(TreeResourcePaginated, self).pre_save(obj, old_obj=old_obj)
+        if obj is not None:
+            set_node_ancestors(obj)
+        return obj
+
     def integrity_validation(self, obj, real_obj=None):
         """ Test that the object path already exist """
 
@@ -560,7 +711,7 @@ class PassiveResourcePaginated(TreeLeafResourcePaginated):
                     return True
                 return False
 
-            policy_id = self.request.db.policies.find_one({'slug': slug}).get('_id')
+            policy_id = policy_catalogue.get_by_slug(self.request.db, slug).get('_id')
             nodes_related_with_obj = self.request.db.nodes.find({"policies.%s.object_related_list"
                                                                 % unicode(policy_id): {'$in': [unicode(obj['_id'])]}})
 
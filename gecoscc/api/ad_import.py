@@ -14,13 +14,15 @@
 
 import json
 import logging
+import os
 import re
 import random
+import shutil
+import tempfile
+import time
 
-from ordereddict import OrderedDict
 from gzip import GzipFile
-from xml.dom import minidom
-from StringIO import StringIO
+from xml.etree.cElementTree import iterparse
 
 from bson import ObjectId
 from chef import Client
@@ -31,21 +33,21 @@ from pyramid.httpexceptions import HTTPBadRequest
 
 
 from gecoscc.api import BaseAPI
+from gecoscc.eventsmanager import JobStorage
 from gecoscc.models import (OU_ORDER, OrganisationalUnit, Group, User,
                             Computer, Printer, Storage, Repository)
 from gecoscc.permissions import http_basic_login_required, can_access_to_this_path
+from gecoscc.socks import invalidate_jobs
+from gecoscc.tasks import ad_import
 from gecoscc.utils import (get_chef_api, reserve_node_or_raise,
-                           save_node_and_free, is_domain, is_visible_group,
+                           save_node_and_free, is_domain,
                            apply_policies_to_computer, apply_policies_to_user,
-                           get_filter_this_domain,
-                           MASTER_DEFAULT)
+                           get_filter_this_domain, get_path_ancestors,
+                           set_node_ancestors, MASTER_DEFAULT)
 logger = logging.getLogger(__name__)
 
 
-@resource(path='/api/ad_import/',
-          description='Active Directory import',
-          validators=http_basic_login_required)
-class ADImport(BaseAPI):
+class ADImporter(object):
     """
     Create or update objects from a Active Directory XML dump.
 
@@ -56,7 +58,12 @@ class ADImport(BaseAPI):
     RECIPE_NAME_OHAI_GECOS = 'recipe[ohai-gecos]'
     RECIPE_NAME_GECOS_WS_MGMT = 'recipe[gecos_ws_mgmt]'
 
-    collection_name = 'nodes'
+    # Objects read from the database or saved by request
+    chunk_size = 1000
+    # Minimum seconds between two progress reports
+    progress_interval = 5
+    # Components of a distinguished name ("OU=Name,DC=example,DC=com")
+    dnComponents = re.compile(ur'([^, ]+=(?:(?:\\,)|[^,])+)')
     importSchema = [
         {
             'adName': 'OrganizationalUnit',
@@ -369,99 +376,142 @@ class ADImport(BaseAPI):
         },
     ]
 
-    def _fixDuplicateName(self, mongoObjects, mongoType, newObj, domain):
+    def __init__(self, db, admin_user, settings, report_progress=None):
+        self.db = db
+        self.collection = db.nodes
+        self.admin_user = admin_user
+        self.settings = settings
+        self.report_progress = report_progress
+        self.last_progress = 0
+
+    def _progress(self, report, force=False):
         """
-        Fix duplicate name append an _counter to the name
+        Call report_progress with the report, at most every progress_interval seconds
+        """
+        if self.report_progress is None:
+            return
+        now = time.time()
+        if force or now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.report_progress(report)
+
+    def _splitName(self, name):
         """
-        contador = 0
-        m = re.match(ur'^(.+)(_\d+)$', newObj['name'])
+        Split a name in its base and the counter of the _counter suffix
+        (None if the name has not got suffix)
+        """
+        m = re.match(ur'^(.+)_(\d+)$', name)
         if m:
-            nombreBase = m.group(1)
-        else:
-            nombreBase = newObj['name']
-
-        # Each object to import
-        if mongoObjects is not None:
-            for mongoObject in mongoObjects.values():
-                m = re.match(ur'({0})(_\d+)?'.format(nombreBase), mongoObject['name'])
-                if m and m.group(2):
-                    nuevoContador = int(m.group(2)[1:]) + 1
-                    if (nuevoContador > contador):
-                        contador = nuevoContador
-                elif m and 1 > contador:
-                    contador = 1
-
-        # Each object already in database
-        collection = self.collection.find({
-            'name': {
-                '$regex': u'{0}(_\d+)?'.format(nombreBase)
-            },
-            'type': mongoType,
-            'path': get_filter_this_domain(domain)}, {
-            'name': 1
-        })
+            return m.group(1), int(m.group(2))
+        return name, None
+
+    def _registerName(self, names, mongoType, name):
+        """
+        Register a name in the names registry: (type, base name) -> next counter
+        """
+        nombreBase, contador = self._splitName(name)
+        nuevoContador = 1 if contador is None else contador + 1
+        key = (mongoType, nombreBase)
+        if nuevoContador > names.get(key, 0):
+            names[key] = nuevoContador
+
+    def _getNamesRegistry(self, domain):
+        """
+        Names registry of the objects already in the domain, read with only one query
+        """
+        names = {}
+        collection = self.collection.find({'ancestors': get_filter_this_domain(domain)},
+                                          {'name': 1, 'type': 1})
         for mongoObject in collection:
-            m = re.match(ur'({0})(_\d+)?'.format(nombreBase), mongoObject['name'])
-            if m and m.group(2):
-                nuevoContador = int(m.group(2)[1:]) + 1
-                if (nuevoContador > contador):
-                    contador = nuevoContador
-            elif m and 1 > contador:
-                contador = 1
+            if mongoObject.get('name'):
+                self._registerName(names, mongoObject['type'], mongoObject['name'])
+        return names
 
+    def _fixDuplicateName(self, names, mongoType, newObj):
+        """
+        Fix duplicate name append an _counter to the name
+        """
+        nombreBase = self._splitName(newObj['name'])[0]
+        contador = names.get((mongoType, nombreBase), 0)
         if contador > 0:
             newObj['name'] = u'{0}_{1}'.format(nombreBase, contador)
+        self._registerName(names, mongoType, newObj['name'])
+
+    def _readADObject(self, objSchema, adObj):
+        """
+        Read the attributes of objSchema from an AD element of the XML dump.
+        The list attributes (MemberOf...) are child elements with an Item by value.
+        """
+        if adObj.get('ObjectGUID') is None:
+            raise Exception('An Active Directory object must has "ObjectGUID" attrib.')
+        adValues = {}
+        for attrib in objSchema['attributes']:
+            value = adObj.get(attrib['ad'])
+            if value is not None:
+                adValues[attrib['ad']] = unicode(value)
+                continue
+            element = adObj.find(attrib['ad'])
+            if element is not None:
+                adValues[attrib['ad']] = [unicode(item.text) for item in element.findall('Item')
+                                          if item.text is not None]
+        return adValues
+
+    def _iterADObjects(self, xmlfile):
+        """
+        Parse the XML dump incrementally. Yields ('Domain', attributes) for the
+        root domain and (objSchema, adValues) for every AD object, the elements
+        already read are cleared so the memory does not depend on the dump size.
+        """
+        schemas = dict([(objSchema['adName'], objSchema) for objSchema in self.importSchema])
+        domain_read = False
+        parents = []
+        for event, elem in iterparse(xmlfile, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                if elem.tag == 'Domain' and not domain_read:
+                    domain_read = True
+                    yield 'Domain', dict([(key, unicode(value)) for key, value in elem.attrib.items()])
+                continue
+            parents.pop()
+            objSchema = schemas.get(elem.tag)
+            if objSchema is None:
+                continue
+            yield objSchema, self._readADObject(objSchema, elem)
+            elem.clear()
+            if parents and parents[-1].tag not in schemas:
+                # Remove the objects already read from their container
+                del parents[-1][:]
 
-    def _convertADObjectToMongoObject(self, domain, mongoObjects, objSchema, adObj, is_ad_master, report, objects_apply_policy):
+    def _convertADObjectToMongoObject(self, domain, names, objSchema, adValues, mongoObj, is_ad_master, report):
+
+        def set_attributes(obj, objSchema, adValues, update_name=True):
+            for attrib in objSchema['attributes']:
+                if attrib['ad'] not in adValues or (attrib['mongo'] == 'name' and not update_name):
+                    continue
+                obj[attrib['mongo']] = adValues[attrib['ad']]
+                if attrib.get('json', False) and obj[attrib['mongo']] and isinstance(obj[attrib['mongo']], basestring):
+                    obj[attrib['mongo']] = json.loads(obj[attrib['mongo']])
+            for attrib in objSchema['staticAttributes']:
+                if attrib['key'] not in obj:
+                    obj[attrib['key']] = attrib['value']
+            return obj
 
-        def update_object(self, objSchema, mongoObj, adObj):
+        def update_object(self, objSchema, mongoObj, adValues):
             """
             Update an object from a collection with a GUID in common.
             """
 
             # Update MONGODB object with ACTIVE DIRECTORY attributes
-            for attrib in objSchema['attributes']:
-                if attrib['mongo'] != 'name':  # TODO: Proper update the object name
-                    if adObj.hasAttribute(attrib['ad']):
-                        mongoObj[attrib['mongo']] = adObj.attributes[attrib['ad']].value
-                        if attrib.get('json', False) and mongoObj[attrib['mongo']]:
-                            mongoObj[attrib['mongo']] = json.loads(mongoObj[attrib['mongo']])
-                    else:
-                        elements = adObj.getElementsByTagName(attrib['ad'])
-                        if elements.length > 0:
-                            mongoObj[attrib['mongo']] = []
-                            items = elements[0].getElementsByTagName('Item')
-                            for item in items:
-                                mongoObj[attrib['mongo']].append(item.childNodes[0].nodeValue)
-            for attrib in objSchema['staticAttributes']:
-                if attrib['key'] not in mongoObj:
-                    mongoObj[attrib['key']] = attrib['value']
+            # TODO: Proper update the object name
+            return set_attributes(mongoObj, objSchema, adValues, update_name=False)
 
-            return mongoObj
-
-        def new_object(self, domain, mongoObjects, objSchema, adObj, objects_apply_policy):
+        def new_object(self, domain, names, objSchema, adValues):
             """
             Create an object into a collection.
             """
 
             # Create the new MONGODB object.
-            newObj = {}
-            for attrib in objSchema['attributes']:
-                if adObj.hasAttribute(attrib['ad']):
-                    newObj[attrib['mongo']] = adObj.attributes[attrib['ad']].value
-                    if attrib.get('json', False) and mongoObj[attrib['mongo']]:
-                        mongoObj[attrib['mongo']] = json.loads(mongoObj[attrib['mongo']])
-                else:
-                    elements = adObj.getElementsByTagName(attrib['ad'])
-                    if elements.length > 0:
-                        newObj[attrib['mongo']] = []
-                        items = elements[0].getElementsByTagName('Item')
-                        for item in items:
-                            newObj[attrib['mongo']].append(item.childNodes[0].nodeValue)
-            # Add static attributes
-            for attrib in objSchema['staticAttributes']:
-                if attrib['key'] not in newObj:
-                    newObj[attrib['key']] = attrib['value']
+            newObj = set_attributes({}, objSchema, adValues)
 
             # Add additional attributes.
             defaultValues = objSchema['serializeModel']().serialize({})
@@ -471,62 +521,121 @@ class ADImport(BaseAPI):
             newObj['policies'] = {}
             defaultValues.update(newObj)
             newObj = defaultValues
+            # The id is known before saving, the children need it in their path
+            newObj['_id'] = ObjectId()
 
-            self._fixDuplicateName(mongoObjects, objSchema['mongoType'], newObj, domain)
-
-            if newObj['type'] in ('computer', 'user'):
-                objects_apply_policy[newObj['type']].append(newObj['name'])
+            self._fixDuplicateName(names, objSchema['mongoType'], newObj)
 
             # Save the new object
             return newObj
 
-        # Try to get an already exist object
-        mongoObj = self.collection.find_one({'adObjectGUID': adObj.attributes['ObjectGUID'].value})
         if mongoObj is not None:
             if is_ad_master:
                 report['updated'] += 1
-                return update_object(self, objSchema, mongoObj, adObj), True
+                return update_object(self, objSchema, mongoObj, adValues), True
             return mongoObj, False
         else:
             report['inserted'] += 1
-            return new_object(self, domain, mongoObjects, objSchema, adObj, objects_apply_policy), True
+            return new_object(self, domain, names, objSchema, adValues), True
 
-    def _get_domain(self, ouSchema, xmlDomain, is_ad_master, report):
-        # Get already exists root domain
-        domain_id = self.request.POST.get('domainId', None)
-        system_type = self.request.POST.get('systemType', 'ad')
-        if not domain_id:
-            raise HTTPBadRequest('GECOSCC needs a domainId param')
+    def _convertADObjectsToMongoObjects(self, domain, names, adObjects, is_ad_master, report):
+        """
+        Convert a chunk of AD objects, the objects already in the database
+        are read with only one query.
+        Returns a list of (mongoObject, is_saving, is_new)
+        """
+        guids = [adValues['ObjectGUID'] for objSchema, adValues in adObjects]
+        existingObjects = dict([(mongoObj['adObjectGUID'], mongoObj) for mongoObj in
+                                self.collection.find({'adObjectGUID': {'$in': guids}})])
+        mongoObjects = []
+        for objSchema, adValues in adObjects:
+            existingObject = existingObjects.get(adValues['ObjectGUID'])
+            mongoObject, is_saving = self._convertADObjectToMongoObject(domain, names, objSchema, adValues,
+                                                                        existingObject, is_ad_master, report)
+            report['total'] += 1
+            mongoObjects.append((mongoObject, is_saving, existingObject is None))
+        return mongoObjects
+
+    def _normalizeDN(self, distinguishedName):
+        """
+        Distinguished name without the spaces between its components
+        """
+        return ','.join(self.dnComponents.findall(distinguishedName))
 
+    def _parentDN(self, distinguishedName):
+        return ','.join(self.dnComponents.findall(distinguishedName)[1:])
+
+    def _placeMongoObjects(self, paths, waiting, distinguishedName, mongoObject, placed):
+        """
+        Register the path of an object, the objects that were waiting for it
+        (and their own waiting children) get their path and are appended to placed
+        """
+        pending = [(distinguishedName, mongoObject)]
+        while pending:
+            distinguishedName, mongoObject = pending.pop()
+            paths[distinguishedName] = (mongoObject['_id'], mongoObject['path'], mongoObject['type'])
+            for child in waiting.pop(distinguishedName, []):
+                child['path'] = '{0},{1}'.format(mongoObject['path'], str(mongoObject['_id']))
+                placed.append(child)
+                pending.append((self._normalizeDN(child['adDistinguishedName']), child))
+
+    def _importADObjects(self, domain, names, paths, waiting, saved_ids, new_ids, adObjects, is_ad_master, report):
+        """
+        Convert a chunk of AD objects and save the objects whose parent is
+        already in the tree. The others wait in memory until their parent
+        is read, the dumps usually have the OUs before their children.
+        """
+        placed = []
+        for mongoObject, is_saving, is_new in self._convertADObjectsToMongoObjects(domain, names, adObjects,
+                                                                                   is_ad_master, report):
+            distinguishedName = self._normalizeDN(mongoObject['adDistinguishedName'])
+            if not is_saving:
+                # Only its path is needed to save its children
+                self._placeMongoObjects(paths, waiting, distinguishedName, mongoObject, placed)
+                continue
+            if mongoObject['type'] in ('user', 'computer'):
+                # The groups and the chef node are resolved once every object is saved
+                if 'memberof' not in mongoObject or is_ad_master:
+                    mongoObject['memberof'] = []
+                saved_ids.append(mongoObject['_id'])
+                if is_new:
+                    new_ids.add(mongoObject['_id'])
+            elif mongoObject['type'] == 'group' and is_ad_master:
+                # AD Fixes
+                mongoObject['members'] = []
+            parent = paths.get(self._parentDN(distinguishedName))
+            if parent is None:
+                waiting.setdefault(self._parentDN(distinguishedName), []).append(mongoObject)
+                continue
+            mongoObject['path'] = '{0},{1}'.format(parent[1], str(parent[0]))
+            placed.append(mongoObject)
+            self._placeMongoObjects(paths, waiting, distinguishedName, mongoObject, placed)
+        self._saveMongoObjects(placed)
+
+    def _update_domain(self, domain_id, xmlDomain, system_type, is_ad_master, report):
         filter_domain = {
-            '_id': ObjectId(domain_id),
-            'type': ouSchema['mongoType']
+            '_id': domain_id,
+            'type': 'ou'
         }
         domain = self.collection.find_one(filter_domain)
-
         if not domain:
-            raise HTTPBadRequest('domain does not exists')
-
-        can_access_to_this_path(self.request, self.collection, domain, ou_type='ou_availables')
-
-        if not is_domain(domain):
-            raise HTTPBadRequest('domain param is not a domain id')
+            raise Exception('domain does not exists')
 
         update_domain = {
-            'extra': xmlDomain.attributes['DistinguishedName'].value,
+            'extra': xmlDomain['DistinguishedName'],
             'source': u'{0}:{1}:{2}'.format(system_type,
-                                            xmlDomain.attributes['DistinguishedName'].value,
-                                            xmlDomain.attributes['ObjectGUID'].value),
-            'adObjectGUID': xmlDomain.attributes['ObjectGUID'].value,
-            'adDistinguishedName': xmlDomain.attributes['DistinguishedName'].value,
+                                            xmlDomain['DistinguishedName'],
+                                            xmlDomain['ObjectGUID']),
+            'adObjectGUID': xmlDomain['ObjectGUID'],
+            'adDistinguishedName': xmlDomain['DistinguishedName'],
             'master_policies': {}
         }
         has_updated = False
         report['total'] += 1
         if is_ad_master:
             update_domain['master'] = u'{0}:{1}:{2}'.format(system_type,
-                                                            xmlDomain.attributes['DistinguishedName'].value,
-                                                            xmlDomain.attributes['ObjectGUID'].value)
+                                                            xmlDomain['DistinguishedName'],
+                                                            xmlDomain['ObjectGUID'])
             has_updated = True
         elif not is_ad_master:
             if 'adObjectGUID' not in domain:
@@ -541,194 +650,252 @@ class ADImport(BaseAPI):
             domain = self.collection.find_one(filter_domain)
         return domain
 
-    def _saveMongoObject(self, mongoObject):
-        if '_id' not in mongoObject.keys():
-            # Insert object
-            return self.collection.insert(mongoObject)
-        else:
-            # Update object
-            return self.collection.update({'adObjectGUID': mongoObject['adObjectGUID']}, mongoObject)
-
-    def _orderByDependencesMongoObjects(self, mongoObjects, domain):
-
-        # Order by size
-        orderedBySize = {}
-        er = re.compile(r'([^, ]+=(?:(?:\\,)|[^,])+)')
-        for index, mongoObject in mongoObjects.items():
-            if mongoObject['adDistinguishedName'] == domain['adDistinguishedName']:  # Jump root domain
-                mongoObjectRoot = mongoObject
-                continue
-            subADDN = er.findall(mongoObject['adDistinguishedName'])
-            size = len(subADDN)
-            if size not in orderedBySize.keys():
-                orderedBySize[size] = []
-            orderedBySize[size].append(mongoObject)
-
-        # Merge results in one dimensional dict
-        mongoObjects = OrderedDict()
-        mongoObjects[mongoObjectRoot['adDistinguishedName']] = mongoObjectRoot
-        for size, listMongoObjects in orderedBySize.items():
-            for mongoObject in listMongoObjects:
-                mongoObjects[mongoObject['adDistinguishedName']] = mongoObject
-        return mongoObjects
+    def _saveMongoObjects(self, mongoObjects):
+        """
+        Save the objects with ordered bulk upserts by GUID,
+        chunk_size objects by request
+        """
+        bulk = None
+        size = 0
+        for mongoObject in mongoObjects:
+            set_node_ancestors(mongoObject)
+            if bulk is None:
+                bulk = self.collection.initialize_ordered_bulk_op()
+            bulk.find({'adObjectGUID': mongoObject['adObjectGUID']}).upsert().replace_one(mongoObject)
+            size += 1
+            if size == self.chunk_size:
+                bulk.execute()
+                bulk = None
+                size = 0
+        if bulk is not None:
+            bulk.execute()
 
     def _warningGroup(self, group, mongoObject, report):
         if 'group' not in report['warnings']:
             report['warnings']['group'] = []
         report['warnings']['group'].append("The relation between %s and %s is not a relation valid at GCC" % (mongoObject['name'], group['name']))
 
-    def post(self):
-        try:
-            # Initialize report
-            report = {'inserted': 0,
-                      'updated': 0,
-                      'total': 0,
-                      'warnings': {}}
-
-            objects_apply_policy = {'computer': [],
-                                    'user': []}
-
-            db = self.request.db
-            # Read GZIP data
-            postedfile = self.request.POST['media'].file
-            xmldata = GzipFile('', 'r', 9, StringIO(postedfile.read())).read()
-
-            # Read XML data
-            xmldoc = minidom.parseString(xmldata)
+    def _isVisibleGroup(self, group_path, node_path):
+        """
+        Same check than is_visible_group, with the paths already known:
+        the group must be in an OU of the path of the node
+        """
+        ancestors = get_path_ancestors(node_path)
+        return group_path in [','.join(ancestors[:i]) for i in range(1, len(ancestors) + 1)]
 
-            # Get the root domain
-            xmlDomain = xmldoc.getElementsByTagName('Domain')[0]
-            is_ad_master = self.request.POST['master'] == 'True'
-            domain = self._get_domain(self.importSchema[0], xmlDomain, is_ad_master, report)
-
-            # Convert from AD objects to MongoDB objects
-            mongoObjects = {}
-            mongoObjectsPath = {}
-            for objSchema in self.importSchema:
-                objs = xmldoc.getElementsByTagName(objSchema['adName'])
-                for adObj in objs:
-                    if not adObj.hasAttribute('ObjectGUID'):
-                        raise Exception('An Active Directory object must has "ObjectGUID" attrib.')
-                    mongoObject, is_saving = self._convertADObjectToMongoObject(domain, mongoObjects, objSchema, adObj, is_ad_master, report, objects_apply_policy)
-                    report['total'] += 1
-                    if is_saving:
-                        mongoObjects[mongoObject['adDistinguishedName']] = mongoObject
-                    mongoObjectsPath[mongoObject['adDistinguishedName']] = mongoObject
-            # Order mongoObjects by dependences
-            if mongoObjects:
-                mongoObjects[domain['adDistinguishedName']] = domain
-                mongoObjectsPath[domain['adDistinguishedName']] = domain
-                mongoObjects = self._orderByDependencesMongoObjects(mongoObjects, domain)
-
-            # Save each MongoDB objects
-            properRootDomainADDN = domain['adDistinguishedName']
-            for index, mongoObject in mongoObjects.items():
-                if index == properRootDomainADDN:
-                    continue
-                # Get the proper path ("root,{0}._id,{1}._id,{2}._id...")
-                listPath = re.findall(ur'([^, ]+=(?:(?:\\,)|[^,])+)', index)
-                nodePath = ','.join(listPath[1:])
-
-                # Find parent
-                mongoObjectParent = mongoObjectsPath[nodePath]
-                mongoObjectParent = self.collection.find_one({'_id': mongoObjectParent['_id']})
-                path = '{0},{1}'.format(mongoObjectParent['path'], str(mongoObjectParent['_id']))
-                mongoObject['path'] = path
-                # Save mongoObject
-                self._saveMongoObject(mongoObject)
-
-            # AD Fixes
-            admin_user = self.request.user
-            chef_server_api = get_chef_api(get_current_registry().settings, admin_user)
-            if is_ad_master:
-                for index, mongoObject in mongoObjects.items():
-                    if mongoObject['type'] == 'group':
-                        if mongoObject['members'] != []:
-                            mongoObject['members'] = []
-                            self._saveMongoObject(mongoObject)
-
-            for index, mongoObject in mongoObjects.items():
-                updateMongoObject = False
-                # MemberOf
-                if mongoObject['type'] in ('user', 'computer'):
-                    if 'memberof' not in mongoObject or is_ad_master:
-                        mongoObject['memberof'] = []
-
-                    if 'adPrimaryGroup' in mongoObject and mongoObject['adPrimaryGroup']:
-                        group = mongoObjects[mongoObject['adPrimaryGroup']]
-                        if is_visible_group(db, group['_id'], mongoObject):
-                            if not mongoObject['_id'] in group['members']:
-                                group['members'].append(mongoObject['_id'])
-                                self._saveMongoObject(group)
-
-                            if mongoObjects[mongoObject['adPrimaryGroup']]['_id'] not in mongoObject['memberof']:
-                                mongoObject['memberof'].append(mongoObjects[mongoObject['adPrimaryGroup']]['_id'])
+    def _registerChefNode(self, name, chef_server_api):
+        """
+        Add the gecos recipes to the run list of the chef node and create its chef client
+        """
+        chef_server_node = reserve_node_or_raise(name,
+                                                 chef_server_api,
+                                                 'gcc-ad-import-%s' % random.random(),
+                                                 attempts=3)
+        ohai_gecos_in_runlist = self.RECIPE_NAME_OHAI_GECOS in chef_server_node.run_list
+        gecos_ws_mgmt_in_runlist = self.RECIPE_NAME_GECOS_WS_MGMT in chef_server_node.run_list
+        if not ohai_gecos_in_runlist and not gecos_ws_mgmt_in_runlist:
+            chef_server_node.run_list.append(self.RECIPE_NAME_OHAI_GECOS)
+            chef_server_node.run_list.append(self.RECIPE_NAME_GECOS_WS_MGMT)
+        elif not ohai_gecos_in_runlist and gecos_ws_mgmt_in_runlist:
+            chef_server_node.run_list.insert(chef_server_node.run_list.index(self.RECIPE_NAME_GECOS_WS_MGMT), self.RECIPE_NAME_OHAI_GECOS)
+        elif ohai_gecos_in_runlist and not gecos_ws_mgmt_in_runlist:
+            chef_server_node.run_list.insert(chef_server_node.run_list.index(self.RECIPE_NAME_OHAI_GECOS) + 1, self.RECIPE_NAME_GECOS_WS_MGMT)
+        save_node_and_free(chef_server_node)
+        chef_server_client = Client(name, api=chef_server_api)
+        if not chef_server_client.exists:
+            chef_server_client.save()
+
+    def _resolveSavedObjects(self, paths, saved_ids, new_ids, report, chef_server_api):
+        """
+        Second pass over the users and computers saved: the AD groups are
+        resolved with the paths registry, the memberships are written with
+        $addToSet bulk updates and the computers are registered in chef.
+        The policies are applied to the new objects.
+        """
+        for start in range(0, len(saved_ids), self.chunk_size):
+            chunk_ids = saved_ids[start:start + self.chunk_size]
+            nodes = self.collection.find({'_id': {'$in': chunk_ids}},
+                                         {'name': 1, 'type': 1, 'path': 1,
+                                          'adMemberOf': 1, 'adPrimaryGroup': 1})
+            updates = []
+            hidden_groups = []
+            try:
+                for node in nodes:
+                    update = {'$unset': {'adMemberOf': '', 'adPrimaryGroup': ''}}
+                    groupDNs = node.get('adMemberOf') or []
+                    if node.get('adPrimaryGroup'):
+                        groupDNs = [node['adPrimaryGroup']] + groupDNs
+                    group_ids = []
+                    for groupDN in groupDNs:
+                        group = paths.get(self._normalizeDN(groupDN))
+                        if group is None or group[2] != 'group' or group[0] in group_ids:
+                            continue
+                        if self._isVisibleGroup(group[1], node['path']):
+                            group_ids.append(group[0])
+                            updates.append((group[0], {'$addToSet': {'members': node['_id']}}))
                         else:
-                            self._warningGroup(group, mongoObject, report)
-                        updateMongoObject = True
-                        del mongoObject['adPrimaryGroup']
-
-                    if 'adMemberOf' in mongoObject and mongoObject['adMemberOf']:
-                        for group_id in mongoObject['adMemberOf']:
-                            group = mongoObjects[group_id]
-                            if is_visible_group(db, group['_id'], mongoObject):
-                                if not mongoObject['_id'] in group['members']:
-                                    group['members'].append(mongoObject['_id'])
-                                    self._saveMongoObject(group)
-
-                                if mongoObjects[group_id]['_id'] not in mongoObject['memberof']:
-                                    mongoObject['memberof'].append(mongoObjects[group_id]['_id'])
-                            else:
-                                self._warningGroup(group, mongoObject, report)
-                        updateMongoObject = True
-                        del mongoObject['adMemberOf']
-
-                # Create Chef-Server Nodes
-                if mongoObject['type'] == 'computer':
-                    chef_server_node = reserve_node_or_raise(mongoObject['name'],
-                                                             chef_server_api,
-                                                             'gcc-ad-import-%s' % random.random(),
-                                                             attempts=3)
-                    ohai_gecos_in_runlist = self.RECIPE_NAME_OHAI_GECOS in chef_server_node.run_list
-                    gecos_ws_mgmt_in_runlist = self.RECIPE_NAME_GECOS_WS_MGMT in chef_server_node.run_list
-                    if not ohai_gecos_in_runlist and not gecos_ws_mgmt_in_runlist:
-                        chef_server_node.run_list.append(self.RECIPE_NAME_OHAI_GECOS)
-                        chef_server_node.run_list.append(self.RECIPE_NAME_GECOS_WS_MGMT)
-                    elif not ohai_gecos_in_runlist and gecos_ws_mgmt_in_runlist:
-                        chef_server_node.run_list.insert(chef_server_node.run_list.index(self.RECIPE_NAME_GECOS_WS_MGMT), self.RECIPE_NAME_OHAI_GECOS)
-                    elif ohai_gecos_in_runlist and not gecos_ws_mgmt_in_runlist:
-                        chef_server_node.run_list.insert(chef_server_node.run_list.index(self.RECIPE_NAME_OHAI_GECOS) + 1, self.RECIPE_NAME_GECOS_WS_MGMT)
-                    save_node_and_free(chef_server_node)
-                    chef_server_client = Client(mongoObject['name'], api=chef_server_api)
-                    if not chef_server_client.exists:
-                        chef_server_client.save()
-                    mongoObject['node_chef_id'] = mongoObject['name']
-                    updateMongoObject = True
-
-                # Save changes
-                if updateMongoObject:
-                    self._saveMongoObject(mongoObject)
+                            hidden_groups.append((node, group[0]))
+                    if group_ids:
+                        update['$addToSet'] = {'memberof': {'$each': group_ids}}
+
+                    # Create Chef-Server Nodes
+                    if node['type'] == 'computer':
+                        self._registerChefNode(node['name'], chef_server_api)
+                        update['$set'] = {'node_chef_id': node['name']}
+                        report['chef_registered'] += 1
+                        self._progress(report)
+                    updates.append((node['_id'], update))
+            finally:
+                # The changes already done are saved although a chef request fails
+                if updates:
+                    bulk = self.collection.initialize_unordered_bulk_op()
+                    for node_id, update in updates:
+                        bulk.find({'_id': node_id}).update_one(update)
+                    bulk.execute()
+
+            if hidden_groups:
+                hidden_group_ids = [hidden_group_id for hidden_node, hidden_group_id in hidden_groups]
+                group_names = dict([(hidden_group['_id'], hidden_group['name']) for hidden_group in
+                                    self.collection.find({'_id': {'$in': hidden_group_ids}}, {'name': 1})])
+                for node, group_id in hidden_groups:
+                    self._warningGroup({'name': group_names.get(group_id)}, node, report)
 
             # apply policies to new objects
-            for node_type, node_names in objects_apply_policy.items():
-                nodes = self.collection.find({'name': {'$in': node_names},
-                                              'path': get_filter_this_domain(domain),
-                                              'type': node_type})
-                for node in nodes:
+            new_chunk_ids = [node_id for node_id in chunk_ids if node_id in new_ids]
+            if new_chunk_ids:
+                for node in self.collection.find({'_id': {'$in': new_chunk_ids}}):
                     apply_policies_function = globals()['apply_policies_to_%s' % node['type']]
-                    apply_policies_function(self.collection, node, admin_user, api=chef_server_api)
-
-            # Return result
-            status = '{0} inserted, {1} updated of {2} objects imported successfully.'.format(report['inserted'],
-                                                                                              report['updated'],
-                                                                                              report['total'])
-            response = {'status': status,
-                        'ok': True}
+                    apply_policies_function(self.collection, node, self.admin_user, api=chef_server_api)
+
+    def run(self, dumpfile, domain_id, is_ad_master, system_type='ad'):
+        """
+        Import the gzipped XML dump into the domain. Returns the report.
+        The objects are saved by chunks while the XML data is read, only
+        the ids, paths and types of the objects are kept in memory.
+        """
+        # Initialize report
+        report = {'parsed': 0,
+                  'inserted': 0,
+                  'updated': 0,
+                  'chef_registered': 0,
+                  'total': 0,
+                  'warnings': {}}
+
+        # Read GZIP data
+        xmlfile = GzipFile(fileobj=dumpfile, mode='rb')
+
+        # Convert from AD objects to MongoDB objects and save them while the XML data is read
+        domain = None
+        # Distinguished name: (_id, path, type) of the objects with path
+        paths = {}
+        # Objects without path by the distinguished name of their parent
+        waiting = {}
+        # Users and computers saved, new users and computers
+        saved_ids = []
+        new_ids = set()
+        adObjects = []
+        for objSchema, adValues in self._iterADObjects(xmlfile):
+            if objSchema == 'Domain':
+                # Get the root domain
+                domain = self._update_domain(domain_id, adValues, system_type, is_ad_master, report)
+                names = self._getNamesRegistry(domain)
+                paths[self._normalizeDN(domain['adDistinguishedName'])] = (domain['_id'], domain['path'], domain['type'])
+                continue
+            adObjects.append((objSchema, adValues))
+            report['parsed'] += 1
+            if domain is not None and len(adObjects) >= self.chunk_size:
+                self._importADObjects(domain, names, paths, waiting, saved_ids, new_ids, adObjects,
+                                      is_ad_master, report)
+                adObjects = []
+                self._progress(report)
+        if domain is None:
+            raise Exception('The Active Directory dump must has a "Domain" element.')
+        if adObjects:
+            self._importADObjects(domain, names, paths, waiting, saved_ids, new_ids, adObjects,
+                                  is_ad_master, report)
+            adObjects = []
+        if waiting:
+            parentDN = waiting.keys()[0]
+            raise Exception('The parent %s of %s is not in the Active Directory dump.' %
+                            (parentDN, waiting[parentDN][0]['adDistinguishedName']))
+
+        self._progress(report, force=True)
+
+        chef_server_api = get_chef_api(self.settings, self.admin_user)
+        self._resolveSavedObjects(paths, saved_ids, new_ids, report, chef_server_api)
+        return report
+
+
+@resource(path='/api/ad_import/',
+          description='Active Directory import',
+          validators=http_basic_login_required)
+class ADImport(BaseAPI):
+    """
+    Receive a Active Directory XML dump. The dump is imported by the
+    ad_import task, its progress is written in the job returned.
+    """
+
+    collection_name = 'nodes'
+
+    def _get_domain(self):
+        # Get already exists root domain
+        domain_id = self.request.POST.get('domainId', None)
+        if not domain_id:
+            raise HTTPBadRequest('GECOSCC needs a domainId param')
+
+        filter_domain = {
+            '_id': ObjectId(domain_id),
+            'type': 'ou'
+        }
+        domain = self.collection.find_one(filter_domain)
+
+        if not domain:
+            raise HTTPBadRequest('domain does not exists')
+
+        can_access_to_this_path(self.request, self.collection, domain, ou_type='ou_availables')
+
+        if not is_domain(domain):
+            raise HTTPBadRequest('domain param is not a domain id')
+        return domain
+
+    def _save_dump(self, postedfile):
+        """
+        Copy the posted dump to ad_import.upload_dir, the task reads it from there
+        """
+        settings = get_current_registry().settings
+        upload_dir = settings.get('ad_import.upload_dir', None) or tempfile.gettempdir()
+        if not os.path.exists(upload_dir):
+            os.makedirs(upload_dir)
+        dumpfile = tempfile.NamedTemporaryFile(prefix='ad_import_', suffix='.xml.gz',
+                                               dir=upload_dir, delete=False)
+        with dumpfile:
+            shutil.copyfileobj(postedfile, dumpfile)
+        return dumpfile.name
+
+    def post(self):
+        try:
+            domain = self._get_domain()
+            is_ad_master = self.request.POST['master'] == 'True'
+            system_type = self.request.POST.get('systemType', 'ad')
+            filename = self._save_dump(self.request.POST['media'].file)
+
+            user = self.request.user
+            macrojob_storage = JobStorage(self.request.db.jobs, user)
+            macrojob_id = macrojob_storage.create(obj=domain,
+                                                  op='import',
+                                                  computer=None,
+                                                  status='processing',
+                                                  policy={'name': 'Active Directory import',
+                                                          'name_es': self._('Active Directory import')},
+                                                  administrator_username=user['username'],
+                                                  message=self._('Active Directory import enqueued'))
+            ad_import.delay(user, domain['_id'], filename, is_ad_master, system_type, macrojob_id)
+            invalidate_jobs(self.request, user)
+            response = {'status': 'Active Directory import enqueued.',
+                        'ok': True,
+                        'job': unicode(macrojob_id)}
         except Exception as e:
             logger.exception(e)
             response = {'status': u'{0}'.format(e),
                         'ok': False}
-        warnings = report.get('warnings', [])
-        if warnings:
-            response['warnings'] = warnings
         return response
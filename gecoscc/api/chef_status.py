@@ -25,8 +25,9 @@ from gecoscc.models import Job
 from gecoscc.models import User
 from gecoscc.utils import (get_chef_api, get_filter_in_domain,
                            apply_policies_to_user, remove_policies_of_computer,
-                           reserve_node_or_raise, save_node_and_free, update_computers_of_user)
-from gecoscc.socks import invalidate_jobs, invalidate_change, add_computer_to_user, update_tree
+                           reserve_node_or_raise, save_node_and_free, update_computers_of_user,
+                           free_node, set_node_ancestors)
+from gecoscc.socks import invalidate_jobs, invalidate_change, add_computer_to_user, update_tree, publisher
 
 USERS_OLD = 'ohai_gecos.users_old'
 USERS_OHAI = 'ohai_gecos.users'
@@ -61,6 +62,8 @@ class ChefStatusResource(BaseAPI):
                     'message': 'The admin user %s does not exists' % username}
         settings = get_current_registry().settings
         api = get_chef_api(settings, self.request.user)
+        # The chef client run has finished, it reserved the node in /chef-client/run/
+        free_node(node_id, 'client')
         node = Node(node_id, api)
         job_status = node.attributes.get('job_status')
 
@@ -73,42 +76,7 @@ class ChefStatusResource(BaseAPI):
         if job_status:
             node = reserve_node_or_raise(node_id, api, 'gcc-chef-status-%s' % random.random(), attempts=3)
             reserve_node = True
-            chef_client_error = False
-
-            for job_id, job_status in job_status.to_dict().items():
-                job = self.collection.find_one({'_id': ObjectId(job_id)})
-                if not job:
-                    continue
-                # Parent
-                macrojob = self.collection.find_one({'_id': ObjectId(job['parent'])}) if 'parent' in job else None
-                if job_status['status'] == 0:
-                    self.collection.update({'_id': job['_id']},
-                                           {'$set': {'status': 'finished',
-                                                     'last_update': datetime.datetime.utcnow()}})
-                    # Decrement number of children in parent
-                    if macrojob and 'counter' in macrojob:
-                        macrojob['counter'] -= 1
-                elif job_status['status'] == 2:
-                    self.collection.update({'_id': job['_id']},
-                                           {'$set': {'status': 'warnings',
-                                                     'message': job_status.get('message', 'Warning'),
-                                                     'last_update': datetime.datetime.utcnow()}})
-                    if macrojob:                                
-                        macrojob['status'] = 'warnings'
-                else:
-                    chef_client_error = True
-                    self.collection.update({'_id': job['_id']},
-                                           {'$set': {'status': 'errors',
-                                                     'message': job_status.get('message', 'Error'),
-                                                     'last_update': datetime.datetime.utcnow()}})
-                    if macrojob:                                
-                        macrojob['status'] = 'errors'
-                # Update parent                                 
-                if macrojob:
-                    self.collection.update({'_id': macrojob['_id']},                                                                
-                                           {'$set': {'counter': macrojob['counter'],
-                                                     'message': self._("Pending: %d") % macrojob['counter'],
-                                                     'status': 'finished' if macrojob['counter'] == 0 else macrojob['status']}})
+            chef_client_error = self.update_jobs(job_status.to_dict())
             self.request.db.nodes.update({'node_chef_id': node_id}, {'$set': {'error_last_chef_client': chef_client_error}})
             invalidate_jobs(self.request)
             node.attributes.set_dotted('job_status', {})
@@ -118,11 +86,79 @@ class ChefStatusResource(BaseAPI):
         if not users_old or users_old != users:
             if not reserve_node:
                 node = reserve_node_or_raise(node_id, api, 'gcc-chef-status-%s' % random.random(), attempts=3)
-            return self.check_users(node, api)
+            with publisher.batch():
+                return self.check_users(node, api)
         if job_status:
             save_node_and_free(node)
         return {'ok': True}
 
+    def update_jobs(self, jobs_status):
+        '''
+        Update the jobs with the status reported by the chef client.
+        The jobs and their macrojobs are read with two queries, the jobs are
+        updated with one bulk operation and the macrojob counters are
+        decremented atomically.
+        Returns if any job has finished with errors.
+        '''
+        chef_client_error = False
+        job_ids = [ObjectId(job_id) for job_id in jobs_status.keys() if ObjectId.is_valid(job_id)]
+        if not job_ids:
+            return chef_client_error
+        jobs = self.collection.find({'_id': {'$in': job_ids}}, {'parent': 1})
+        jobs = dict((unicode(job['_id']), job) for job in jobs)
+        parent_ids = list(set([job['parent'] for job in jobs.values() if job.get('parent')]))
+        macrojobs = self.collection.find({'_id': {'$in': parent_ids}}, {'counter': 1})
+        macrojobs = dict((macrojob['_id'], macrojob) for macrojob in macrojobs)
+
+        now = datetime.datetime.utcnow()
+        bulk = self.collection.initialize_unordered_bulk_op()
+        finished_by_macrojob = {}
+        status_by_macrojob = {}
+        for job_id, job_status in jobs_status.items():
+            job = jobs.get(job_id, None)
+            if not job:
+                continue
+            macrojob = macrojobs.get(job.get('parent', None), None)
+            if job_status['status'] == 0:
+                bulk.find({'_id': job['_id']}).update({'$set': {'status': 'finished',
+                                                                'last_update': now}})
+                # Decrement number of children in parent
+                if macrojob and 'counter' in macrojob:
+                    finished_by_macrojob[macrojob['_id']] = finished_by_macrojob.get(macrojob['_id'], 0) + 1
+            elif job_status['status'] == 2:
+                bulk.find({'_id': job['_id']}).update({'$set': {'status': 'warnings',
+                                                                'message': job_status.get('message', 'Warning'),
+                                                                'last_update': now}})
+                if macrojob and status_by_macrojob.get(macrojob['_id'], None) != 'errors':
+                    status_by_macrojob[macrojob['_id']] = 'warnings'
+            else:
+                chef_client_error = True
+                bulk.find({'_id': job['_id']}).update({'$set': {'status': 'errors',
+                                                                'message': job_status.get('message', 'Error'),
+                                                                'last_update': now}})
+                if macrojob:
+                    status_by_macrojob[macrojob['_id']] = 'errors'
+        if jobs:
+            bulk.execute()
+
+        # Update parents
+        for macrojob_id in set(finished_by_macrojob.keys() + status_by_macrojob.keys()):
+            update = {}
+            if macrojob_id in finished_by_macrojob:
+                update['$inc'] = {'counter': -finished_by_macrojob[macrojob_id]}
+            if macrojob_id in status_by_macrojob:
+                update['$set'] = {'status': status_by_macrojob[macrojob_id]}
+            macrojob = self.collection.find_and_modify({'_id': macrojob_id}, update, new=True)
+            if not macrojob or 'counter' not in macrojob:
+                continue
+            # If other chef client has changed the macrojob meanwhile, it writes the message
+            self.collection.update({'_id': macrojob_id,
+                                    'counter': macrojob['counter'],
+                                    'status': macrojob['status']},
+                                   {'$set': {'message': self._("Pending: %d") % macrojob['counter'],
+                                             'status': 'finished' if macrojob['counter'] == 0 else macrojob['status']}})
+        return chef_client_error
+
     def check_users(self, chef_node, api):
         node_collection = self.request.db.nodes
 
@@ -143,7 +179,7 @@ class ChefStatusResource(BaseAPI):
                 continue
             user = node_collection.find_one({'name': username,
                                              'type': 'user',
-                                             'path': get_filter_in_domain(node)})
+                                             'ancestors': get_filter_in_domain(node)})
             if not user:
                 user_model = User()
                 user = user_model.serialize({'name': username,
@@ -155,6 +191,7 @@ class ChefStatusResource(BaseAPI):
                 user = update_computers_of_user(self.request.db, user, api)
 
                 del user['_id']
+                set_node_ancestors(user)
                 user_id = node_collection.insert(user)
                 user = node_collection.find_one({'_id': user_id})
                 reload_clients = True
@@ -176,7 +213,7 @@ class ChefStatusResource(BaseAPI):
                 continue
             user = node_collection.find_one({'name': username,
                                              'type': 'user',
-                                             'path': get_filter_in_domain(node)})
+                                             'ancestors': get_filter_in_domain(node)})
             computers = user['computers'] if user else []
             if node['_id'] in computers:
                 users_remove_policies.append(deepcopy(user))
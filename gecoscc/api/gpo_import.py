@@ -24,7 +24,8 @@ from cornice.resource import resource
 from pyramid.httpexceptions import HTTPBadRequest
 
 from gecoscc.api import BaseAPI
-from gecoscc.api.gpoconversors import GPOConversor
+from gecoscc.api.gpoconversors import GPOConversor, GPOChanges, get_sid_guid
+from gecoscc.cache import policy_catalogue
 from gecoscc.permissions import http_basic_login_required, can_access_to_this_path
 from gecoscc.utils import is_domain
 
@@ -67,8 +68,7 @@ class GPOImport(BaseAPI):
             # Read SID-GUID data
             postedfile = self.request.POST['media0'].file
             xmldata = GzipFile('', 'r', 9, StringIO(postedfile.read())).read()
-            xmlsid_guid = xmltodict.parse(xmldata)
-            GPOConversor.xml_sid_guid = xmlsid_guid
+            sid_guid = get_sid_guid(xmltodict.parse(xmldata))
 
             # Update domain with master_policies
             domain_id = self.request.POST.get('domainId', None)
@@ -89,7 +89,7 @@ class GPOImport(BaseAPI):
 
             policies_slugs = self.request.POST.getall('masterPolicy[]')
             for policy_slug in policies_slugs:
-                policy = self.collection_policies.find_one({'slug': policy_slug})
+                policy = policy_catalogue.get_by_slug(self.request.db, policy_slug)
                 if 'master_policies' not in domain:
                     domain['master_policies'] = {}
                 if policy is not None and policy['_id'] not in domain['master_policies']:
@@ -101,14 +101,20 @@ class GPOImport(BaseAPI):
             xmldata = GzipFile('', 'r', 9, StringIO(postedfile.read())).read()
             xmlgpos = xmltodict.parse(xmldata)
 
-            # Apply each xmlgpo
+            # The SID-GUID table is only used by the conversors of this request
+            gpoconversors = [gpoconversorclass(self.request, sid_guid)
+                             for gpoconversorclass in GPOConversor.__subclasses__()]
+
+            # Apply each xmlgpo, the nodes are saved once with the changes of every GPO
+            changes = GPOChanges(self.request)
             for xmlgpo in xmlgpos['report']['GPO']:
-                for gpoconversorclass in GPOConversor.__subclasses__():
-                    if not gpoconversorclass(self.request).apply(self._cleanPrefixNamespaces(xmlgpo)):
+                for gpoconversor in gpoconversors:
+                    if not gpoconversor.apply(self._cleanPrefixNamespaces(xmlgpo), changes):
                         # TODO Report error to somewhere
                         ok = False
                     else:
                         counter += 1
+            changes.save()
 
             status = 'Policies applied correctly: {0}'.format(counter)
 
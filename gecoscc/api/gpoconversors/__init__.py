@@ -14,34 +14,98 @@
 
 from copy import deepcopy
 
-from gecoscc.utils import get_domain
+from bson import ObjectId
+from ordereddict import OrderedDict
+
 from gecoscc.tasks import object_changed
 
 __all__ = ['desktop_background', 'sharing_permissions', 'automatic_updates', 'file_browser', 'user_mount', 'shutdown_options']
 
 
-class GPOConversor(object):
+def get_sid_guid(xml_sid_guid):
+    """
+    Index the SID-GUID table (parsed with xmltodict) by SID
+    """
+    items = (xml_sid_guid.get('items') or {}).get('item') or []
+    if isinstance(items, dict):
+        # Only one item
+        items = [items]
+    return dict([(item['@sid'], item['@guid']) for item in items])
 
-    collection_name = 'nodes'
 
-    xml_sid_guid = None
+class GPOChanges(object):
+    """
+    Policies changed by the conversors of a GPO import. The nodes are read
+    once, and every changed node is saved and sent to the object_changed
+    task once, with all its changes, when the import finishes.
+    """
 
     def __init__(self, request):
+        self.request = request
+        self.collection = request.db.nodes
+        self.nodes = OrderedDict()
+        self.old_nodes = {}
+        self.domains = {}
+
+    def load(self, guids):
+        """
+        Read the nodes of the guids that are not read yet with one query
+        """
+        guids = [guid for guid in set(guids) if guid not in self.nodes]
+        if not guids:
+            return
+        for guid in guids:
+            self.nodes[guid] = None
+        for node in self.collection.find({'adObjectGUID': {'$in': guids}}):
+            self.nodes[node['adObjectGUID']] = node
+            self.old_nodes[node['adObjectGUID']] = deepcopy(node)
+
+    def get_node(self, guid):
+        self.load([guid])
+        return self.nodes[guid]
+
+    def get_domain(self, node):
+        path_split = node['path'].split(',')
+        if len(path_split) == 2:
+            return node
+        elif len(path_split) < 3:
+            return None
+        domain_id = path_split[2]
+        if domain_id not in self.domains:
+            self.domains[domain_id] = self.collection.find_one({'_id': ObjectId(domain_id)})
+        return self.domains[domain_id]
+
+    def save(self):
+        """
+        Save the policies of the changed nodes with a bulk update
+        and launch one object_changed task by node
+        """
+        changed = [(node, self.old_nodes[guid]) for guid, node in self.nodes.items()
+                   if node is not None and node.get('policies') != self.old_nodes[guid].get('policies')]
+        if not changed:
+            return
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for node, old_node in changed:
+            bulk.find({'_id': node['_id']}).update_one({'$set': {'policies': node['policies']}})
+        bulk.execute()
+        admin_user = self.request.user
+        for node, old_node in changed:
+            object_changed.delay(admin_user, node['type'], node, old_node)
+        self.old_nodes.update([(node['adObjectGUID'], deepcopy(node)) for node, old_node in changed])
+
+
+class GPOConversor(object):
+
+    collection_name = 'nodes'
+
+    def __init__(self, request, sid_guid=None):
         self.request = request
         self.db = request.db
         self.collection = self.db[self.collection_name]
+        self.sid_guid = sid_guid or {}
 
     def get_guid_from_sid(self, sid):
-        for item in self.xml_sid_guid['items']['item']:
-            if item['@sid'] == sid:
-                return item['@guid']
-        return None
-
-    def _saveMongoADObject(self, node, old_node):
-        admin_user = self.request.user
-        result = self.collection.update({'adObjectGUID': node['adObjectGUID']}, node)
-        object_changed.delay(admin_user, node['type'], node, old_node)
-        return result
+        return self.sid_guid.get(sid, None)
 
     def getNodesFromPath(self, lst, path):
 
@@ -63,29 +127,37 @@ class GPOConversor(object):
                 result += self.getNodesFromPath(subNode, subPath)
             return result
 
-    def apply(self, xmlgpo):
+    def apply(self, xmlgpo, changes=None):
+        """
+        Apply the policies of the GPO to its nodes. With changes (GPOChanges)
+        the nodes are saved by the caller with changes.save()
+        """
+        save = changes is None
+        if save:
+            changes = GPOChanges(self.request)
         result = True
         converted = self.convert(xmlgpo)
         if converted is None:
             # TODO: Inform about the problem
             return False
+        changes.load([guid for entry in converted for guid in entry['guids']])
         for entry in converted:
             if result is False:
                 break
             for guid in entry['guids']:
                 if result is False:
                     break
-                node = self.collection.find_one({'adObjectGUID': guid})
-                domain = get_domain(node, self.collection)
+                node = changes.get_node(guid)
                 if node is None:
                     result = False
                     # TODO: Inform about the problem
                     continue
-                old_node = deepcopy(node)
+                domain = changes.get_domain(node)
                 for policy in entry['policies']:
                     policy_id = policy.keys()[0]
                     if policy_id not in domain.get('master_policies', {}) and node.get('policies', {}).get(policy_id, None):
                         continue
                     node['policies'][policy_id] = policy[policy_id]
-                result = self._saveMongoADObject(node, old_node)
+        if save:
+            changes.save()
         return result
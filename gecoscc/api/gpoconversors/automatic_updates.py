@@ -12,15 +12,16 @@
 #
 
 from gecoscc.api.gpoconversors import GPOConversor
+from gecoscc.cache import policy_catalogue
 
 
 class AutomaticUpdates(GPOConversor):
 
     policy = None
 
-    def __init__(self, db):
-        super(AutomaticUpdates, self).__init__(db)
-        self.policy = self.db.policies.find_one({'slug': 'auto_updates_res'})
+    def __init__(self, request, sid_guid=None):
+        super(AutomaticUpdates, self).__init__(request, sid_guid)
+        self.policy = policy_catalogue.get_by_slug(self.db, 'auto_updates_res')
 
     def convert(self, xmlgpo):
         if self.policy is None:
@@ -14,15 +14,16 @@
 import re
 
 from gecoscc.api.gpoconversors import GPOConversor
+from gecoscc.cache import policy_catalogue
 
 
 class DesktopBackground(GPOConversor):
 
     policy = None
 
-    def __init__(self, db):
-        super(DesktopBackground, self).__init__(db)
-        self.policy = self.db.policies.find_one({'slug': 'desktop_background_res'})
+    def __init__(self, request, sid_guid=None):
+        super(DesktopBackground, self).__init__(request, sid_guid)
+        self.policy = policy_catalogue.get_by_slug(self.db, 'desktop_background_res')
 
     def convert(self, xmlgpo):
         if self.policy is None:
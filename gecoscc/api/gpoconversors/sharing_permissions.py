@@ -13,15 +13,16 @@
 #
 
 from gecoscc.api.gpoconversors import GPOConversor
+from gecoscc.cache import policy_catalogue
 
 
 class SharingPermissions(GPOConversor):
 
     policy = None
 
-    def __init__(self, db):
-        super(SharingPermissions, self).__init__(db)
-        self.policy = self.db.policies.find_one({'slug': 'folder_sharing_res'})
+    def __init__(self, request, sid_guid=None):
+        super(SharingPermissions, self).__init__(request, sid_guid)
+        self.policy = policy_catalogue.get_by_slug(self.db, 'folder_sharing_res')
 
     def convert(self, xmlgpo):
         if self.policy is None:
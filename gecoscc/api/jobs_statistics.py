@@ -11,7 +11,10 @@
 
 from cornice.resource import resource
 
+from pyramid.httpexceptions import HTTPBadRequest
+
 from gecoscc.api import BaseAPI
+from gecoscc.eventsmanager import get_jobs_statistics
 from gecoscc.models import Jobs, Job
 from gecoscc.permissions import api_login_required
 
@@ -33,7 +36,19 @@ class JobStatistics(BaseAPI):
         return {self.key: oid}
 
     def get(self):
-        return {'processing': self.collection.find({'status': 'processing'}).count(),
-                'finished': self.collection.find({'status': 'finished'}).count(),
-                'errors': self.collection.find({'status': 'errors'}).count(),
-                'total': self.collection.find().count()}
+        """
+        Number of jobs by status. Params:
+          administrator=true: only the jobs of the request user
+          hours: only the jobs created in the last hours
+        """
+        administrator_username = None
+        if self.request.GET.get('administrator', '') == 'true':
+            administrator_username = self.request.user['username']
+        hours = self.request.GET.get('hours', None)
+        if hours is not None:
+            try:
+                hours = int(hours)
+            except ValueError:
+                raise HTTPBadRequest('hours must be a number')
+        cache_seconds = int(self.request.registry.settings.get('api.jobs_statistics_cache_seconds', 10))
+        return get_jobs_statistics(self.collection, administrator_username, hours, cache_seconds)
@@ -15,7 +15,8 @@ from cornice.resource import resource
 from gecoscc.api import TreeResourcePaginated
 from gecoscc.models import OrganisationalUnit, OrganisationalUnits
 from gecoscc.permissions import http_basic_login_required
-from gecoscc.utils import is_domain, MASTER_DEFAULT
+from gecoscc.utils import (is_domain, get_filter_nodes_belonging_ou, start_ou_move,
+                           move_ou_children, MASTER_DEFAULT)
 
 
 @resource(collection_path='/api/ous/',
@@ -46,37 +47,37 @@ class OrganisationalUnitResource(TreeResourcePaginated):
         '''
         Check if the Ou contains any object
         '''
-        ou_children = self.collection.find({'path': {'$regex': '.*' + unicode(obj['_id']) + '.*'}}).count()
+        ou_children = self.collection.find({'ancestors': get_filter_nodes_belonging_ou(obj['_id'])}).count()
 
         if ou_children == 0:
             return True
         else:
             return False
 
+    def get_children_paths(self, obj, old_obj):
+        new_path = ','.join([obj.get('path'), str(old_obj[self.key])])
+        old_path = ','.join([old_obj.get('path'), str(old_obj[self.key])])
+        return (old_path, new_path)
+
+    def is_moved(self, obj, old_obj):
+        return (self.request.method == 'PUT' and old_obj and
+                obj.get('path') != old_obj.get('path'))
+
+    def pre_save(self, obj, old_obj=None):
+        obj = super(OrganisationalUnitResource, self).pre_save(obj, old_obj=old_obj)
+        if obj is not None and self.is_moved(obj, old_obj):
+            # If the process dies the move is finished by the resume_ou_moves command
+            old_path, new_path = self.get_children_paths(obj, old_obj)
+            start_ou_move(self.collection, old_obj[self.key], old_path, new_path,
+                          self.request.user['username'])
+        return obj
+
     def post_save(self, obj, old_obj=None):
         """ Check if path has changed to refresh children nodes """
-        if (self.request.method == 'PUT' and old_obj and
-                obj.get('path') != old_obj.get('path')):
+        if self.is_moved(obj, old_obj):
             # The ou path has changed
-            new_path = ','.join([obj.get('path'), str(old_obj[self.key])])
-            old_path = ','.join([old_obj.get('path'), str(old_obj[self.key])])
-
-            children = self.collection.find({
-                'path': {
-                    '$regex': '^{0}'.format(old_path)
-                }
-            })
-            for child in children:
-                old_child_path = child['path']
-                new_child_path = str(old_child_path).replace(old_path,
-                                                             new_path)
-                self.collection.update({
-                    self.key: child[self.key]
-                }, {
-                    '$set': {
-                        'path': new_child_path
-                    }
-                })
+            old_path, new_path = self.get_children_paths(obj, old_obj)
+            move_ou_children(self.collection, old_obj[self.key], old_path, new_path)
         elif self.request.method == 'POST' and is_domain(obj):
             obj['master'] = MASTER_DEFAULT
             obj['master_policies'] = {}
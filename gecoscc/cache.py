@@ -0,0 +1,159 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# Authors:
+#   Pablo Martin <goinnn@gmail.com>
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+import threading
+import time
+
+from bson import ObjectId
+from jsonschema.validators import validator_for
+
+CACHE_VERSIONS_COLLECTION = 'cache_versions'
+
+
+def get_version(db, name):
+    """
+    Returns the version stamp of the cached data called name
+    """
+    version = db[CACHE_VERSIONS_COLLECTION].find_one({'_id': name})
+    return version and version['version']
+
+
+def bump_version(db, name):
+    """
+    Change the version stamp of the data called name, every process reloads
+    its copy of the data the next time that it checks the version.
+    The stamp is an ObjectId, not a counter: a dropped database never
+    repeats a version already seen.
+    """
+    db[CACHE_VERSIONS_COLLECTION].update({'_id': name},
+                                         {'$set': {'version': ObjectId()}},
+                                         upsert=True)
+
+
+class PolicyCatalogue(object):
+    """
+    In process copy of the policies collection, by _id and by slug.
+
+    The policies only change when they are imported, the catalogue checks the
+    version stamp of the policies at most every check_interval seconds and
+    reloads all the policies when it has changed. The code that writes the
+    policies must call invalidate. The policies returned are shared, they
+    must not be modified.
+    """
+
+    name = 'policies'
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        # database name: (version, checked, policies by id, policies by slug)
+        self.catalogues = {}
+
+    def load(self, db):
+        version = get_version(db, self.name)
+        by_id = {}
+        by_slug = {}
+        for policy in db.policies.find():
+            by_id[unicode(policy['_id'])] = policy
+            by_slug[policy['slug']] = policy
+        return (version, time.time(), by_id, by_slug)
+
+    def get_catalogue(self, db):
+        catalogue = self.catalogues.get(db.name, None)
+        if catalogue is not None and time.time() - catalogue[1] < self.check_interval:
+            return catalogue
+        with self.lock:
+            catalogue = self.catalogues.get(db.name, None)
+            if catalogue is None or get_version(db, self.name) != catalogue[0]:
+                catalogue = self.load(db)
+            else:
+                catalogue = (catalogue[0], time.time(), catalogue[2], catalogue[3])
+            self.catalogues[db.name] = catalogue
+        return catalogue
+
+    def get(self, db, policy_id):
+        return self.get_catalogue(db)[2].get(unicode(policy_id), None)
+
+    def get_by_slug(self, db, slug):
+        return self.get_catalogue(db)[3].get(slug, None)
+
+    def get_emitter_policies(self, db):
+        return [policy for policy in self.get_catalogue(db)[2].values()
+                if policy.get('is_emitter_policy', False)]
+
+    def invalidate(self, db):
+        bump_version(db, self.name)
+        with self.lock:
+            self.catalogues.pop(db.name, None)
+
+
+policy_catalogue = PolicyCatalogue()
+
+
+class CookbookCache(object):
+    """
+    In process copy of the chef cookbook and of the validator of its json schema.
+
+    The cookbook only changes when it is uploaded, the cache checks the
+    version stamp of the cookbook at most every check_interval seconds and
+    downloads it again when it has changed. The validator is compiled once
+    for every version of the cookbook. cookbook_upload and import_policies
+    must call invalidate. The cookbooks returned are shared, they must not
+    be modified.
+    """
+
+    name = 'cookbook'
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        # (database name, cookbook name): (version, checked, cookbook)
+        self.cookbooks = {}
+        # cookbook name: (cookbook version, validator)
+        self.validators = {}
+
+    def get(self, db, api, cookbook_name, get_cookbook):
+        key = (db.name, cookbook_name)
+        cached = self.cookbooks.get(key, None)
+        if cached is not None and time.time() - cached[1] < self.check_interval:
+            return cached[2]
+        with self.lock:
+            cached = self.cookbooks.get(key, None)
+            version = get_version(db, self.name)
+            if cached is None or version != cached[0]:
+                cached = (version, time.time(), get_cookbook(api, cookbook_name))
+            else:
+                cached = (cached[0], time.time(), cached[2])
+            self.cookbooks[key] = cached
+        return cached[2]
+
+    def get_validator(self, cookbook):
+        cookbook_name = cookbook.get('cookbook_name', None)
+        cookbook_version = cookbook.get('version', None)
+        cached = self.validators.get(cookbook_name, None)
+        if cached is not None and cached[0] == cookbook_version:
+            return cached[1]
+        schema = cookbook['metadata']['attributes']['json_schema']['object']
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        validator = cls(schema)
+        with self.lock:
+            self.validators[cookbook_name] = (cookbook_version, validator)
+        return validator
+
+    def invalidate(self, db):
+        bump_version(db, self.name)
+        with self.lock:
+            for key in [key for key in self.cookbooks if key[0] == db.name]:
+                del self.cookbooks[key]
+
+
+cookbook_cache = CookbookCache()
@@ -0,0 +1,52 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# Authors:
+#   Pablo Martin <goinnn@gmail.com>
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from optparse import make_option
+
+from gecoscc.eventsmanager import archive_jobs
+from gecoscc.management import BaseCommand
+
+
+class Command(BaseCommand):
+    description = """
+        Move the old jobs and the archived jobs to the jobs_archive collection.
+        The days are read from jobs.retention_days and jobs.archived_retention_days
+        if they are not provided
+    """
+
+    usage = "usage: %prog config_uri archive_jobs [--days 90] [--archived-days 7]"
+
+    option_list = [
+        make_option(
+            '-d', '--days',
+            dest='days',
+            action='store',
+            type='int',
+            help='Days that the jobs are kept'
+        ),
+        make_option(
+            '-a', '--archived-days',
+            dest='archived_days',
+            action='store',
+            type='int',
+            help='Days that the archived jobs are kept'
+        ),
+    ]
+
+    def command(self):
+        days = self.options.days
+        if days is None:
+            days = int(self.settings.get('jobs.retention_days', 90))
+        archived_days = self.options.archived_days
+        if archived_days is None:
+            archived_days = int(self.settings.get('jobs.archived_retention_days', 7))
+        total = archive_jobs(self.db, days, archived_days)
+        print "%s jobs moved to the archive" % total
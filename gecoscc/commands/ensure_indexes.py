@@ -0,0 +1,22 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# Authors:
+#   Pablo Martin <goinnn@gmail.com>
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from gecoscc.management import BaseCommand
+
+
+class Command(BaseCommand):
+    description = """
+        Create the indexes of the gecoscc database
+    """
+
+    def command(self):
+        self.settings['mongodb'].indexes(self.db)
+        print "Indexes ensured in %s database" % self.db.name
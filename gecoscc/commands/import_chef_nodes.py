@@ -16,7 +16,8 @@ from chef import Node as ChefNode
 from pymongo.errors import DuplicateKeyError
 
 from gecoscc.management import BaseCommand
-from gecoscc.utils import _get_chef_api, register_or_updated_node, update_node, SOURCE_DEFAULT, toChefUsername
+from gecoscc.utils import (_get_chef_api, register_or_updated_node, update_node, set_node_ancestors,
+                           SOURCE_DEFAULT, toChefUsername)
 
 
 class Command(BaseCommand):
@@ -59,6 +60,7 @@ class Command(BaseCommand):
                          'lock': False,
                          'policies': {},
                          'source': SOURCE_DEFAULT})
+            set_node_ancestors(data)
             ou_id = self.db.nodes.insert(data)
             print "OU with name 'ou_0' created in mongo"
             ou = self.db.nodes.find_one({'_id': ou_id})
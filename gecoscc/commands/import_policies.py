@@ -16,6 +16,7 @@ import sys
 from copy import deepcopy
 from optparse import make_option
 
+from gecoscc.cache import cookbook_cache, policy_catalogue
 from gecoscc.management import BaseCommand
 from gecoscc.rules import EXCLUDE_GENERIC_ATTRS, is_user_policy
 from gecoscc.utils import _get_chef_api, get_cookbook, RESOURCES_EMITTERS_TYPES, emiter_police_slug, toChefUsername
@@ -271,6 +272,10 @@ class Command(BaseCommand):
                     policy['name_' + lan] = POLICY_EMITTER_NAMES_LOCALIZED[lan][slug]
                 self.treatment_policy(policy)
 
+        # The processes reload the policies and the cookbook
+        policy_catalogue.invalidate(self.db)
+        cookbook_cache.invalidate(self.db)
+
     def set_packages_url(self, value):
         value['properties']['package_list']['autocomplete_url'] = PACKAGE_POLICY_URL
         value['properties']['package_list']['items']['enum'] = []
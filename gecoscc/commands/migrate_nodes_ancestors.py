@@ -0,0 +1,29 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# Authors:
+#   Pablo Martin <goinnn@gmail.com>
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from gecoscc.management import BaseCommand
+from gecoscc.utils import set_node_ancestors
+
+
+class Command(BaseCommand):
+    description = """
+        Set the ancestors and depth fields of every node from its path
+    """
+
+    def command(self):
+        db = self.pyramid.db
+        nodes = db.nodes.find({}, {'path': 1})
+        total = 0
+        for node in nodes:
+            db.nodes.update({'_id': node['_id']},
+                            {'$set': set_node_ancestors({'path': node.get('path')})})
+            total += 1
+        print "%s nodes updated" % total
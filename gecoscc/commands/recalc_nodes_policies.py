@@ -57,7 +57,7 @@ class Command(BaseCommand):
         filters = {'type': 'computer'}
         if self.options.domain:
             domain = db.nodes.find_one({'_id': ObjectId(self.options.domain)})
-            filters['path'] = get_filter_this_domain(domain)
+            filters['ancestors'] = get_filter_this_domain(domain)
         elif self.options.computer:
             filters['$or'] = [{'_id': ObjectId(c)} for c in self.options.computer]
         computers = db.nodes.find(filters)
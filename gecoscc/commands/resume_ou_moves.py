@@ -0,0 +1,39 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# Authors:
+#   Pablo Martin <goinnn@gmail.com>
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+from gecoscc.management import BaseCommand
+from gecoscc.tasks import object_moved
+from gecoscc.utils import move_ou_children, OU_MOVES_COLLECTION
+
+
+class Command(BaseCommand):
+    description = """
+        Finish the moves of OUs that were interrupted before moving all their children
+        and recalculate the policies of the moved nodes
+    """
+
+    def command(self):
+        markers = self.db[OU_MOVES_COLLECTION]
+        for marker in markers.find():
+            ou = self.db.nodes.find_one({'_id': marker['_id']})
+            if not ou or '%s,%s' % (ou['path'], ou['_id']) != marker['new_path']:
+                # The OU was not saved with its new path, so nothing was moved
+                markers.remove({'_id': marker['_id']})
+                print "OU %s was not moved" % marker['_id']
+                continue
+            moved = move_ou_children(self.db.nodes, ou['_id'], marker['old_path'], marker['new_path'])
+            print "OU %s: %s nodes moved" % (ou['_id'], moved)
+            admin_user = self.db.adminusers.find_one({'username': marker['username']})
+            if not admin_user:
+                print "Administrator %s does not exist, the policies are not recalculated" % marker['username']
+                continue
+            old_ou = dict(ou, path=marker['old_path'].rsplit(',', 1)[0])
+            object_moved.delay(admin_user, 'ou', ou, old_ou)
@@ -10,6 +10,8 @@
 # https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
 #
 
+import threading
+
 import pymongo
 
 DEFAULT_MONGODB_HOST = 'localhost'
@@ -19,15 +21,53 @@ DEFAULT_MONGODB_URI = 'mongodb://%s:%d/%s' % (DEFAULT_MONGODB_HOST,
                                               DEFAULT_MONGODB_PORT,
                                               DEFAULT_MONGODB_NAME)
 
+# Old jobs are moved to this collection by the archive_jobs command
+JOBS_ARCHIVE_COLLECTION = 'jobs_archive'
+
+# Indexes ensured the first time the database is used (and by the
+# ensure_indexes command): (collection name, index keys)
+INDEXES = [
+    ('nodes', [('node_chef_id', pymongo.DESCENDING)]),
+    ('nodes', [('path', pymongo.DESCENDING),
+               ('type', pymongo.DESCENDING)]),
+    ('nodes', [('ancestors', pymongo.DESCENDING),
+               ('type', pymongo.DESCENDING)]),
+    ('nodes', [('ancestors', pymongo.DESCENDING),
+               ('depth', pymongo.DESCENDING)]),
+    ('jobs', [('userid', pymongo.DESCENDING)]),
+    ('jobs', [('status', pymongo.DESCENDING)]),
+    ('jobs', [('administrator_username', pymongo.DESCENDING),
+              ('status', pymongo.DESCENDING)]),
+    # Logbook of an administrator (JobResource) and archive_jobs API
+    ('jobs', [('administrator_username', pymongo.ASCENDING),
+              ('parent', pymongo.ASCENDING),
+              ('archived', pymongo.ASCENDING),
+              ('_id', pymongo.DESCENDING)]),
+    ('jobs', [('administrator_username', pymongo.ASCENDING),
+              ('archived', pymongo.ASCENDING)]),
+    # archive_jobs command
+    ('jobs', [('created', pymongo.ASCENDING)]),
+    ('jobs', [('archived', pymongo.ASCENDING),
+              ('last_update', pymongo.ASCENDING)]),
+    (JOBS_ARCHIVE_COLLECTION, [('administrator_username', pymongo.ASCENDING),
+                               ('_id', pymongo.DESCENDING)]),
+]
+
 
 class MongoDB(object):
     """Simple wrapper to get pymongo real objects from the settings uri"""
 
     def __init__(self, db_uri=DEFAULT_MONGODB_URI,
-                 connection_factory=None, **kwargs):
+                 connection_factory=None, ensure_indexes=True,
+                 jobs_archive_ttl=None, **kwargs):
 
         self.db_uri = db_uri
         self.parsed_uri = pymongo.uri_parser.parse_uri(self.db_uri)
+        self.ensure_indexes = ensure_indexes
+        # Seconds that the archived jobs are kept (None keeps them forever)
+        self.jobs_archive_ttl = jobs_archive_ttl
+        self.databases = {}
+        self.databases_lock = threading.Lock()
 
         if 'replicaSet' in kwargs:
             connection_factory = pymongo.MongoReplicaSetClient
@@ -49,26 +89,34 @@ class MongoDB(object):
         return self.connection
 
     def get_database(self, database_name=None):
+        """
+        Returns the database handle. It is authenticated (and the indexes
+        are ensured) only the first time, then the handle is cached.
+        """
         if database_name is None:
-            db = self.connection[self.database_name]
-        else:
-            db = self.connection[database_name]
-        if self.parsed_uri.get("username", None):
-            db.authenticate(
-                self.parsed_uri.get("username", None),
-                self.parsed_uri.get("password", None)
-            )
-        self.indexes(db)
+            database_name = self.database_name
+        db = self.databases.get(database_name, None)
+        if db is not None:
+            return db
+        with self.databases_lock:
+            db = self.databases.get(database_name, None)
+            if db is None:
+                db = self.connection[database_name]
+                if self.parsed_uri.get("username", None):
+                    db.authenticate(
+                        self.parsed_uri.get("username", None),
+                        self.parsed_uri.get("password", None)
+                    )
+                if self.ensure_indexes:
+                    self.indexes(db)
+                self.databases[database_name] = db
         return db
 
     def indexes(self, db):
-        db.nodes.ensure_index([
-            ('node_chef_id', pymongo.DESCENDING),
-        ])
-        db.nodes.ensure_index([
-            ('path', pymongo.DESCENDING),
-            ('type', pymongo.DESCENDING),
-        ])
+        for collection_name, index in INDEXES:
+            db[collection_name].ensure_index(index)
+        if self.jobs_archive_ttl:
+            self.jobs_archive_ttl_index(db)
         # TODO: this try/except will be removed in review release
         try:
             db.nodes.ensure_index([
@@ -82,9 +130,18 @@ class MongoDB(object):
                 ('type', pymongo.DESCENDING),
             ])
 
-        db.jobs.ensure_index([
-            ('userid', pymongo.DESCENDING),
-        ])
+    def jobs_archive_ttl_index(self, db):
+        """
+        MongoDB removes the archived jobs jobs_archive_ttl seconds after they were archived
+        """
+        try:
+            db[JOBS_ARCHIVE_COLLECTION].ensure_index([('archived_at', pymongo.ASCENDING)],
+                                                     expireAfterSeconds=self.jobs_archive_ttl)
+        except pymongo.errors.OperationFailure:
+            # The index exists with other ttl
+            db.command('collMod', JOBS_ARCHIVE_COLLECTION,
+                       index={'keyPattern': {'archived_at': pymongo.ASCENDING},
+                              'expireAfterSeconds': self.jobs_archive_ttl})
 
 
 def get_db(request):
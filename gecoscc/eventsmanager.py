@@ -11,11 +11,16 @@
 #
 
 import logging
+import threading
+import time
 
-from datetime import datetime
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
 
 from pyramid.threadlocal import get_current_registry
 
+from gecoscc.db import JOBS_ARCHIVE_COLLECTION
 from gecoscc.models import JOB_STATUS
 
 logger = logging.getLogger(__name__)
@@ -24,6 +29,53 @@ CHANNELS = {
     'admin': ('admin', ),
 }
 
+# Jobs statistics by (database, administrator, hours): (statistics, expiration time).
+# The cache is only expired by time: the jobs change too often to invalidate it
+# on every write, the statistics can be up to cache_seconds old.
+JOBS_STATISTICS_CACHE_MAX_ITEMS = 1000
+JOBS_STATISTICS_CACHE = {}
+JOBS_STATISTICS_CACHE_LOCK = threading.Lock()
+
+
+def get_jobs_statistics(collection, administrator_username=None, hours=None, cache_seconds=0):
+    """
+    Number of jobs by status (and the total) with one $group aggregation.
+    The jobs can be filtered by administrator and by the last hours since
+    they were created. The result is cached cache_seconds seconds.
+    """
+    cache_key = (collection.database.name, administrator_username, hours)
+    if cache_seconds:
+        cached = JOBS_STATISTICS_CACHE.get(cache_key, None)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+
+    match = {}
+    if administrator_username is not None:
+        match['administrator_username'] = administrator_username
+    if hours is not None:
+        match['created'] = {'$gte': datetime.utcnow() - timedelta(hours=hours)}
+    pipeline = [{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+    if match:
+        pipeline.insert(0, {'$match': match})
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        result = result['result']
+
+    statistics = dict([(status, 0) for status in JOB_STATUS])
+    total = 0
+    for group in result:
+        if group['_id'] in statistics:
+            statistics[group['_id']] = group['count']
+        total += group['count']
+    statistics['total'] = total
+
+    if cache_seconds:
+        with JOBS_STATISTICS_CACHE_LOCK:
+            if len(JOBS_STATISTICS_CACHE) >= JOBS_STATISTICS_CACHE_MAX_ITEMS:
+                JOBS_STATISTICS_CACHE.clear()
+            JOBS_STATISTICS_CACHE[cache_key] = (statistics, time.time() + cache_seconds)
+    return statistics
+
 
 class JobStorage(object):
 
@@ -56,11 +108,19 @@ class JobStorage(object):
         if not self.check_permissions():
             raise self.JobOperationForbidden()
 
-    def create(self, obj=None, op=None, status=None,
-               computer=None, policy=None,
-               parent=None, childs=0, counter=0,
-               administrator_username=None,
-               message=None):
+    def get_locales(self):
+        if not hasattr(self, '_locales'):
+            settings = get_current_registry().settings
+            default_locale_name = settings.get('pyramid.default_locale_name')
+            self._locales = [lang for lang in settings.get('pyramid.locales')
+                             if lang != default_locale_name]
+        return self._locales
+
+    def build_job(self, obj=None, op=None, status=None,
+                  computer=None, policy=None,
+                  parent=None, childs=0, counter=0,
+                  administrator_username=None,
+                  message=None):
         if obj is None or op is None or status is None:
             raise ValueError('objid, type and op are required')
         elif status not in JOB_STATUS:
@@ -106,16 +166,28 @@ class JobStorage(object):
             'counter': counter
         }
         if policy:
-            settings = get_current_registry().settings
-            languages = settings.get('pyramid.locales')
-            default_locale_name = settings.get('pyramid.default_locale_name')
-            for lang in languages:
-                if lang == default_locale_name:
-                    continue
+            for lang in self.get_locales():
                 job['policyname_%s' % lang] = policy.get('name_%s' % lang)
         if message:
             job['message'] = message
-        return self.collection.insert(job)
+        return job
+
+    def create(self, **kwargs):
+        job_id = self.collection.insert(self.build_job(**kwargs))
+        return job_id
+
+    def create_many(self, jobs):
+        """
+        Create several jobs (a list of the create arguments) with a bulk insert.
+        Returns the ids in the same order than the jobs
+        """
+        job_buffer = self.buffer()
+        job_ids = [job_buffer.create(**job) for job in jobs]
+        job_buffer.flush()
+        return job_ids
+
+    def buffer(self):
+        return JobBuffer(self)
 
     def update_status(self, jobid, status):
 
@@ -153,6 +225,58 @@ class JobStorage(object):
         return job
 
 
+class JobBuffer(object):
+    """
+    Builds the jobs in memory with their ids, so the ids are known at once,
+    and inserts them with one unordered bulk insert when it is flushed
+    """
+
+    def __init__(self, job_storage):
+        self.job_storage = job_storage
+        self.jobs = []
+
+    def create(self, **kwargs):
+        job = self.job_storage.build_job(**kwargs)
+        job['_id'] = ObjectId()
+        self.jobs.append(job)
+        return job['_id']
+
+    def flush(self):
+        if not self.jobs:
+            return
+        jobs = self.jobs
+        self.jobs = []
+        self.job_storage.collection.insert(jobs, continue_on_error=True)
+
+
+def archive_jobs(db, retention_days, archived_retention_days, batch_size=1000):
+    """
+    Move to the jobs archive the jobs created retention_days ago and the archived
+    jobs not updated in archived_retention_days, batch_size jobs each time.
+    Returns the number of jobs moved.
+    """
+    now = datetime.utcnow()
+    jobs_filter = {'$or': [{'created': {'$lt': now - timedelta(days=retention_days)}},
+                           {'archived': True,
+                            'last_update': {'$lt': now - timedelta(days=archived_retention_days)}}]}
+    jobs_archive = db[JOBS_ARCHIVE_COLLECTION]
+    total = 0
+    while True:
+        jobs = list(db.jobs.find(jobs_filter).limit(batch_size))
+        if not jobs:
+            break
+        for job in jobs:
+            job['archived_at'] = now
+        try:
+            jobs_archive.insert(jobs, continue_on_error=True)
+        except DuplicateKeyError:
+            # Jobs copied by a previous run that did not remove them
+            pass
+        db.jobs.remove({'_id': {'$in': [job['_id'] for job in jobs]}})
+        total += len(jobs)
+    return total
+
+
 def get_jobstorage(request):
     if request.is_logged:
         user = request.user
@@ -0,0 +1,203 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# Authors:
+#   Pablo Martin <goinnn@gmail.com>
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+
+import datetime
+import threading
+import time
+
+import redis
+
+from pymongo.errors import DuplicateKeyError
+
+CHEF_LOCK_BACKEND = 'chef'
+DEFAULT_LOCK_BACKEND = CHEF_LOCK_BACKEND
+NODE_LOCK_COLLECTION = 'node_locks'
+REDIS_LOCK_PREFIX = 'gecoscc:node_lock:'
+REDIS_FENCE_PREFIX = 'gecoscc:node_fence:'
+
+
+class NodeLock(object):
+    """
+    Base class of the chef node lock backends.
+
+    A node is reserved by a controller (a string that identifies who is using
+    the node). Every successful reservation returns a fencing token, a number
+    that always grows for the same node, so a stale owner can not free a node
+    reserved later by other controller.
+    """
+
+    def __init__(self, expiration):
+        self.expiration = int(expiration)
+
+    def acquire(self, node_id, controller):
+        """
+        Reserve the node in one round trip.
+        Returns the fencing token or None if the node is busy.
+        """
+        raise NotImplementedError
+
+    def release(self, node_id, controller=None, token=None):
+        """
+        Free the node. If controller or token are None the node is freed
+        whoever is the owner.
+        """
+        raise NotImplementedError
+
+
+class LocalNodeLock(NodeLock):
+    """In memory lock, useful for tests and for a single process deployment"""
+
+    def __init__(self, expiration):
+        super(LocalNodeLock, self).__init__(expiration)
+        self.mutex = threading.Lock()
+        self.locks = {}
+        self.fences = {}
+
+    def acquire(self, node_id, controller):
+        now = time.time()
+        with self.mutex:
+            current = self.locks.get(node_id)
+            if current and current['control'] != controller and current['exp_date'] > now:
+                return None
+            token = self.fences.get(node_id, 0) + 1
+            self.fences[node_id] = token
+            self.locks[node_id] = {'control': controller,
+                                   'token': token,
+                                   'exp_date': now + self.expiration}
+            return token
+
+    def release(self, node_id, controller=None, token=None):
+        with self.mutex:
+            current = self.locks.get(node_id)
+            if not current:
+                return
+            if controller is not None and current['control'] != controller:
+                return
+            if token is not None and current['token'] != token:
+                return
+            del self.locks[node_id]
+
+
+class MongoNodeLock(NodeLock):
+    """
+    Lock stored in the node_locks collection, one document by chef node.
+    The reservation is a findAndModify (upsert), so it is atomic.
+    """
+
+    def __init__(self, expiration, mongodb):
+        super(MongoNodeLock, self).__init__(expiration)
+        self.mongodb = mongodb
+
+    @property
+    def collection(self):
+        return self.mongodb.get_database()[NODE_LOCK_COLLECTION]
+
+    def acquire(self, node_id, controller):
+        now = datetime.datetime.utcnow()
+        try:
+            lock = self.collection.find_and_modify(
+                query={'_id': node_id,
+                       '$or': [{'control': None},
+                               {'control': controller},
+                               {'exp_date': {'$lt': now}}]},
+                update={'$set': {'control': controller,
+                                 'exp_date': now + datetime.timedelta(seconds=self.expiration)},
+                        '$inc': {'token': 1}},
+                upsert=True,
+                new=True)
+        except DuplicateKeyError:
+            # The document exists and other controller has the node
+            return None
+        return lock['token']
+
+    def release(self, node_id, controller=None, token=None):
+        query = {'_id': node_id}
+        if controller is not None:
+            query['control'] = controller
+        if token is not None:
+            query['token'] = token
+        self.collection.update(query, {'$set': {'control': None,
+                                                'exp_date': None}})
+
+
+class RedisNodeLock(NodeLock):
+    """Lock stored in redis with SET NX PX, the fencing token is a INCR counter"""
+
+    # Free the node only if the controller (and the token) are the owners
+    release_script = """
+        local value = redis.call('get', KEYS[1])
+        if not value then
+            return 0
+        end
+        local separator = string.find(value, ':[^:]*$')
+        if string.sub(value, 1, separator - 1) ~= ARGV[1] then
+            return 0
+        end
+        if ARGV[2] ~= '' and string.sub(value, separator + 1) ~= ARGV[2] then
+            return 0
+        end
+        return redis.call('del', KEYS[1])
+    """
+
+    def __init__(self, expiration, redis_url):
+        super(RedisNodeLock, self).__init__(expiration)
+        self.redis = redis.StrictRedis(connection_pool=redis.ConnectionPool.from_url(redis_url))
+        self.release_node = self.redis.register_script(self.release_script)
+
+    def acquire(self, node_id, controller):
+        key = REDIS_LOCK_PREFIX + node_id
+        token = self.redis.incr(REDIS_FENCE_PREFIX + node_id)
+        value = '%s:%s' % (controller, token)
+        expiration = self.expiration * 1000
+        if self.redis.set(key, value, px=expiration, nx=True):
+            return token
+        current = self.redis.get(key)
+        if current and current.rsplit(':', 1)[0] == controller:
+            self.redis.set(key, value, px=expiration)
+            return token
+        return None
+
+    def release(self, node_id, controller=None, token=None):
+        key = REDIS_LOCK_PREFIX + node_id
+        if controller is None:
+            self.redis.delete(key)
+            return
+        self.release_node(keys=[key], args=[controller, '' if token is None else token])
+
+
+def get_node_lock(settings):
+    """
+    Returns the node lock backend configured with chef.lock_backend.
+    Returns None with the chef backend: the node is reserved writing the
+    use_node attribute in the chef node itself.
+    """
+    if 'node_lock' in settings:
+        return settings['node_lock']
+    backend = settings.get('chef.lock_backend', DEFAULT_LOCK_BACKEND)
+    expiration = settings.get('chef.seconds_block_is_busy', 3600)
+    if backend == CHEF_LOCK_BACKEND:
+        node_lock = None
+    elif backend == 'local':
+        node_lock = LocalNodeLock(expiration)
+    elif backend == 'mongo':
+        node_lock = MongoNodeLock(expiration, settings['mongodb'])
+    elif backend == 'redis':
+        redis_url = settings.get('chef.lock_redis_url', None) or settings['sockjs_url']
+        node_lock = RedisNodeLock(expiration, redis_url)
+    else:
+        raise ValueError('Unknown chef.lock_backend: %s' % backend)
+    settings['node_lock'] = node_lock
+    return node_lock
+
+
+def is_use_node_mirrored(settings):
+    """Checks if the use_node attribute of the chef node should be updated too"""
+    return str(settings.get('chef.lock_mirror_use_node', False)).lower() == 'true'
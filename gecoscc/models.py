@@ -654,6 +654,13 @@ JOB_STATUS = {
 }
 
 
+class JobProgress(colander.MappingSchema):
+    parsed = colander.SchemaNode(colander.Integer(), default=0, missing=0)
+    inserted = colander.SchemaNode(colander.Integer(), default=0, missing=0)
+    updated = colander.SchemaNode(colander.Integer(), default=0, missing=0)
+    chef_registered = colander.SchemaNode(colander.Integer(), default=0, missing=0)
+
+
 class Job(colander.MappingSchema):
     # This is not a ObjectId, is a UUID4 format string of numbers
     _id = colander.SchemaNode(colander.String())
@@ -688,10 +695,12 @@ class Job(colander.MappingSchema):
                                   missing=0)
     op = colander.SchemaNode(colander.String(),
                              validator=colander.OneOf(
-                                 ['created', 'changed', 'deleted']))
+                                 ['created', 'changed', 'deleted', 'import']))
 
     created = colander.SchemaNode(colander.DateTime())
     last_update = colander.SchemaNode(colander.DateTime())
+    # Only the jobs of the long operations (Active Directory import)
+    progress = JobProgress(missing=colander._drop())
 
 
 class Jobs(colander.SequenceSchema):
@@ -115,7 +115,6 @@ def nodes_path_filter(request, ou_type='ou_managed'):
     params = request.GET
     maxdepth = int(params.get('maxdepth', 0))
     path = request.GET.get('path', None)
-    range_depth = '0,{0}'.format(maxdepth)
     ou_managed_ids = request.user.get(ou_type, [])
     if not request.user.get('is_superuser') or ou_managed_ids:
         if path == 'root':
@@ -125,9 +124,7 @@ def nodes_path_filter(request, ou_type='ou_managed'):
         elif path is None and ou_managed_ids:
             filters = [
                 {
-                    'path': {
-                        '$regex': '.*%s.*' % '|'.join(ou_managed_ids)
-                    }
+                    'ancestors': {'$in': ou_managed_ids}
                 }, {
                     '_id': {'$in': [ObjectId(ou_managed_id) for ou_managed_id in ou_managed_ids]}
                 }
@@ -137,17 +134,17 @@ def nodes_path_filter(request, ou_type='ou_managed'):
             raise HTTPForbidden()
     elif request.user.get('is_superuser') and path is None:
         return {}
+    ancestors = unicode(path).split(',')
     return {
-        'path': {
-            '$regex': r'^{0}(,[^,]*){{{1}}}$'.format(path, range_depth),
-        }
+        'ancestors': ancestors[-1],
+        'depth': {'$gte': len(ancestors), '$lte': len(ancestors) + maxdepth},
     }
 
 
 def user_nodes_filter(request, ou_type='ou_managed'):
     ou_managed_ids = request.user.get(ou_type, [])
     if ou_managed_ids:
-        return {'path': {'$regex': '.*%s.*' % '|'.join(ou_managed_ids)}}
+        return {'ancestors': {'$in': ou_managed_ids}}
     elif request.user.get('is_superuser'):
         return {}
     raise HTTPForbidden()
@@ -10,9 +10,16 @@
 # https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
 #
 
+import threading
+
+import gevent
+import gevent.queue
 import redis
 import simplejson as json
 
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from pyramid.response import Response
 from pyramid.threadlocal import get_current_registry
 
@@ -24,11 +31,187 @@ from socketio.virtsocket import Socket
 
 CHANNEL_WEBSOCKET = 'message'
 TOKEN = 'token'
+LOCAL_REDIS_SCHEME = 'memory://'
+DEFAULT_FLUSH_WINDOW = 1
+
+REDIS_POOLS = {}
+REDIS_POOLS_LOCK = threading.Lock()
+
+
+class LocalRedis(object):
+    """
+    In memory stand-in of the redis client (sockjs_url = memory://),
+    the published messages are kept in the published list and they are
+    delivered to the subscriptions of this process
+    """
+
+    def __init__(self):
+        self.published = []
+        self.subscriptions = set()
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        receivers = [subscription for subscription in list(self.subscriptions)
+                     if channel in subscription.channels]
+        for subscription in receivers:
+            subscription.queue.put({'type': 'message',
+                                    'channel': channel,
+                                    'data': message})
+        return len(receivers)
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    def pubsub(self):
+        return LocalPubSub(self)
+
+
+class LocalPipeline(object):
+
+    def __init__(self, local_redis):
+        self.local_redis = local_redis
+        self.commands = []
+
+    def publish(self, channel, message):
+        self.commands.append((channel, message))
+        return self
+
+    def execute(self):
+        result = [self.local_redis.publish(channel, message) for channel, message in self.commands]
+        self.commands = []
+        return result
+
+
+class LocalPubSub(object):
+
+    def __init__(self, local_redis):
+        self.local_redis = local_redis
+        self.channels = set()
+        self.queue = gevent.queue.Queue()
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self.queue.put({'type': 'subscribe',
+                            'channel': channel,
+                            'data': len(self.channels)})
+        self.local_redis.subscriptions.add(self)
+
+    def unsubscribe(self, *channels):
+        self.channels.difference_update(channels or set(self.channels))
+        if not self.channels:
+            self.local_redis.subscriptions.discard(self)
+
+    def listen(self):
+        while self.channels:
+            yield self.queue.get()
+
+    def close(self):
+        self.unsubscribe()
 
 
 def get_manager():
+    """
+    Returns the redis client of the process. The clients of the same url
+    share the connection pool
+    """
     settings = get_current_registry().settings
-    return redis.Redis.from_url(settings['sockjs_url'])
+    url = settings['sockjs_url']
+    manager = REDIS_POOLS.get(url, None)
+    if manager is None:
+        with REDIS_POOLS_LOCK:
+            manager = REDIS_POOLS.get(url, None)
+            if manager is None:
+                if url.startswith(LOCAL_REDIS_SCHEME):
+                    manager = LocalRedis()
+                else:
+                    manager = redis.StrictRedis(connection_pool=redis.ConnectionPool.from_url(url))
+                REDIS_POOLS[url] = manager
+    return manager
+
+
+class PublisherBuffer(object):
+    """
+    Messages pending of a batch. The buffer is flushed by the thread of the
+    batch or by the timer armed with the first pending message, so the last
+    messages of a burst are not held longer than the flush window
+    """
+
+    def __init__(self, manager, flush_window):
+        self.manager = manager
+        self.flush_window = flush_window
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def add(self, key, message):
+        with self.lock:
+            self.pending.pop(key, None)
+            self.pending[key] = message
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending = self.pending
+            self.pending = OrderedDict()
+        if not pending:
+            return
+        pipeline = self.manager.pipeline(transaction=False)
+        for message in pending.values():
+            pipeline.publish(CHANNEL_WEBSOCKET, json.dumps(message))
+        pipeline.execute()
+
+
+class Publisher(threading.local):
+    """
+    Publishes the websocket messages. Inside a batch the messages are
+    coalesced (the last message with the same key wins) and they are sent
+    in one pipeline when the batch finishes or when the flush window expires.
+
+    The batch belongs to the thread that opens it: the messages published
+    from other threads (e.g. the pool of ChefTask.run_concurrently) are sent
+    at once unless these threads open their own batch
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.buffer = None
+
+    def get_flush_window(self):
+        settings = get_current_registry().settings
+        return float(settings.get('sockjs_flush_window', DEFAULT_FLUSH_WINDOW))
+
+    @contextmanager
+    def batch(self):
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.flush()
+
+    def publish(self, key, message):
+        if self.depth == 0:
+            get_manager().publish(CHANNEL_WEBSOCKET, json.dumps(message))
+            return
+        if self.buffer is None:
+            self.buffer = PublisherBuffer(get_manager(), self.get_flush_window())
+        self.buffer.add(key, message)
+
+    def flush(self):
+        buffer, self.buffer = self.buffer, None
+        if buffer is not None:
+            buffer.flush()
+
+
+publisher = Publisher()
 
 
 def is_websockets_enabled():
@@ -40,27 +223,27 @@ def invalidate_change(request, objnew):
     if not is_websockets_enabled():
         return
 
-    manager = get_manager()
-    manager.publish(CHANNEL_WEBSOCKET, json.dumps({
+    object_id = unicode(objnew['_id'])
+    publisher.publish(('change', object_id), {
         'token': request.GET.get(TOKEN, ''),
         'action': 'change',
-        'objectId': unicode(objnew['_id']),
+        'objectId': object_id,
         'user': request.user['username']
-    }))
+    })
 
 
 def invalidate_delete(request, obj):
     if not is_websockets_enabled():
         return
 
-    manager = get_manager()
-    manager.publish(CHANNEL_WEBSOCKET, json.dumps({
+    object_id = unicode(obj['_id'])
+    publisher.publish(('delete', object_id), {
         'token': request.GET.get(TOKEN, ''),
         'action': 'delete',
-        'objectId': unicode(obj['_id']),
+        'objectId': object_id,
         'path': obj['path'],
         'user': request.user['username']
-    }))
+    })
 
 
 def invalidate_jobs(request, user=None):
@@ -68,47 +251,44 @@ def invalidate_jobs(request, user=None):
         return
 
     user = user or request.user
-    manager = get_manager()
-    manager.publish(CHANNEL_WEBSOCKET, json.dumps({
+    publisher.publish(('jobs', user.get('username')), {
         'username': user.get('username'),
         'action': 'jobs',
-    }))
+    })
 
 
 def update_tree(path = 'root'):
     if not is_websockets_enabled():
         return
 
-    manager = get_manager()
-    manager.publish(CHANNEL_WEBSOCKET, json.dumps({
+    publisher.publish(('update_tree', path), {
         'action': 'update_tree',
         'path': path
-    }))
+    })
 
 
 def add_computer_to_user(computer, user):
     if not is_websockets_enabled():
         return
 
-    manager = get_manager()
-    manager.publish(CHANNEL_WEBSOCKET, json.dumps({
+    publisher.publish(('add_computer_to_user', unicode(computer), unicode(user)), {
         'action': 'add_computer_to_user',
         'computer': unicode(computer),
         'user': unicode(user)
-    }))
+    })
 
 def delete_computer(object_id, path):
     if not is_websockets_enabled():
         return
 
-    manager = get_manager()
-    manager.publish(CHANNEL_WEBSOCKET, json.dumps({
+    object_id = unicode(object_id)
+    publisher.publish(('delete', object_id), {
         'token': '',
         'action': 'delete',
-        'objectId': unicode(object_id),
+        'objectId': object_id,
         'path': path,
         'user': 'Chef server'
-    }))
+    })
 
 
 class GecosSocketIOServer(SocketIOServer):
@@ -131,29 +311,82 @@ class GecosGeventSocketIOWorker(GeventSocketIOWorker):
     server_class = GecosSocketIOServer
 
 
-class GecosNamespace(BaseNamespace):
+class PubSubHub(object):
+    """
+    One redis subscription by worker process. Each message is decoded once
+    and it is sent only to the namespaces interested in it
+    """
 
-    def listener(self):
-        if not is_websockets_enabled():
-            return
+    def __init__(self):
+        self.namespaces = set()
+        self.listener = None
 
-        settings = get_current_registry().settings
+    def register(self, namespace):
+        self.namespaces.add(namespace)
+        if self.listener is None or self.listener.dead:
+            self.listener = gevent.spawn(self.listen)
 
-        r = redis.StrictRedis.from_url(settings['sockjs_url'])
-        r = r.pubsub()
+    def unregister(self, namespace):
+        self.namespaces.discard(namespace)
 
+    def listen(self):
+        r = get_manager().pubsub()
         try:
             r.subscribe(CHANNEL_WEBSOCKET)
 
             for m in r.listen():
                 if m['type'] == 'message':
                     data = json.loads(m['data'])
-                    self.emit(CHANNEL_WEBSOCKET, data)
+                    self.broadcast(data)
         except redis.ConnectionError:
-            self.emit(CHANNEL_WEBSOCKET, {'redis':'error'})
+            self.broadcast({'redis': 'error'})
+        finally:
+            self.listener = None
+            r.close()
+
+    def broadcast(self, data):
+        for namespace in list(self.namespaces):
+            if namespace.is_interested(data):
+                try:
+                    namespace.emit(CHANNEL_WEBSOCKET, data)
+                except Exception:
+                    self.unregister(namespace)
+
+
+pubsub_hub = PubSubHub()
+
+
+class GecosNamespace(BaseNamespace):
+
+    def initialize(self):
+        user = getattr(self.request, 'user', None) or {}
+        self.username = user.get('username', None)
+        self.is_superuser = user.get('is_superuser', False)
+        self.ou_managed = set(user.get('ou_managed', []) or [])
+
+    def is_interested(self, data):
+        """
+        The jobs messages are only sent to its administrator and
+        update_tree messages only if the path is managed by the administrator
+        """
+        action = data.get('action', None)
+        if action == 'jobs':
+            return data.get('username', None) == self.username
+        elif action == 'update_tree':
+            if self.is_superuser:
+                return True
+            path = data.get('path', None) or ''
+            return bool(self.ou_managed.intersection(path.split(',')))
+        return True
 
     def on_subscribe(self, *args, **kwargs):
-        self.spawn(self.listener)
+        if not is_websockets_enabled():
+            return
+        pubsub_hub.register(self)
+
+    def disconnect(self, *args, **kwargs):
+        pubsub_hub.unregister(self)
+        super(GecosNamespace, self).disconnect(*args, **kwargs)
 
 
 def socketio_service(request):
@@ -11,11 +11,15 @@
 #
 
 import datetime
+import math
 import random
 import os
 import subprocess
+import threading
 
-from copy import deepcopy
+from collections import defaultdict
+from copy import copy, deepcopy
+from multiprocessing.pool import ThreadPool
 
 from bson import ObjectId
 
@@ -25,18 +29,19 @@ from chef.node import NodeAttributes
 from celery.task import Task, task
 from celery.signals import task_prerun
 from celery.exceptions import Ignore
-from jsonschema import validate
 from jsonschema.exceptions import ValidationError
+from pyramid.threadlocal import get_current_registry, manager as threadlocal_manager
 
 
 import gettext
+from gecoscc.cache import cookbook_cache, policy_catalogue
 from gecoscc.eventsmanager import JobStorage
 from gecoscc.rules import get_rules, is_user_policy, get_username_chef_format, object_related_list
-from gecoscc.socks import invalidate_jobs
+from gecoscc.socks import invalidate_jobs, publisher
 # It is necessary import here: apply_policies_to_computer, apply_policies_to_printer and apply_policies_to_user...
 from gecoscc.utils import (get_chef_api, get_cookbook,
                            get_filter_nodes_belonging_ou,
-                           emiter_police_slug, get_computer_of_user,
+                           emiter_police_slug,
                            delete_dotted, to_deep_dict, reserve_node_or_raise,
                            save_node_and_free, NodeBusyException, NodeNotLinked,
                            apply_policies_to_computer, apply_policies_to_user,
@@ -50,6 +55,132 @@ from gecoscc.utils import (get_chef_api, get_cookbook,
 DELETED_POLICY_ACTION = 'deleted'
 SOFTWARE_PROFILE_SLUG = 'package_profile_res'
 
+# Job buffer of the computer that is being updated by each thread
+job_buffers = threading.local()
+# Policy diff of the task that is updating the computer of each thread
+policy_diffs = threading.local()
+# Node cache of the task that is updating the computer of each thread
+node_caches = threading.local()
+
+
+class PolicyDiff(object):
+    '''
+    Changes of the policies of an object, computed once by task and shared by
+    the threads that update its computers:
+        * policies: the policies to apply, the changed and the deleted ones.
+        * unchanged_fields: the fields of the changed policies that keep their value.
+        * patches: the values of the mergeable policies, by their updated_by nodes.
+    '''
+
+    def __init__(self, obj, objold, action, rule_type='policies'):
+        self.lock = threading.Lock()
+        self.patches = {}
+        self.unchanged_fields = {}
+        new_policies = obj.get(rule_type, {})
+        old_policies = (objold or {}).get(rule_type, {})
+        if not objold or obj.get('memberof', []) != objold.get('memberof', []):
+            self.policies = [(policy_id, action) for policy_id in new_policies.keys()]
+        else:
+            self.policies = [(policy_id, action) for policy_id, policy in new_policies.items()
+                             if policy != old_policies.get(policy_id, None)]
+            for policy_id, policy_id_action in self.policies:
+                old_policy = old_policies.get(policy_id, None)
+                if not old_policy:
+                    continue
+                self.unchanged_fields[policy_id] = set([field for field, value in new_policies[policy_id].items()
+                                                        if field in old_policy and old_policy[field] == value])
+        self.policies += [(policy_id, DELETED_POLICY_ACTION)
+                          for policy_id in set(old_policies.keys()) - set(new_policies.keys())]
+
+    def is_unchanged(self, policy, field_ui, action):
+        '''
+        Checks if the value of a field of a not mergeable policy is the same that
+        before the change, so its rule writes the value that the node already has.
+        '''
+        if action == DELETED_POLICY_ACTION or callable(field_ui):
+            return False
+        if policy.get('is_mergeable', False) or policy.get('is_emitter_policy', False):
+            return False
+        return field_ui in self.unchanged_fields.get(unicode(policy['_id']), ())
+
+    def get_patch(self, key, func, *args):
+        '''
+        Returns a copy of the value calculated by func(*args) for the first computer with this key
+        '''
+        with self.lock:
+            patch = self.patches.get(key, None)
+        if patch is None:
+            patch = func(*args)
+            with self.lock:
+                self.patches[key] = patch
+        return deepcopy(patch)
+
+
+def get_updated_by_ids(attributes):
+    '''
+    Returns the ids of the nodes in the updated_by attributes of the normal attributes of a chef node
+    '''
+    node_ids = set()
+    pending = [attributes]
+    while pending:
+        attributes = pending.pop()
+        for key, value in attributes.items():
+            if not isinstance(value, dict):
+                continue
+            if key != 'updated_by':
+                pending.append(value)
+                continue
+            for updated_by_id in value.values():
+                if isinstance(updated_by_id, list):
+                    node_ids.update(updated_by_id)
+                elif updated_by_id:
+                    node_ids.add(updated_by_id)
+    return node_ids
+
+
+class NodeCache(object):
+    '''
+    Nodes read by a task, by id. The nodes are loaded with one query for all the
+    ids that are not in the cache and are shared by the threads that update the
+    computers. The nodes returned are copies, so they can be modified.
+    '''
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.lock = threading.Lock()
+        # unicode id: node (None if it does not exist)
+        self.nodes = {}
+
+    def load(self, node_ids):
+        missing = set([unicode(node_id) for node_id in node_ids]) - set(self.nodes.keys())
+        if not missing:
+            return
+        nodes = dict.fromkeys(missing)
+        for node in self.collection.find({'_id': {'$in': [ObjectId(node_id) for node_id in missing]}}):
+            nodes[unicode(node['_id'])] = node
+        with self.lock:
+            self.nodes.update(nodes)
+
+    def get(self, node_id):
+        node_id = unicode(node_id)
+        if node_id not in self.nodes:
+            self.load([node_id])
+        return deepcopy(self.nodes[node_id])
+
+    def get_list(self, node_ids):
+        self.load(node_ids)
+        return [node for node in [self.get(node_id) for node_id in node_ids] if node is not None]
+
+
+def get_patch(key, func, *args):
+    '''
+    Returns func(*args), calculated once by task when the computers are updated by object_action
+    '''
+    policies_diff = getattr(policy_diffs, 'diff', None)
+    if policies_diff is None:
+        return func(*args)
+    return policies_diff.get_patch(key, func, *args)
+
 
 class ChefTask(Task):
     abstract = True
@@ -82,64 +213,122 @@ class ChefTask(Task):
 
     def walking_here(self, obj, related_objects):
         '''
-        Checks if an object is in the object related list else add it to the list
+        Checks if an object is in the object related set (of ids) else add it to the set
         '''
         if related_objects is not None:
-            if obj not in related_objects:
-                related_objects.append(deepcopy(obj))
+            if obj['_id'] not in related_objects:
+                related_objects.add(obj['_id'])
             else:
                 return True
         return False
 
+    def resolve_related_computers(self, objs, related_computers, related_objects):
+        '''
+        Get the related computers of a list of objects (computers, users, groups and OUs).
+        The whole closure is gathered with a few $in queries of lightweight
+        projections, and only the touched computers and users are fully loaded.
+        A computer related through a user has the user in the "user" key.
+        '''
+        projection = {'type': 1, 'computers': 1, 'members': 1}
+        computer_ids = []
+        user_ids = []
+        ou_ids = []
+        members = []
+        full_nodes = {}
+        users_computers = {}
+
+        def walk(node, is_full=False):
+            if self.walking_here(node, related_objects):
+                return
+            if is_full:
+                full_nodes[node['_id']] = node
+            if node['type'] == 'computer':
+                computer_ids.append(node['_id'])
+            elif node['type'] == 'user':
+                user_ids.append(node['_id'])
+                users_computers[node['_id']] = node.get('computers', [])
+            elif node['type'] == 'group':
+                members.extend(node.get('members', []))
+            elif node['type'] == 'ou':
+                ou_ids.append(node['_id'])
+
+        for obj in objs:
+            walk(obj, is_full=True)
+
+        if ou_ids:
+            types_order = ('computer', 'user', 'group')
+            ancestors = [get_filter_nodes_belonging_ou(ou_id) for ou_id in ou_ids]
+            nodes = self.db.nodes.find({'ancestors': {'$in': ancestors},
+                                        'type': {'$in': types_order}}, projection)
+            for node in sorted(nodes, key=lambda node: types_order.index(node['type'])):
+                walk(node)
+
+        while members:
+            member_ids = [member_id for member_id in set(members) if member_id not in related_objects]
+            del members[:]
+            if member_ids:
+                for node in self.db.nodes.find({'_id': {'$in': member_ids}}, projection):
+                    walk(node)
+
+        # Fetch the full documents of the touched computers and users
+        users_with_computers = [user_id for user_id in user_ids if users_computers[user_id]]
+        needed_ids = set(computer_ids + users_with_computers)
+        for computers_of_user in users_computers.values():
+            needed_ids.update(computers_of_user)
+        needed_ids = [node_id for node_id in needed_ids if node_id not in full_nodes]
+        if needed_ids:
+            for node in self.db.nodes.find({'_id': {'$in': needed_ids}}):
+                full_nodes[node['_id']] = node
+
+        related_computers_by_id = {}
+        for computer in related_computers:
+            related_computers_by_id.setdefault(computer['_id'], []).append(computer)
+
+        for computer_id in computer_ids:
+            computer = full_nodes.get(computer_id)
+            if computer is None or computer_id in related_computers_by_id:
+                continue
+            related_computers.append(computer)
+            related_computers_by_id[computer_id] = [computer]
+
+        for user_id in users_with_computers:
+            user = full_nodes.get(user_id)
+            if user is None:
+                continue
+            for computer_id in users_computers[user_id]:
+                computer = full_nodes.get(computer_id)
+                if computer is None or computer.get('type') != 'computer':
+                    continue
+                computers = related_computers_by_id.setdefault(computer_id, [])
+                if any(c.get('user', {}).get('_id') == user_id for c in computers):
+                    continue
+                computers_without_user = [c for c in computers if 'user' not in c]
+                if computers_without_user:
+                    computers_without_user[0]['user'] = user
+                else:
+                    computer = dict(computer)
+                    computer['user'] = user
+                    related_computers.append(computer)
+                    computers.append(computer)
+        return related_computers
+
     def get_related_computers_of_computer(self, obj, related_computers, related_objects):
         '''
         Get the related computers of a computer
         '''
-        if self.walking_here(obj, related_objects):
-            return related_computers
-        related_computers.append(obj)
-        return related_computers
+        return self.resolve_related_computers([obj], related_computers, related_objects)
 
     def get_related_computers_of_group(self, obj, related_computers, related_objects):
         '''
         Get the related computers of a group
         '''
-        if self.walking_here(obj, related_objects):
-            return related_computers
-        for node_id in obj['members']:
-            node = self.db.nodes.find_one({'_id': node_id})
-            if node and node not in related_objects:
-                self.get_related_computers(node, related_computers, related_objects)
-        return related_computers
+        return self.resolve_related_computers([obj], related_computers, related_objects)
 
     def get_related_computers_of_ou(self, ou, related_computers, related_objects):
         '''
         Get the related computers of an OU
         '''
-        if self.walking_here(ou, related_objects):
-            return related_computers
-        computers = self.db.nodes.find({'path': get_filter_nodes_belonging_ou(ou['_id']),
-                                        'type': 'computer'})
-        for computer in computers:
-            self.get_related_computers_of_computer(computer,
-                                                   related_computers,
-                                                   related_objects)
-
-        users = self.db.nodes.find({'path': get_filter_nodes_belonging_ou(ou['_id']),
-                                    'type': 'user'})
-        for user in users:
-            self.get_related_computers_of_user(user,
-                                               related_computers,
-                                               related_objects)
-
-        groups = self.db.nodes.find({'path': get_filter_nodes_belonging_ou(ou['_id']),
-                                     'type': 'group'})
-        for group in groups:
-            self.get_related_computers_of_group(group,
-                                                related_computers,
-                                                related_objects)
-
-        return related_computers
+        return self.resolve_related_computers([ou], related_computers, related_objects)
 
     def get_related_computers_of_emiters(self, obj, related_computers, related_objects):
         '''
@@ -148,24 +337,20 @@ class ChefTask(Task):
         if self.walking_here(obj, related_objects):
             return related_computers
         object_related_list = get_object_related_list(self.db, obj)
-        for object_related in object_related_list:
-            self.get_related_computers(object_related, related_computers, related_objects)
-        return related_computers
+        return self.resolve_related_computers(list(object_related_list), related_computers, related_objects)
 
     def get_related_computers_of_user(self, obj, related_computers, related_objects):
         '''
         Get the related computer of User
         '''
-        if self.walking_here(obj, related_objects):
-            return related_computers
-        return get_computer_of_user(self.db.nodes, obj, related_computers)
+        return self.resolve_related_computers([obj], related_computers, related_objects)
 
     def get_related_computers(self, obj, related_computers=None, related_objects=None):
         '''
         Get the related computers with the objs
         '''
         if related_objects is None:
-            related_objects = []
+            related_objects = set()
 
         if related_computers is None:
             related_computers = []
@@ -215,12 +400,14 @@ class ChefTask(Task):
                 else:
                     object_related_id_list = obj[rule_type][policy_id]['object_related_list']
                 object_related_list = []
+                if policy['slug'] != SOFTWARE_PROFILE_SLUG:
+                    self.load_nodes(object_related_id_list)
                 for object_related_id in object_related_id_list:
                     if policy['slug'] == SOFTWARE_PROFILE_SLUG:
                         object_related = self.db.software_profiles.find_one({'_id': ObjectId(object_related_id)})
                         object_related['type'] = 'software_profile'
                     else:
-                        object_related = self.db.nodes.find_one({'_id': ObjectId(object_related_id)})
+                        object_related = self.get_node(object_related_id)
                     if not object_related:
                         continue
                     object_related_list.append(object_related)
@@ -233,6 +420,32 @@ class ChefTask(Task):
                     return {}
         return ValueError("The rule type should be save or policy")
 
+    def get_node(self, node_id):
+        '''
+        Get a node by id, from the node cache of the task if there is one
+        '''
+        node_cache = getattr(node_caches, 'cache', None)
+        if node_cache is None:
+            return self.db.nodes.find_one({'_id': ObjectId(node_id)})
+        return node_cache.get(node_id)
+
+    def get_nodes(self, node_ids):
+        '''
+        Get the existing nodes of a list of ids, from the node cache of the task if there is one
+        '''
+        node_cache = getattr(node_caches, 'cache', None)
+        if node_cache is None:
+            return self.db.nodes.find({'_id': {'$in': [ObjectId(node_id) for node_id in node_ids]}})
+        return node_cache.get_list(node_ids)
+
+    def load_nodes(self, node_ids):
+        '''
+        Load with one query the nodes that are not in the node cache of the task
+        '''
+        node_cache = getattr(node_caches, 'cache', None)
+        if node_cache is not None:
+            node_cache.load(node_ids)
+
     def get_rules_and_object(self, rule_type, obj, node, policy):
         '''
         Get the rules and object
@@ -254,7 +467,7 @@ class ChefTask(Task):
         Get related objects from a emitter policy
         '''
         new_field_chef_value = []
-        updater_nodes = self.db.nodes.find({"$or": [{'_id': {"$in": nodes_ids}}]})
+        updater_nodes = self.get_nodes(nodes_ids)
 
         for updater_node in updater_nodes:
             if unicode(policy['_id']) in updater_node['policies']:
@@ -263,6 +476,8 @@ class ChefTask(Task):
         new_field_chef_value = list(set(new_field_chef_value))
         self.log("debug","tasks.py:::get_related_objects -> new_field_chef_value = {0}".format(new_field_chef_value))
         related_objects = []
+        if obj_type != SOFTWARE_PROFILE_SLUG:
+            self.load_nodes(new_field_chef_value)
 
         for node_id in new_field_chef_value:
             if obj_type == SOFTWARE_PROFILE_SLUG:
@@ -270,7 +485,7 @@ class ChefTask(Task):
                 related_objs.update({'type': 'software_profile'})
                 obj_list = {'object_related_list': [related_objs], 'type': obj_type}
             else:
-                related_objs = self.db.nodes.find_one({'_id': ObjectId(node_id)})
+                related_objs = self.get_node(node_id)
                 obj_list = {'object_related_list': [related_objs], 'type': obj_type}
             related_objects += object_related_list(obj_list)
         self.log("debug","tasks.py:::get_related_objects -> related_objects = {0}".format(related_objects))
@@ -399,16 +614,9 @@ class ChefTask(Task):
             self.log("debug","tasks.py:::update_ws_mergeable_policy - nodes_ids = {0}".format(nodes_ids))
         
 
-            new_field_chef_value = []
+            key = ('ws_mergeable', unicode(policy['_id']), field_ui, action == DELETED_POLICY_ACTION, tuple(sorted(nodes_ids)))
+            new_field_chef_value = get_patch(key, self.get_ws_mergeable_value, nodes_ids, policy, field_ui, obj_ui)
             self.log("debug","tasks.py:::update_ws_mergeable_policy - new_field_chef_value = {0}".format(new_field_chef_value))
-            updater_nodes = self.db.nodes.find({"$or": [{'_id': {"$in": nodes_ids}}]})
-            for updater_node in updater_nodes:
-                if field_ui in updater_node['policies'][unicode(policy['_id'])]:                                                                
-                    new_field_chef_value += updater_node['policies'][unicode(policy['_id'])][field_ui]
-                else: # support_os
-                    new_field_chef_value += obj_ui[field_ui]
-
-            
             try:
                 node.attributes.set_dotted(field_chef,list(set(new_field_chef_value)))
             except TypeError:
@@ -419,6 +627,33 @@ class ChefTask(Task):
         return False
             
 
+    def get_ws_mergeable_value(self, nodes_ids, policy, field_ui, obj_ui):
+        '''
+        Join the values of a mergeable workstation policy of the nodes that update a computer
+        '''
+        new_field_chef_value = []
+        updater_nodes = self.get_nodes(nodes_ids)
+        for updater_node in updater_nodes:
+            if field_ui in updater_node['policies'][unicode(policy['_id'])]:
+                new_field_chef_value += updater_node['policies'][unicode(policy['_id'])][field_ui]
+            else: # support_os
+                new_field_chef_value += obj_ui[field_ui]
+        return new_field_chef_value
+
+    def get_user_mergeable_value(self, nodes_ids, policy):
+        '''
+        Join the values of a mergeable user policy of the nodes that update a computer
+        '''
+        new_field_chef_value = {}
+        updater_nodes = self.get_nodes(nodes_ids)
+        for updater_node in updater_nodes:
+            node_policy = updater_node['policies'][unicode(policy['_id'])]
+            for policy_field in node_policy.keys():
+                if policy_field not in new_field_chef_value:
+                    new_field_chef_value[policy_field] = []
+                new_field_chef_value[policy_field] += node_policy[policy_field]
+        return new_field_chef_value
+
     def update_user_mergeable_policy(self, node, action, field_chef, field_ui, policy, priority_obj, priority_obj_ui, update_by_path, obj_ui):
         '''
         Updates node chef with a mergeable user policy
@@ -428,15 +663,8 @@ class ChefTask(Task):
             nodes_ids = self.get_nodes_ids(node_updated_by)
             self.log("debug","tasks.py:::update_user_mergeable_policy - nodes_ids = {0}".format(nodes_ids))
 
-            new_field_chef_value = {}
-            updater_nodes = self.db.nodes.find({"$or": [{'_id': {"$in": nodes_ids}}]})
-            for updater_node in updater_nodes:
-                node_policy = updater_node['policies'][unicode(policy['_id'])]
-                for policy_field in node_policy.keys():
-                    if policy_field not in new_field_chef_value:
-                        new_field_chef_value[policy_field] = []
-                    new_field_chef_value[policy_field] += node_policy[policy_field]
-                
+            key = ('user_mergeable', unicode(policy['_id']), tuple(sorted(nodes_ids)))
+            new_field_chef_value = get_patch(key, self.get_user_mergeable_value, nodes_ids, policy)
 
             obj_ui_field = field_ui(priority_obj_ui, obj=priority_obj, node=node, field_chef=field_chef)
             if obj_ui_field.get(priority_obj['name']):
@@ -459,7 +687,8 @@ class ChefTask(Task):
             node_updated_by = node.attributes.get_dotted(update_by_path).items()
             nodes_ids = self.get_nodes_ids(node_updated_by)
 
-            related_objects = self.get_related_objects(nodes_ids, policy, obj_ui['type'])
+            key = ('emitter', unicode(policy['_id']), obj_ui['type'], tuple(sorted(nodes_ids)))
+            related_objects = get_patch(key, self.get_related_objects, nodes_ids, policy, obj_ui['type'])
 
             node.attributes.set_dotted(field_chef, related_objects)
             return True
@@ -476,7 +705,8 @@ class ChefTask(Task):
             node_updated_by = node.attributes.get_dotted(update_by_path).items()
             nodes_ids = self.get_nodes_ids(node_updated_by)
 
-            related_objects = self.get_related_objects(nodes_ids, policy, obj_ui['type'])
+            key = ('emitter', unicode(policy['_id']), obj_ui['type'], tuple(sorted(nodes_ids)))
+            related_objects = get_patch(key, self.get_related_objects, nodes_ids, policy, obj_ui['type'])
             current_objs = field_ui(priority_obj_ui, obj=priority_obj, node=node, field_chef=field_chef)
 
             for objs in related_objects:
@@ -488,7 +718,7 @@ class ChefTask(Task):
         return False
         
 
-    def update_node_from_rules(self, rules, user, computer, obj_ui, obj, action, node, policy, rule_type, parent_id, job_ids_by_computer):
+    def update_node_from_rules(self, rules, user, computer, obj_ui, obj, action, node, policy, rule_type, parent_id, job_ids_by_computer, force_update=False):
         '''
         This function update a node from rules.
         Rules are the different fields in a policy.
@@ -497,14 +727,19 @@ class ChefTask(Task):
             2 - The field is None and action is remove
             3 - The policy is not mergeable
             4 - The policy is mergeable
+        The fields that have not changed in this task are skipped (see PolicyDiff),
+        unless force_update is True.
         '''
         updated = updated_updated_by = False
         attributes_jobs_updated = []
         attributes_updated_by_updated = []
         is_mergeable = policy.get('is_mergeable', False)
+        policies_diff = None if force_update else getattr(policy_diffs, 'diff', None)
         for field_chef, field_ui in rules.items():
             if is_user_policy(field_chef) and 'user' not in computer:
                 continue
+            if policies_diff is not None and policies_diff.is_unchanged(policy, field_ui, action):
+                continue
             job_attr = '.'.join(field_chef.split('.')[:3]) + '.job_ids'
             updated_by_attr = self.get_updated_by_fieldname(field_chef, policy, obj, computer)
             priority_obj_ui = obj_ui
@@ -570,8 +805,9 @@ class ChefTask(Task):
         '''
         Get the first exising node from a ids list
         '''
+        self.load_nodes(ids)
         for mongo_id in ids:
-            node = self.db.nodes.find_one({'_id': ObjectId(mongo_id)})
+            node = self.get_node(mongo_id)
             if node:
                 if action != DELETED_POLICY_ACTION or unicode(obj.get('_id')) != mongo_id:
                     return node
@@ -610,10 +846,10 @@ class ChefTask(Task):
 
         if updated_by.get('computer', None):
             if action != DELETED_POLICY_ACTION or unicode(obj.get('_id')) != updated_by['computer']:
-                priority_object = self.db.nodes.find_one({'_id': ObjectId(updated_by['computer'])})
+                priority_object = self.get_node(updated_by['computer'])
         if not priority_object and updated_by.get('user', None):
             if action != DELETED_POLICY_ACTION or unicode(obj.get('_id')) != updated_by['user']:
-                priority_object = self.db.nodes.find_one({'_id': ObjectId(updated_by['user'])})
+                priority_object = self.get_node(updated_by['user'])
         if not priority_object and updated_by.get('group', None):
             priority_object = self.get_first_exists_node(updated_by.get('group', None), obj, action)
         if not priority_object and updated_by.get('ou', None):
@@ -672,8 +908,7 @@ class ChefTask(Task):
         '''
         order ous by depth
         '''
-        ou_ids = [ObjectId(ou_id) for ou_id in ou_ids]
-        ous = [ou for ou in self.db.nodes.find({'_id': {'$in': ou_ids}})]
+        ous = [ou for ou in self.get_nodes(ou_ids)]
         ous.sort(key=lambda x: x['path'].count(','), reverse=True)
         return [unicode(ou['_id']) for ou in ous]
 
@@ -685,7 +920,8 @@ class ChefTask(Task):
             job_ids = node.attributes.get_dotted(attr)
         else:
             job_ids = []
-        job_storage = JobStorage(self.db.jobs, user)
+        # The jobs of the computer are inserted together (see object_action_computer)
+        job_storage = getattr(job_buffers, 'buffer', None) or JobStorage(self.db.jobs, user)
         job_status = 'processing'
         computer_name = computer['name']
         if is_user_policy(policy.get('path', '')) and 'user' in computer:
@@ -744,20 +980,25 @@ class ChefTask(Task):
         if obj['type'] in RESOURCES_RECEPTOR_TYPES:  # ou, user, comp, group
             if force_update or self.is_updating_policies(obj, objold):
                 rule_type = 'policies'
-                for policy_id, action in self.get_policies(rule_type, action, obj, objold):
-                    policy = self.db.policies.find_one({"_id": ObjectId(policy_id)})
+                policies_diff = getattr(policy_diffs, 'diff', None)
+                if force_update or policies_diff is None:
+                    policies = self.get_policies(rule_type, action, obj, objold)
+                else:
+                    policies = policies_diff.policies
+                for policy_id, action in policies:
+                    policy = policy_catalogue.get(self.db, policy_id)
                     if action == DELETED_POLICY_ACTION:
                         rules, obj_ui = self.get_rules_and_object(rule_type, objold, node, policy)
                     else:
                         rules, obj_ui = self.get_rules_and_object(rule_type, obj, node, policy)
-                    node, updated_policy = self.update_node_from_rules(rules, user, computer, obj_ui, obj, action, node, policy, rule_type, parent_id, job_ids_by_computer)
+                    node, updated_policy = self.update_node_from_rules(rules, user, computer, obj_ui, obj, action, node, policy, rule_type, parent_id, job_ids_by_computer, force_update)
                     if not updated and updated_policy:
                         updated = True
             return (node, updated)
         elif obj['type'] in RESOURCES_EMITTERS_TYPES:  # printer, storage, repository
             rule_type = 'save'
             if force_update or self.is_updated_node(obj, objold):
-                policy = self.db.policies.find_one({'slug': emiter_police_slug(obj['type'])})
+                policy = policy_catalogue.get_by_slug(self.db, emiter_police_slug(obj['type']))
                 rules, obj_receptor = self.get_rules_and_object(rule_type, obj, node, policy)
                 node, updated = self.update_node_from_rules(rules, user, computer, obj, obj_receptor, action, node, policy, rule_type, job_ids_by_computer)
             return (node, updated)
@@ -767,8 +1008,7 @@ class ChefTask(Task):
         Useful method, validate the DATABASES
         '''
         try:
-            schema = cookbook['metadata']['attributes']['json_schema']['object']
-            validate(to_deep_dict(node.attributes), schema)
+            cookbook_cache.get_validator(cookbook).validate(to_deep_dict(node.attributes))
         except ValidationError as e:
             # Bugfix: Validation error "required property"
             # example:
@@ -869,82 +1109,153 @@ class ChefTask(Task):
             job['computer'] = computer
         job_storage.create(**job)
 
-    def object_action(self, user, obj, objold=None, action=None, computers=None):
+    def run_concurrently(self, func, items, concurrency=None):
         '''
-        This method try to get the node to make changes in it.
-        Theses changes are called actions and can be: changed, created, moved and deleted.
-        if the node is free, the method can get the node, it reserves the node and runs the action, later the node is saved and released.
+        Call func for each item using a bounded pool of threads.
+        The results are returned in the same order than the items.
+        The number of threads is limited by the chef.max_concurrent_requests setting.
         '''
-        api = get_chef_api(self.app.conf, user)
-        cookbook = get_cookbook(api, self.app.conf.get('chef.cookbook_name'))
-        computers = computers or self.get_related_computers(obj)
-        # MacroJob
+        items = list(items)
+        if concurrency is None:
+            concurrency = int(self.app.conf.get('chef.max_concurrent_requests', 1) or 1)
+        concurrency = min(concurrency, len(items))
+        if concurrency <= 1:
+            return [func(item) for item in items]
+
+        # The worker threads have not got the pyramid registry
+        registry = get_current_registry()
+
+        def func_with_registry(item):
+            threadlocal_manager.push({'registry': registry, 'request': None})
+            try:
+                return func(item)
+            finally:
+                threadlocal_manager.pop()
+
+        chunksize = int(math.ceil(float(len(items)) / (concurrency * 4)))
+        pool = ThreadPool(concurrency)
+        try:
+            return pool.map(func_with_registry, items, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    def object_action_computer(self, user, obj, objold, action, computer, api, cookbook, macrojob_id, policies_diff=None, node_cache=None):
+        '''
+        Reserve the chef node of a computer, run the action on it and free the node.
+        Returns the ids of the jobs created for this computer and if there are new jobs.
+        '''
+        job_ids_by_computer = []
         job_ids_by_order = []
-        name = "%s %s" % (obj['type'], action)
-        self.log("debug","obj_type_translate {0}".format(obj['type']))
-        self.log("debug","action_translate {0}".format(action))
-        name_es = self._(action) + " " + self._(obj['type'])
-        macrojob_storage = JobStorage(self.db.jobs, user)
-        macrojob_id = macrojob_storage.create(obj=obj,
-                                    op=action,
-                                    computer=None,
-                                    status='processing',
-                                    policy={'name':name,'name_es':name_es},
-                                    administrator_username=user['username'])
-        invalidate_jobs(self.request, user)
         are_new_jobs = False
-        for computer in computers:
+        job_buffers.buffer = JobStorage(self.db.jobs, user).buffer()
+        policy_diffs.diff = policies_diff
+        node_caches.cache = node_cache
+        try:
+            node_chef_id = computer.get('node_chef_id', None)
+            node = reserve_node_or_raise(node_chef_id, api, 'gcc-tasks-%s-%s' % (obj['_id'], random.random()), 10)
+            if not node.get(self.app.conf.get('chef.cookbook_name')):
+                raise NodeNotLinked("Node %s is not linked" % node_chef_id)
+            if node_cache is not None:
+                # Every node of the updated_by attributes is read with one query
+                node_cache.load(get_updated_by_ids(node.normal.to_dict()))
+            error_last_saved = computer.get('error_last_saved', False)
+            error_last_chef_client = computer.get('error_last_chef_client', False)
+            force_update = error_last_saved or error_last_chef_client
             try:
-                job_ids_by_computer = []
-                node_chef_id = computer.get('node_chef_id', None)
-                node = reserve_node_or_raise(node_chef_id, api, 'gcc-tasks-%s-%s' % (obj['_id'], random.random()), 10)
-                if not node.get(self.app.conf.get('chef.cookbook_name')):
-                    raise NodeNotLinked("Node %s is not linked" % node_chef_id)
-                error_last_saved = computer.get('error_last_saved', False)
-                error_last_chef_client = computer.get('error_last_chef_client', False)
-                force_update = error_last_saved or error_last_chef_client
                 node, updated = self.update_node(user, computer, obj, objold, node, action, macrojob_id, job_ids_by_computer, force_update)
-                if job_ids_by_computer:
-                    job_ids_by_order += job_ids_by_computer
-                if not updated:
-                    save_node_and_free(node)
-                    continue
-                are_new_jobs = True
-                self.validate_data(node, cookbook, api)
+            finally:
+                # The jobs must exist before saving the node or reporting its errors
+                job_buffers.buffer.flush()
+            job_ids_by_order = job_ids_by_computer
+            if not updated:
                 save_node_and_free(node)
-                if error_last_saved:
-                    self.db.nodes.update({'_id': computer['_id']},
-                                         {'$set': {'error_last_saved': False}})
-            except NodeNotLinked as e:
-                self.report_node_not_linked(computer, user, obj, action)
-                are_new_jobs = True
-                save_node_and_free(node, api, refresh=True)
-            except NodeBusyException as e:
-                self.report_node_busy(computer, user, obj, action)
-                are_new_jobs = True
-            except ValidationError as e:
-                if not job_ids_by_computer:
-                    self.report_unknown_error(e, user, obj, action, computer)
-                self.report_error(e, job_ids_by_computer, computer, 'Validation error: ')
+                return (job_ids_by_order, are_new_jobs)
+            are_new_jobs = True
+            self.validate_data(node, cookbook, api)
+            save_node_and_free(node)
+            if error_last_saved:
+                self.db.nodes.update({'_id': computer['_id']},
+                                     {'$set': {'error_last_saved': False}})
+        except NodeNotLinked as e:
+            self.report_node_not_linked(computer, user, obj, action)
+            are_new_jobs = True
+            save_node_and_free(node, api, refresh=True)
+        except NodeBusyException as e:
+            self.report_node_busy(computer, user, obj, action)
+            are_new_jobs = True
+        except ValidationError as e:
+            if not job_ids_by_computer:
+                self.report_unknown_error(e, user, obj, action, computer)
+            self.report_error(e, job_ids_by_computer, computer, 'Validation error: ')
+            save_node_and_free(node, api, refresh=True)
+            are_new_jobs = True
+        except Exception as e:
+            if not job_ids_by_computer:
+                self.report_unknown_error(e, user, obj, action, computer)
+            self.report_error(e, job_ids_by_computer, computer)
+            try:
                 save_node_and_free(node, api, refresh=True)
-                are_new_jobs = True
-            except Exception as e:
-                if not job_ids_by_computer:
-                    self.report_unknown_error(e, user, obj, action, computer)
-                self.report_error(e, job_ids_by_computer, computer)
-                try:
-                    save_node_and_free(node, api, refresh=True)
-                except:
-                    pass
-                are_new_jobs = True
-        job_status = 'processing' if job_ids_by_order else 'finished'
-        self.db.jobs.update({'_id': macrojob_id},
-                            {'$set': {'status': job_status,
-                                      'childs':  len(job_ids_by_order),
-                                      'counter': len(job_ids_by_order),
-                                      'message': self._("Pending: %d") % len(job_ids_by_order)}})
-        if are_new_jobs:
-            invalidate_jobs(self.request, user)
+            except:
+                pass
+            are_new_jobs = True
+        finally:
+            job_buffers.buffer = None
+            policy_diffs.diff = None
+            node_caches.cache = None
+        return (job_ids_by_order, are_new_jobs)
+
+    def object_action(self, user, obj, objold=None, action=None, computers=None, macrojob_id=None):
+        '''
+        This method try to get the node to make changes in it.
+        Theses changes are called actions and can be: changed, created, moved and deleted.
+        if the node is free, the method can get the node, it reserves the node and runs the action, later the node is saved and released.
+        The computers are processed concurrently (see chef.max_concurrent_requests setting).
+        With a macrojob_id the jobs are added to that macrojob, which is updated by the caller,
+        and the ids of the jobs are returned.
+        '''
+        # The websocket messages of the computers are coalesced
+        with publisher.batch():
+            api = get_chef_api(self.app.conf, user)
+            cookbook = cookbook_cache.get(self.db, api, self.app.conf.get('chef.cookbook_name'), get_cookbook)
+            computers = computers or self.get_related_computers(obj)
+            # MacroJob
+            job_ids_by_order = []
+            name = "%s %s" % (obj['type'], action)
+            self.log("debug","obj_type_translate {0}".format(obj['type']))
+            self.log("debug","action_translate {0}".format(action))
+            name_es = self._(action) + " " + self._(obj['type'])
+            own_macrojob = macrojob_id is None
+            if own_macrojob:
+                macrojob_storage = JobStorage(self.db.jobs, user)
+                macrojob_id = macrojob_storage.create(obj=obj,
+                                            op=action,
+                                            computer=None,
+                                            status='processing',
+                                            policy={'name':name,'name_es':name_es},
+                                            administrator_username=user['username'])
+                invalidate_jobs(self.request, user)
+            # The changes of the policies are the same for all the computers
+            policies_diff = PolicyDiff(obj, objold, action)
+            node_cache = NodeCache(self.db.nodes)
+
+            def action_computer(computer):
+                return self.object_action_computer(user, obj, objold, action, computer, api, cookbook, macrojob_id, policies_diff, node_cache)
+
+            are_new_jobs = False
+            for job_ids_by_computer, are_new_jobs_by_computer in self.run_concurrently(action_computer, computers):
+                job_ids_by_order += job_ids_by_computer
+                are_new_jobs = are_new_jobs or are_new_jobs_by_computer
+            if not own_macrojob:
+                return job_ids_by_order
+            job_status = 'processing' if job_ids_by_order else 'finished'
+            self.db.jobs.update({'_id': macrojob_id},
+                                {'$set': {'status': job_status,
+                                          'childs':  len(job_ids_by_order),
+                                          'counter': len(job_ids_by_order),
+                                          'message': self._("Pending: %d") % len(job_ids_by_order)}})
+            if are_new_jobs:
+                invalidate_jobs(self.request, user)
 
     def object_created(self, user, objnew, computers=None):
         self.object_action(user, objnew, action='created', computers=computers)
@@ -953,13 +1264,13 @@ class ChefTask(Task):
         self.object_action(user, objnew, objold, action, computers=computers)
 
     def object_deleted(self, user, obj, computers=None):
-        obj_without_policies = deepcopy(obj)
+        obj_without_policies = copy(obj)
         obj_without_policies['policies'] = {}
         object_changed = getattr(self, '%s_changed' % obj['type'])
         object_changed(user, obj_without_policies, obj, action='deleted', computers=computers)
 
     def object_detached(self, user, obj, computers=None):
-        obj_without_policies = deepcopy(obj)
+        obj_without_policies = copy(obj)
         obj_without_policies['policies'] = {}
         object_changed = getattr(self, '%s_changed' % obj['type'])
         object_changed(user, obj_without_policies, obj, action='detached', computers=computers)
@@ -970,7 +1281,9 @@ class ChefTask(Task):
             func = globals()['apply_policies_to_%s' % objnew['type']]
         except KeyError:
             raise NotImplementedError
-        func(self.db.nodes, objnew, user, api, initialize=True, use_celery=False, policies_collection=self.db.policies)
+        # The policies are applied to the whole subtree, the websocket messages are coalesced
+        with publisher.batch():
+            func(self.db.nodes, objnew, user, api, initialize=True, use_celery=False, policies_collection=self.db.policies)
 
     def object_emiter_deleted(self, user, obj, computers=None):
         name = "%s deleted" % obj['type']
@@ -986,11 +1299,19 @@ class ChefTask(Task):
                                     message="Pending: 0",
                                     administrator_username=user['username'])
         invalidate_jobs(self.request, user)
-        
+        self.remove_emitter_from_related_objects(user, obj)
+
+    def remove_emitter_from_related_objects(self, user, obj, excluded_ids=None):
+        '''
+        Remove a deleted emitter object from the policies of the nodes that are related to it,
+        but the nodes in excluded_ids, and update their computers
+        '''
         obj_id = unicode(obj['_id'])
         policy_id = unicode(get_policy_emiter_id(self.db, obj))
         object_related_list = get_object_related_list(self.db, obj)
         for obj_related in object_related_list:
+            if excluded_ids and obj_related['_id'] in excluded_ids:
+                continue
             obj_old_related = deepcopy(obj_related)
             object_related_list = obj_related['policies'][policy_id]['object_related_list']
             if obj_id in object_related_list:
@@ -1108,30 +1429,140 @@ class ChefTask(Task):
         self.log_action('moved', 'OU', objnew)
 
     def ou_deleted(self, user, obj, computers=None, direct_deleted=True):
-        ou_path = '%s,%s' % (obj['path'], unicode(obj['_id']))
-        types_to_remove = ('computer', 'user', 'group', 'printer', 'storage', 'repository', 'ou')
-        for node_type in types_to_remove:
-            nodes_by_type = self.db.nodes.find({'path': ou_path,
-                                                'type': node_type})
-            for node in nodes_by_type:
-                node_deleted_function = getattr(self, '%s_deleted' % node_type)
-                node_deleted_function(user, node, computers=computers, direct_deleted=False)
-        self.db.nodes.remove({'path': ou_path})
+        '''
+        Delete the whole subtree of an OU: the chef nodes and clients of its computers
+        are deleted concurrently, the computers outside the subtree related to the deleted
+        users, groups and OUs are updated, the references of the nodes outside the subtree
+        are removed with a few multi updates and the computers are reported in one macrojob
+        '''
+        subtree = list(self.db.nodes.find({'ancestors': get_filter_nodes_belonging_ou(obj['_id'])}))
+        subtree_ids = set([node['_id'] for node in subtree])
+        nodes_by_type = defaultdict(list)
+        for node in subtree:
+            nodes_by_type[node['type']].append(node)
+
+        # The emitters are removed from the policies of the nodes that are not deleted
+        for node_type in RESOURCES_EMITTERS_TYPES:
+            for node in nodes_by_type[node_type]:
+                self.remove_emitter_from_related_objects(user, node, excluded_ids=subtree_ids)
+
         name = "%s deleted" % obj['type']
         name_es = self._("deleted") + " " + self._(obj['type'])
         macrojob_storage = JobStorage(self.db.jobs, user)
         macrojob_id = macrojob_storage.create(obj=obj,
                                     op='deleted',
                                     computer=None,
-                                    status='finished',
+                                    status='processing',
                                     policy={'name':name,'name_es':name_es},
                                     childs=0,
                                     counter=0,
                                     message="Pending: 0",
                                     administrator_username=user['username'])
         invalidate_jobs(self.request, user)
+
+        # The policies of the deleted nodes are removed from the computers outside the subtree
+        policy_job_ids = []
+        for node, external_computers in self.get_external_related_computers(obj, nodes_by_type, subtree_ids):
+            node_without_policies = copy(node)
+            node_without_policies['policies'] = {}
+            policy_job_ids += self.object_action(user, node_without_policies, node, 'deleted',
+                                                 computers=external_computers, macrojob_id=macrojob_id)
+
+        api = get_chef_api(self.app.conf, user)
+
+        def delete_chef_node(computer):
+            try:
+                node = Node(computer['node_chef_id'], api)
+                node.delete()
+                client = Client(computer['node_chef_id'], api=api)
+                client.delete()
+            except Exception as e:
+                return unicode(e)
+            return None
+
+        computers = [computer for computer in nodes_by_type['computer'] if computer.get('node_chef_id', None)]
+        errors = self.run_concurrently(delete_chef_node, computers)
+        job_buffer = JobStorage(self.db.jobs, user).buffer()
+        for computer, error in zip(computers, errors):
+            job_buffer.create(obj=obj,
+                              op='deleted',
+                              status='errors' if error else 'finished',
+                              computer=computer,
+                              policy={'name': name, 'name_es': name_es},
+                              parent=macrojob_id,
+                              message='No deleted in chef server. %s' % error if error else '',
+                              administrator_username=user['username'])
+        job_buffer.flush()
+
+        self.remove_references(subtree_ids,
+                               [node['_id'] for node in nodes_by_type['computer']],
+                               [node['_id'] for node in nodes_by_type['group']])
+        self.db.nodes.remove({'ancestors': get_filter_nodes_belonging_ou(obj['_id'])})
+
+        if any(errors):
+            status = 'errors'
+        else:
+            status = 'processing' if policy_job_ids else 'finished'
+        self.db.jobs.update({'_id': macrojob_id},
+                            {'$set': {'status': status,
+                                      'childs': len(computers) + len(policy_job_ids),
+                                      'counter': len(policy_job_ids),
+                                      'message': self._("Pending: %d") % len(policy_job_ids),
+                                      'last_update': datetime.datetime.utcnow()}})
+        invalidate_jobs(self.request, user)
         self.log_action('deleted', 'OU', obj)
 
+    def get_external_related_computers(self, obj, nodes_by_type, subtree_ids):
+        '''
+        Get the computers outside the subtree of a deleted OU that are related to the deleted
+        users, groups and OUs (through the users of the OUs), as (node, computers) pairs
+        '''
+        external_by_node = []
+        external_by_ou = defaultdict(list)
+        ou_ids = set([unicode(obj['_id'])] + [unicode(ou['_id']) for ou in nodes_by_type['ou']])
+        for node in nodes_by_type['user']:
+            if all(computer_id in subtree_ids for computer_id in node.get('computers', [])):
+                continue
+            external_computers = [computer for computer in self.get_related_computers(node)
+                                  if computer['_id'] not in subtree_ids]
+            if not external_computers:
+                continue
+            external_by_node.append((node, external_computers))
+            for ancestor_id in node.get('ancestors', []):
+                if ancestor_id in ou_ids:
+                    external_by_ou[ancestor_id] += external_computers
+        for node in nodes_by_type['group']:
+            if not node.get('members'):
+                continue
+            external_computers = [computer for computer in self.get_related_computers(node)
+                                  if computer['_id'] not in subtree_ids]
+            if external_computers:
+                external_by_node.append((node, external_computers))
+        for node in [obj] + nodes_by_type['ou']:
+            external_computers = external_by_ou.get(unicode(node['_id']))
+            if external_computers:
+                external_by_node.append((node, external_computers))
+        return external_by_node
+
+    def remove_references(self, node_ids, computer_ids, group_ids, chunk_size=1000):
+        '''
+        Remove the references to deleted nodes from the groups (members), the users (computers)
+        and the members of deleted groups (memberof), with one multi update by chunk of ids
+        '''
+        node_ids = list(node_ids)
+        for i in range(0, len(node_ids), chunk_size):
+            chunk = node_ids[i:i + chunk_size]
+            self.db.nodes.update({'type': 'group', 'members': {'$in': chunk}},
+                                 {'$pull': {'members': {'$in': chunk}}}, multi=True)
+        for i in range(0, len(computer_ids), chunk_size):
+            chunk = computer_ids[i:i + chunk_size]
+            self.db.nodes.update({'type': 'user', 'computers': {'$in': chunk}},
+                                 {'$pull': {'computers': {'$in': chunk}}}, multi=True)
+        for i in range(0, len(group_ids), chunk_size):
+            chunk = group_ids[i:i + chunk_size]
+            self.db.nodes.update({'memberof': {'$in': chunk}},
+                                 {'$pull': {'memberof': {'$in': chunk}}}, multi=True)
+
     def printer_created(self, user, objnew, computers=None):
         self.object_created(user, objnew, computers=computers)
         self.log_action('created', 'Printer', objnew)
@@ -1327,6 +1758,48 @@ ssl_verify_mode          :verify_none
             status = 'finished'
             msg = self._("Cookbook uploaded successfully %s %s") % (obj['name'], obj['version'])
      
+    cookbook_cache.invalidate(self.db)
     self.db.jobs.update({'_id':ObjectId(macrojob_id)},{'$set':{'status':status, 'message':msg}})
 
     invalidate_jobs(self.request, user)   
+
+
+@task(base=ChefTask)
+def ad_import(user, domain_id, filename, is_ad_master, system_type, macrojob_id):
+    '''
+    Import an Active Directory XML dump saved by the ad_import API.
+    The progress and the result are written in the macrojob.
+    '''
+    self = ad_import
+    from gecoscc.api.ad_import import ADImporter
+
+    def report_progress(report, status='processing', message=None):
+        progress = dict([(key, report[key]) for key in ('parsed', 'inserted', 'updated', 'chef_registered')])
+        update = {'status': status,
+                  'progress': progress,
+                  'last_update': datetime.datetime.utcnow()}
+        if message is not None:
+            update['message'] = message
+        self.db.jobs.update({'_id': macrojob_id}, {'$set': update})
+        invalidate_jobs(self.request, user)
+
+    # The progress messages of the import are coalesced
+    with publisher.batch():
+        importer = ADImporter(self.db, user, self.app.conf, report_progress=report_progress)
+        try:
+            with open(filename, 'rb') as dumpfile:
+                report = importer.run(dumpfile, domain_id, is_ad_master, system_type)
+            message = self._('%(inserted)s inserted, %(updated)s updated of %(total)s objects imported successfully.') % report
+            warnings = [warning for warnings in report['warnings'].values() for warning in warnings]
+            if warnings:
+                message = '%s %s' % (message, ' '.join(warnings))
+            report_progress(report, status=warnings and 'warnings' or 'finished', message=message)
+        except Exception as e:
+            self.log('error', 'ad_import ::: {0}'.format(e))
+            self.db.jobs.update({'_id': macrojob_id},
+                                {'$set': {'status': 'errors',
+                                          'message': unicode(e),
+                                          'last_update': datetime.datetime.utcnow()}})
+            invalidate_jobs(self.request, user)
+        finally:
+            os.remove(filename)
@@ -11,23 +11,33 @@
 #
 
 import json
+import re
+import time
 import unittest
 import sys
 
+import colander
+import gevent
 import mock
 
 from copy import copy, deepcopy
+from gzip import GzipFile
+from StringIO import StringIO
 
 from bson import ObjectId
 from celery import current_app
 from chef.node import NodeAttributes
 from cornice.errors import Errors
 from paste.deploy import loadapp
-from pymongo import Connection
+from pymongo import Connection, ASCENDING, DESCENDING
 from pyramid import testing
+from pyramid.threadlocal import get_current_registry
 from pyramid.httpexceptions import HTTPForbidden
 
 from api.chef_status import USERS_OHAI
+from gecoscc.api import encode_cursor, decode_cursor, get_cursor_filter
+from gecoscc.api.ad_import import ADImporter
+from gecoscc.api.gpoconversors import GPOConversor, GPOChanges, get_sid_guid
 from gecoscc.api.organisationalunits import OrganisationalUnitResource
 from gecoscc.api.chef_status import ChefStatusResource
 from gecoscc.api.computers import ComputerResource
@@ -40,11 +50,20 @@ from gecoscc.api.register_computer import RegisterComputerResource
 from gecoscc.commands.import_policies import Command as ImportPoliciesCommand
 from gecoscc.commands.create_software_profiles import Command as ImportSoftwareProfilesCommand
 from gecoscc.commands.recalc_nodes_policies import Command as RecalcNodePoliciesCommand
+from gecoscc.cache import CookbookCache, PolicyCatalogue
 from gecoscc.db import get_db
+from gecoscc.eventsmanager import JOBS_STATISTICS_CACHE, JobStorage, archive_jobs, get_jobs_statistics
+from gecoscc.locks import LocalNodeLock, get_node_lock
+from gecoscc.models import Job
 from gecoscc.userdb import get_userdb
 from gecoscc.permissions import LoggedFactory, SuperUserFactory
+from gecoscc.socks import GecosNamespace, PubSubHub, Publisher, get_manager
+from gecoscc.tasks import NodeCache, PolicyDiff, get_updated_by_ids, object_deleted
+from gecoscc.utils import (apply_policies_to_ou, dict_merge, dict_merge_shared, get_computer_of_user,
+                           move_ou_children, set_node_ancestors)
 from gecoscc.views.portal import home
 from gecoscc.views.admins import admin_add
+from gecoscc.views.reports import CSVRenderer, iter_csv
 
 # This url is not used, every time the code should use it, the code is patched
 # and the code use de NodeMock class
@@ -79,6 +98,32 @@ def isinstance_mock(instance, klass):
     return isinstance(instance, klass)
 
 
+def get_related_computers_recursive(collection_nodes, obj, related_computers, related_objects):
+    '''
+    The related computers resolved one node at a time, as they were resolved
+    before the batched queries of ChefTask.resolve_related_computers
+    '''
+    if obj['_id'] in related_objects:
+        return related_computers
+    related_objects.add(obj['_id'])
+    if obj['type'] == 'computer':
+        related_computers.append(obj)
+    elif obj['type'] == 'user':
+        get_computer_of_user(collection_nodes, obj, related_computers)
+    elif obj['type'] == 'group':
+        for node_id in obj['members']:
+            node = collection_nodes.find_one({'_id': node_id})
+            if node:
+                get_related_computers_recursive(collection_nodes, node, related_computers, related_objects)
+    elif obj['type'] == 'ou':
+        for node_type in ('computer', 'user', 'group'):
+            nodes = collection_nodes.find({'path': {'$regex': '.*,%s.*' % obj['_id']},
+                                           'type': node_type})
+            for node in nodes:
+                get_related_computers_recursive(collection_nodes, node, related_computers, related_objects)
+    return related_computers
+
+
 NODES = {}
 
 
@@ -1003,6 +1048,67 @@ class BasicTests(BaseGecosTestCase):
         self.assertNoErrorJobs()
 
 
+    def test_09_chef_status_update_jobs(self):
+        '''
+        Test 9: Check the jobs and the macrojobs updated by a chef client report
+        '''
+        db = self.get_db()
+        request = self.get_dummy_request()
+        ou = db.nodes.find_one({'name': 'OU 1'})
+        job_storage = JobStorage(db.jobs, request.user)
+        policy = {'name': 'Policy', 'name_es': 'Politica'}
+
+        def create_macrojob(childs):
+            macrojob_id = job_storage.create(obj=ou, op='changed', status='processing', policy=policy,
+                                             childs=childs, counter=childs, message='Pending: %d' % childs)
+            job_ids = [job_storage.create(obj=ou, op='changed', status='processing', policy=policy,
+                                          computer={'_id': ObjectId(), 'name': 'Computer %s' % i},
+                                          parent=macrojob_id) for i in range(childs)]
+            return macrojob_id, job_ids
+
+        macrojob_finished, jobs_finished = create_macrojob(2)
+        macrojob_warnings, jobs_warnings = create_macrojob(3)
+        macrojob_errors, jobs_errors = create_macrojob(2)
+        report = {unicode(jobs_finished[0]): {'status': 0},
+                  unicode(jobs_finished[1]): {'status': 0},
+                  unicode(jobs_warnings[0]): {'status': 2, 'message': 'Package not found'},
+                  unicode(jobs_warnings[1]): {'status': 0},
+                  unicode(jobs_errors[0]): {'status': 1, 'message': 'Recipe error'},
+                  unicode(ObjectId()): {'status': 0}}
+        chef_status_api = ChefStatusResource(request)
+        self.assertTrue(chef_status_api.update_jobs(report))
+
+        # Both jobs finished in the same report, the macrojob has finished
+        macrojob = db.jobs.find_one({'_id': macrojob_finished})
+        self.assertEqual(macrojob['counter'], 0)
+        self.assertEqual(macrojob['status'], 'finished')
+        self.assertEqual(macrojob['message'], 'Pending: 0')
+        self.assertEqual(db.jobs.find({'parent': macrojob_finished, 'status': 'finished'}).count(), 2)
+
+        macrojob = db.jobs.find_one({'_id': macrojob_warnings})
+        self.assertEqual(macrojob['counter'], 2)
+        self.assertEqual(macrojob['status'], 'warnings')
+        self.assertEqual(macrojob['message'], 'Pending: 2')
+        job = db.jobs.find_one({'_id': jobs_warnings[0]})
+        self.assertEqual(job['status'], 'warnings')
+        self.assertEqual(job['message'], 'Package not found')
+        self.assertEqual(db.jobs.find_one({'_id': jobs_warnings[2]})['status'], 'processing')
+
+        macrojob = db.jobs.find_one({'_id': macrojob_errors})
+        self.assertEqual(macrojob['counter'], 2)
+        self.assertEqual(macrojob['status'], 'errors')
+        self.assertEqual(macrojob['message'], 'Pending: 2')
+        job = db.jobs.find_one({'_id': jobs_errors[0]})
+        self.assertEqual(job['status'], 'errors')
+        self.assertEqual(job['message'], 'Recipe error')
+
+        # The last job of the macrojob with warnings finishes in other report
+        self.assertFalse(chef_status_api.update_jobs({unicode(jobs_warnings[2]): {'status': 0}}))
+        macrojob = db.jobs.find_one({'_id': macrojob_warnings})
+        self.assertEqual(macrojob['counter'], 1)
+        self.assertEqual(macrojob['status'], 'warnings')
+        self.assertEqual(macrojob['message'], 'Pending: 1')
+
 class AdvancedTests(BaseGecosTestCase):
 
     @mock.patch('gecoscc.api.chef_status.Node')
@@ -3110,6 +3216,256 @@ class AdvancedTests(BaseGecosTestCase):
         self.assertNoErrorJobs()
 
 
+    def test_31_related_computers(self):
+        '''
+        Test 31: Check the related computers resolved with batched queries are the same
+        than the related computers resolved one node at a time, without duplicates
+        '''
+        db = self.get_db()
+        domain = db.nodes.find_one({'name': 'Domain 1'})
+
+        def insert_node(name, node_type, parent, **fields):
+            node = {'name': name, 'type': node_type, 'source': 'gecos',
+                    'path': '%s,%s' % (parent['path'], parent['_id'])}
+            if node_type == 'group':
+                node['members'] = []
+            elif node_type == 'user':
+                node['computers'] = []
+            node.update(fields)
+            node['_id'] = db.nodes.insert(set_node_ancestors(node))
+            return node
+
+        ou_a = insert_node('OU A', 'ou', domain)
+        ou_b = insert_node('OU B', 'ou', ou_a)
+        ou_out = insert_node('OU Out', 'ou', domain)
+        computer_a = insert_node('Computer A', 'computer', ou_a)
+        computer_b = insert_node('Computer B', 'computer', ou_b)
+        computer_out = insert_node('Computer Out', 'computer', ou_out)
+        computer_group = insert_node('Computer Group', 'computer', ou_out)
+        # The computer B is in the OU and it is a computer of the user B
+        user_b = insert_node('User B', 'user', ou_b, computers=[computer_b['_id'], computer_out['_id']])
+        user_out = insert_node('User Out', 'user', ou_out, computers=[computer_group['_id']])
+        # The computer A is in the OU and it is a member of the group
+        group = insert_node('Group', 'group', ou_b,
+                            members=[computer_a['_id'], user_out['_id'], computer_group['_id']])
+
+        def get_pairs(related_computers):
+            return sorted((computer['_id'], computer.get('user', {}).get('_id'))
+                          for computer in related_computers)
+
+        for obj in (ou_a, ou_b, ou_out, group, user_b, user_out, computer_a):
+            obj = db.nodes.find_one({'_id': obj['_id']})
+            related_computers = object_deleted.get_related_computers(obj)
+            pairs = get_pairs(related_computers)
+            self.assertEqual(len(pairs), len(set(pairs)))
+
+            expected_pairs = get_pairs(get_related_computers_recursive(db.nodes, obj, [], set()))
+            # The recursive resolution repeated a computer without user when it
+            # was reached directly after it was reached through a user
+            with_user = set(computer_id for computer_id, user_id in expected_pairs if user_id)
+            expected_pairs = [(computer_id, user_id) for computer_id, user_id in expected_pairs
+                              if user_id or computer_id not in with_user]
+            self.assertEqual(pairs, expected_pairs)
+
+        related_computers = object_deleted.get_related_computers(db.nodes.find_one({'_id': ou_a['_id']}))
+        self.assertEqual(get_pairs(related_computers),
+                         sorted([(computer_a['_id'], None),
+                                 (computer_b['_id'], user_b['_id']),
+                                 (computer_out['_id'], user_b['_id']),
+                                 (computer_group['_id'], user_out['_id'])]))
+
+    @mock.patch('gecoscc.utils.isinstance')
+    @mock.patch('chef.Node')
+    @mock.patch('gecoscc.utils.ChefNode')
+    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.utils.get_cookbook')
+    def test_32_concurrent_computers(self, get_cookbook_method, get_cookbook_method_tasks,
+                                     NodeClass, ChefNodeClass, isinstance_method):
+        '''
+        Test 32: Check a policy of an OU applied to its computers concurrently
+        (chef.max_concurrent_requests) has the same jobs than applied serially
+        '''
+        self.apply_mocks(get_cookbook_method, get_cookbook_method_tasks, NodeClass, ChefNodeClass, isinstance_method)
+
+        # 1 - Register several workstations
+        db = self.get_db()
+        for i in range(6):
+            self.register_computer(chef_node_id='%s%02d' % (CHEF_NODE_ID[:-2], i))
+        chef_nodes = deepcopy(NODES)
+        ou_1 = db.nodes.find_one({'name': 'OU 1'})
+        policy = self.get_default_ws_policy()
+        policy_path = policy['path'] + '.package_list'
+        shutdown_policy = self.get_default_ws_policy(slug='remote_shutdown_res')
+        ou_1['policies'] = {unicode(policy['_id']): {'package_list': ['gimp'], 'pkgs_to_remove': []},
+                            unicode(shutdown_policy['_id']): {'shutdown_mode': 'halt'}}
+        node_lock = get_node_lock(get_current_registry().settings)
+
+        def add_policy_to_ou(concurrency):
+            NODES.clear()
+            NODES.update(deepcopy(chef_nodes))
+            db.nodes.update({'_id': ou_1['_id']}, {'$set': {'policies': {}}})
+            db.jobs.remove()
+            max_concurrent_requests = current_app.conf.get('chef.max_concurrent_requests')
+            current_app.conf['chef.max_concurrent_requests'] = concurrency
+            try:
+                request_put = self.get_dummy_json_put_request(ou_1, OrganisationalUnitResource.schema_detail)
+                OrganisationalUnitResource(request_put).put()
+            finally:
+                current_app.conf['chef.max_concurrent_requests'] = max_concurrent_requests
+            macrojobs = list(db.jobs.find({'parent': None}))
+            self.assertEqual(len(macrojobs), 1)
+            jobs_by_computer = {}
+            for job in db.jobs.find({'parent': macrojobs[0]['_id']}).sort('_id', ASCENDING):
+                jobs_by_computer.setdefault(job['computername'], []).append((job['policyname'], job['status']))
+            policies = dict((chef_node_id, NodeMock(chef_node_id, None).attributes.get_dotted(policy_path))
+                            for chef_node_id in chef_nodes)
+            return macrojobs[0], jobs_by_computer, policies
+
+        # 2 - Add policy in OU, the computers are updated one by one
+        macrojob_serial, jobs_serial, policies_serial = add_policy_to_ou(1)
+        self.assertEqual(len(jobs_serial), 6)
+        self.assertEqual(set(len(computer_jobs) for computer_jobs in jobs_serial.values()), set([2]))
+        self.assertEqual(node_lock.locks, {})
+
+        # 3 - Add policy in OU, the computers are updated four at a time
+        macrojob, jobs, policies = add_policy_to_ou(4)
+        self.assertEqual(jobs, jobs_serial)
+        for field in ('status', 'childs', 'counter', 'message'):
+            self.assertEqual(macrojob[field], macrojob_serial[field])
+        self.assertEqual(macrojob['counter'], sum(len(computer_jobs) for computer_jobs in jobs.values()))
+        self.assertEqual(policies, policies_serial)
+        self.assertEqual(set(map(tuple, policies.values())), set([('gimp',)]))
+        self.assertEqual(node_lock.locks, {})
+
+    def get_ad_dump(self):
+        '''
+        Useful method, returns a gzipped Active Directory XML dump. The users
+        and the computers are before their OUs, and the OU Team before its parent
+        '''
+        xml = u"""<?xml version="1.0" encoding="utf-8"?>
+<Domain ObjectGUID="guid-domain" DistinguishedName="DC=example,DC=com" Name="example">
+  <Users>
+    <User ObjectGUID="guid-user-1" DistinguishedName="CN=User 1,OU=Sales,DC=example,DC=com" Name="User 1">
+      <MemberOf>
+        <Item>CN=Sales Group,OU=Sales,DC=example,DC=com</Item>
+        <Item>CN=Other Group,OU=Other,DC=example,DC=com</Item>
+      </MemberOf>
+    </User>
+    <User ObjectGUID="guid-user-2" DistinguishedName="CN=User 2,OU=Team,OU=Sales,DC=example,DC=com" Name="User 2"
+          PrimaryGroup="CN=Sales Group, OU=Sales, DC=example, DC=com" />
+  </Users>
+  <Computers>
+    <Computer ObjectGUID="guid-computer-1" DistinguishedName="CN=PC1,OU=Team,OU=Sales,DC=example,DC=com" Name="PC1">
+      <MemberOf>
+        <Item>CN=Sales Group,OU=Sales,DC=example,DC=com</Item>
+      </MemberOf>
+    </Computer>
+  </Computers>
+  <Groups>
+    <Group ObjectGUID="guid-group-1" DistinguishedName="CN=Sales Group,OU=Sales,DC=example,DC=com" Name="Sales Group" />
+    <Group ObjectGUID="guid-group-2" DistinguishedName="CN=Other Group,OU=Other,DC=example,DC=com" Name="Other Group" />
+  </Groups>
+  <OrganizationalUnits>
+    <OrganizationalUnit ObjectGUID="guid-ou-2" DistinguishedName="OU=Team,OU=Sales,DC=example,DC=com" Name="Team" />
+    <OrganizationalUnit ObjectGUID="guid-ou-1" DistinguishedName="OU=Sales,DC=example,DC=com" Name="Sales" />
+    <OrganizationalUnit ObjectGUID="guid-ou-3" DistinguishedName="OU=Other,DC=example,DC=com" Name="Other" />
+  </OrganizationalUnits>
+</Domain>"""
+        dumpfile = StringIO()
+        gzipfile = GzipFile(fileobj=dumpfile, mode='wb')
+        gzipfile.write(xml.encode('utf-8'))
+        gzipfile.close()
+        dumpfile.seek(0)
+        return dumpfile
+
+    @mock.patch('gecoscc.api.ad_import.Client')
+    @mock.patch('gecoscc.utils.isinstance')
+    @mock.patch('gecoscc.utils.ChefNode')
+    @mock.patch('gecoscc.tasks.get_cookbook')
+    @mock.patch('gecoscc.utils.get_cookbook')
+    def test_33_ad_import(self, get_cookbook_method, get_cookbook_method_tasks, ChefNodeClass,
+                          isinstance_method, ClientClass):
+        '''
+        Test 33: Check an Active Directory dump is imported by chunks,
+        with the paths and the groups of its objects
+        '''
+        self.apply_mocks(get_cookbook_method, get_cookbook_method_tasks, isinstance_method=isinstance_method)
+        run_lists = {}
+
+        def chef_node(chef_node_id, api):
+            node = NodeMock(chef_node_id, api)
+            node.run_list = run_lists.setdefault(chef_node_id, [])
+            return node
+        ChefNodeClass.side_effect = chef_node
+
+        db = self.get_db()
+        domain = db.nodes.find_one({'name': 'Domain 1'})
+        request = self.get_dummy_request()
+        importer = ADImporter(db, request.user, get_current_registry().settings)
+        importer.chunk_size = 2
+
+        # 1 - The dump is read incrementally
+        ad_objects = list(importer._iterADObjects(GzipFile(fileobj=self.get_ad_dump(), mode='rb')))
+        self.assertEqual(ad_objects[0], ('Domain', {'ObjectGUID': 'guid-domain',
+                                                    'DistinguishedName': 'DC=example,DC=com',
+                                                    'Name': 'example'}))
+        self.assertEqual([obj_schema['adName'] for obj_schema, ad_values in ad_objects[1:]],
+                         ['User', 'User', 'Computer', 'Group', 'Group',
+                          'OrganizationalUnit', 'OrganizationalUnit', 'OrganizationalUnit'])
+        self.assertEqual(ad_objects[1][1]['MemberOf'], ['CN=Sales Group,OU=Sales,DC=example,DC=com',
+                                                        'CN=Other Group,OU=Other,DC=example,DC=com'])
+
+        # 2 - Import the dump
+        report = importer.run(self.get_ad_dump(), domain['_id'], True)
+        self.assertEqual((report['parsed'], report['inserted'], report['updated'], report['total']), (8, 8, 1, 9))
+        self.assertEqual(report['chef_registered'], 1)
+        self.assertEqual(len(report['warnings']['group']), 1)
+
+        def get_node(name):
+            return db.nodes.find_one({'name': name, 'ancestors': unicode(domain['_id'])})
+
+        # 3 - Check the paths
+        domain_path = '%s,%s' % (domain['path'], domain['_id'])
+        sales = get_node('Sales')
+        team = get_node('Team')
+        other = get_node('Other')
+        self.assertEqual(sales['path'], domain_path)
+        self.assertEqual(other['path'], domain_path)
+        self.assertEqual(team['path'], '%s,%s' % (domain_path, sales['_id']))
+        self.assertEqual(team['ancestors'], team['path'].split(','))
+        sales_group = get_node('Sales Group')
+        other_group = get_node('Other Group')
+        user_1 = get_node('User 1')
+        user_2 = get_node('User 2')
+        computer = get_node('PC1')
+        self.assertEqual(sales_group['path'], sales['path'] + ',' + unicode(sales['_id']))
+        self.assertEqual(user_1['path'], sales_group['path'])
+        self.assertEqual(user_2['path'], team['path'] + ',' + unicode(team['_id']))
+        self.assertEqual(computer['path'], user_2['path'])
+
+        # 4 - Check the groups, the group of other OU is not visible by the user 1
+        self.assertEqual(user_1['memberof'], [sales_group['_id']])
+        self.assertEqual(user_2['memberof'], [sales_group['_id']])
+        self.assertEqual(computer['memberof'], [sales_group['_id']])
+        self.assertEqual(sorted(sales_group['members']), sorted([user_1['_id'], user_2['_id'], computer['_id']]))
+        self.assertEqual(other_group['members'], [])
+        self.assertEqual(db.nodes.find({'$or': [{'adMemberOf': {'$exists': True}},
+                                                {'adPrimaryGroup': {'$exists': True}}]}).count(), 0)
+
+        # 5 - Check the chef node of the computer
+        self.assertEqual(computer['node_chef_id'], 'PC1')
+        self.assertEqual(run_lists['PC1'], [ADImporter.RECIPE_NAME_OHAI_GECOS, ADImporter.RECIPE_NAME_GECOS_WS_MGMT])
+
+        # 6 - Import the dump again, the objects are updated
+        report = importer.run(self.get_ad_dump(), domain['_id'], True)
+        self.assertEqual((report['parsed'], report['inserted'], report['updated'], report['total']), (8, 0, 9, 9))
+        self.assertEqual(db.nodes.find({'ancestors': unicode(domain['_id']),
+                                        'adObjectGUID': {'$exists': True}}).count(), 8)
+        self.assertEqual(get_node('Team')['path'], team['path'])
+        self.assertEqual(get_node('User 1')['memberof'], [sales_group['_id']])
+        self.assertEqual(sorted(get_node('Sales Group')['members']),
+                         sorted([user_1['_id'], user_2['_id'], computer['_id']]))
+
 class MovementsTests(BaseGecosTestCase):
 
     @mock.patch('gecoscc.api.chef_status.Node')
@@ -3676,3 +4032,581 @@ class MovementsTests(BaseGecosTestCase):
         self.assertItemsEqual(node_package_policy, [u'kate', u'sublime'])
 
         self.assertNoErrorJobs()
+
+
+class UtilsTests(unittest.TestCase):
+
+    def test_01_local_node_lock(self):
+        '''
+        Test 1: Check the local node lock backend
+        '''
+        node_lock = LocalNodeLock(3600)
+        # 1 - The first controller reserves the node, and it can reserve it again
+        token = node_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-1')
+        self.assertIsNotNone(token)
+        token_again = node_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-1')
+        self.assertGreater(token_again, token)
+
+        # 2 - Other controller can not reserve the node
+        self.assertIsNone(node_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-2'))
+
+        # 3 - A stale token does not free the node
+        node_lock.release(CHEF_NODE_ID, 'gcc-tasks-1', token)
+        self.assertIsNone(node_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-2'))
+
+        # 4 - The owner frees the node, then other controller reserves it
+        node_lock.release(CHEF_NODE_ID, 'gcc-tasks-1', token_again)
+        self.assertGreater(node_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-2'), token_again)
+
+        # 5 - An expired reservation does not block the node
+        expired_lock = LocalNodeLock(0)
+        self.assertIsNotNone(expired_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-1'))
+        self.assertIsNotNone(expired_lock.acquire(CHEF_NODE_ID, 'gcc-tasks-2'))
+
+    def test_02_set_node_ancestors(self):
+        '''
+        Test 2: Check the ancestors and depth fields of the nodes
+        '''
+        flag = set_node_ancestors({'path': 'root'})
+        self.assertEqual(flag['ancestors'], ['root'])
+        self.assertEqual(flag['depth'], 1)
+
+        node = set_node_ancestors({'path': 'root,5a1e,5a2e'})
+        self.assertEqual(node['ancestors'], ['root', '5a1e', '5a2e'])
+        self.assertEqual(node['depth'], 3)
+
+        self.assertEqual(set_node_ancestors({'path': None})['depth'], 0)
+
+    def test_03_cursor_pagination_filter(self):
+        '''
+        Test 3: Check the cursor of the keyset pagination
+        '''
+        last_id = ObjectId()
+        values = [None, u'Computer 1', last_id]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+        order_fields = [('node_order', DESCENDING),
+                        ('name', ASCENDING),
+                        ('_id', ASCENDING)]
+        # There are not nodes with a lower node_order than null
+        self.assertEqual(get_cursor_filter(order_fields, values),
+                         {'$or': [{'node_order': None, 'name': {'$gt': u'Computer 1'}},
+                                  {'node_order': None, 'name': u'Computer 1', '_id': {'$gt': last_id}}]})
+        self.assertEqual(get_cursor_filter(order_fields, [2, None, last_id]),
+                         {'$or': [{'node_order': {'$lt': 2}},
+                                  {'node_order': 2, 'name': {'$ne': None}},
+                                  {'node_order': 2, 'name': None, '_id': {'$gt': last_id}}]})
+
+    def test_04_websocket_publisher_batch(self):
+        '''
+        Test 4: Check the websocket messages are coalesced inside a batch
+        '''
+        testing.setUp(settings={'sockjs_url': 'memory://utils-tests',
+                                'sockjs_flush_window': 3600})
+        try:
+            manager = get_manager()
+            publisher = Publisher()
+            with publisher.batch():
+                for i in range(3):
+                    publisher.publish(('update_tree', 'root'), {'action': 'update_tree', 'path': 'root'})
+                with publisher.batch():
+                    publisher.publish(('jobs', 'test'), {'action': 'jobs', 'username': 'test'})
+                # Nothing is published until the outer batch finishes
+                self.assertEqual(manager.published, [])
+            self.assertEqual(len(manager.published), 2)
+
+            # Out of a batch the messages are published at once
+            publisher.publish(('jobs', 'test'), {'action': 'jobs', 'username': 'test'})
+            self.assertEqual(len(manager.published), 3)
+        finally:
+            testing.tearDown()
+
+    def test_05_websocket_namespace_filter(self):
+        '''
+        Test 5: Check the websocket messages sent to each administrator
+        '''
+        request = testing.DummyRequest(user={'username': 'test',
+                                             'is_superuser': False,
+                                             'ou_managed': ['5a1e']})
+        namespace = GecosNamespace({'socketio': mock.Mock()}, '', request=request)
+        namespace.initialize()
+        self.assertTrue(namespace.is_interested({'action': 'jobs', 'username': 'test'}))
+        self.assertFalse(namespace.is_interested({'action': 'jobs', 'username': 'other'}))
+        self.assertTrue(namespace.is_interested({'action': 'update_tree', 'path': 'root,5a1e,5a2e'}))
+        self.assertFalse(namespace.is_interested({'action': 'update_tree', 'path': 'root,5a3e'}))
+        self.assertTrue(namespace.is_interested({'action': 'change', 'objectId': '5a4e'}))
+
+    def test_06_job_storage_create_many(self):
+        '''
+        Test 6: Check the jobs are built in memory and inserted together
+        '''
+        testing.setUp(settings={'pyramid.locales': ['en', 'es'],
+                                'pyramid.default_locale_name': 'en'})
+        try:
+            collection = mock.MagicMock()
+            job_storage = JobStorage(collection, {'_id': ObjectId()})
+            obj = {'_id': ObjectId(), 'name': 'OU 1', 'path': 'root', 'type': 'ou'}
+            policy = {'name': 'Policy', 'name_es': 'Politica'}
+            job_ids = job_storage.create_many([{'obj': obj, 'op': 'changed', 'status': 'processing',
+                                                'computer': {'_id': ObjectId(), 'name': 'Computer %s' % i},
+                                                'policy': policy} for i in range(3)])
+            self.assertEqual(collection.insert.call_count, 1)
+            jobs = collection.insert.call_args[0][0]
+            self.assertEqual([job['_id'] for job in jobs], job_ids)
+            self.assertEqual([job['computername'] for job in jobs], ['Computer 0', 'Computer 1', 'Computer 2'])
+            self.assertEqual(jobs[0]['policyname_es'], 'Politica')
+        finally:
+            testing.tearDown()
+
+    def test_07_ad_import_duplicate_names(self):
+        '''
+        Test 7: Check the names registry of the AD import
+        '''
+        db = mock.MagicMock()
+        db.nodes.find.return_value = [{'name': 'User', 'type': 'user'},
+                                      {'name': 'User_2', 'type': 'user'},
+                                      {'name': 'Group', 'type': 'group'}]
+        ad_import = ADImporter(db, None, {})
+        names = ad_import._getNamesRegistry({'_id': ObjectId()})
+        self.assertEqual(db.nodes.find.call_count, 1)
+        new_names = []
+        for name, node_type in (('User', 'user'), ('User_1', 'user'), ('Other', 'user'),
+                                ('Other', 'user'), ('Group', 'ou')):
+            obj = {'name': name}
+            ad_import._fixDuplicateName(names, node_type, obj)
+            new_names.append(obj['name'])
+        self.assertEqual(new_names, ['User_3', 'User_4', 'Other', 'Other_1', 'Group'])
+
+    def test_08_ad_import_progress(self):
+        '''
+        Test 8: Check the progress of the AD import is reported at most every progress_interval seconds
+        '''
+        report_progress = mock.Mock()
+        ad_import = ADImporter(mock.MagicMock(), None, {}, report_progress=report_progress)
+        report = {'parsed': 10}
+        ad_import._progress(report)
+        ad_import._progress(report)
+        self.assertEqual(report_progress.call_count, 1)
+        ad_import._progress(report, force=True)
+        self.assertEqual(report_progress.call_count, 2)
+        report_progress.assert_called_with(report)
+
+    def test_09_gpo_sid_guid(self):
+        '''
+        Test 9: Check the SID-GUID table of the GPO import is indexed by SID
+        '''
+        sid_guid = get_sid_guid({'items': {'item': [{'@sid': 'S-1-5-21-1', '@guid': 'guid-1'},
+                                                    {'@sid': 'S-1-5-21-2', '@guid': 'guid-2'}]}})
+        self.assertEqual(sid_guid, {'S-1-5-21-1': 'guid-1', 'S-1-5-21-2': 'guid-2'})
+        sid_guid = get_sid_guid({'items': {'item': {'@sid': 'S-1-5-21-1', '@guid': 'guid-1'}}})
+        self.assertEqual(sid_guid, {'S-1-5-21-1': 'guid-1'})
+        self.assertEqual(get_sid_guid({'items': None}), {})
+
+    @mock.patch('gecoscc.api.gpoconversors.object_changed')
+    def test_10_gpo_changes(self, object_changed_method):
+        '''
+        Test 10: Check the nodes changed by several GPO conversors are saved once
+        '''
+        domain_id = ObjectId()
+        node = {'_id': ObjectId(), 'adObjectGUID': 'guid-1', 'type': 'user',
+                'path': 'root,%s,%s' % (ObjectId(), domain_id), 'policies': {}}
+        request = testing.DummyRequest()
+        request.db = mock.MagicMock()
+        request.db.nodes.find.return_value = [node]
+        request.db.nodes.find_one.return_value = {'_id': domain_id, 'master_policies': {}}
+        request.user = {'username': 'test'}
+        changes = GPOChanges(request)
+        for policy_id in ('policy_1', 'policy_2'):
+            gpoconversor = GPOConversor(request)
+            gpoconversor.convert = lambda xmlgpo, policy_id=policy_id: [{'policies': [{policy_id: {'value': 1}}],
+                                                                         'guids': ['guid-1']}]
+            self.assertTrue(gpoconversor.apply({}, changes))
+        changes.save()
+        self.assertEqual(request.db.nodes.find.call_count, 1)
+        self.assertEqual(request.db.nodes.find_one.call_count, 1)
+        self.assertEqual(request.db.nodes.initialize_unordered_bulk_op.return_value.execute.call_count, 1)
+        self.assertEqual(object_changed_method.delay.call_count, 1)
+        new_node, old_node = object_changed_method.delay.call_args[0][2:]
+        self.assertEqual(sorted(new_node['policies'].keys()), ['policy_1', 'policy_2'])
+        self.assertEqual(old_node['policies'], {})
+
+    def test_11_csv_report_stream(self):
+        '''
+        Test 11: Check the CSV reports are streamed in chunks
+        '''
+        rows = ((i, 'name %s' % i) for i in range(5))
+        chunks = list(iter_csv(('Id', 'Name'), rows, chunk_rows=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks).splitlines(), ['Id,Name'] + ['%s,name %s' % (i, i) for i in range(5)])
+
+        request = testing.DummyRequest()
+        renderer = CSVRenderer(None)
+        result = renderer({'header': ('Id',), 'rows': iter([(1,), (2,)])}, {'request': request})
+        self.assertEqual(result, None)
+        self.assertEqual(request.response.content_type, 'text/csv')
+        self.assertEqual(''.join(request.response.app_iter).splitlines(), ['Id', '1', '2'])
+        self.assertEqual(renderer({'header': ('Id',), 'rows': [(1,)]}, {}).splitlines(), ['Id', '1'])
+
+    def test_12_jobs_statistics(self):
+        '''
+        Test 12: Check the jobs statistics are calculated with one aggregation and cached cache_seconds seconds
+        '''
+        JOBS_STATISTICS_CACHE.clear()
+        collection = mock.MagicMock()
+        collection.aggregate.return_value = {'ok': 1.0,
+                                             'result': [{'_id': 'finished', 'count': 3},
+                                                        {'_id': 'errors', 'count': 1}]}
+        with mock.patch('gecoscc.eventsmanager.time.time', return_value=1000):
+            statistics = get_jobs_statistics(collection, 'admin', 24, cache_seconds=60)
+        self.assertEqual(statistics['finished'], 3)
+        self.assertEqual(statistics['errors'], 1)
+        self.assertEqual(statistics['processing'], 0)
+        self.assertEqual(statistics['total'], 4)
+        pipeline = collection.aggregate.call_args[0][0]
+        self.assertEqual(pipeline[0]['$match']['administrator_username'], 'admin')
+        self.assertTrue('created' in pipeline[0]['$match'])
+
+        # The jobs are not read while the statistics have not expired
+        with mock.patch('gecoscc.eventsmanager.time.time', return_value=1059):
+            get_jobs_statistics(collection, 'admin', 24, cache_seconds=60)
+        self.assertEqual(collection.aggregate.call_count, 1)
+        with mock.patch('gecoscc.eventsmanager.time.time', return_value=1060):
+            get_jobs_statistics(collection, 'admin', 24, cache_seconds=60)
+        self.assertEqual(collection.aggregate.call_count, 2)
+
+        # Without cache the jobs are always read
+        get_jobs_statistics(collection, 'admin', 24)
+        self.assertEqual(collection.aggregate.call_count, 3)
+
+        # The writes of the jobs do not touch the cache
+        job_storage = JobStorage(collection, {'_id': ObjectId()})
+        with mock.patch.object(job_storage, 'build_job', return_value={}):
+            job_storage.create(obj={})
+            job_storage.create_many([{'obj': {}}])
+        self.assertEqual(collection.database.__getitem__.call_count, 0)
+
+    def test_13_archive_jobs(self):
+        '''
+        Test 13: Check the old jobs are moved to the jobs archive in batches
+        '''
+        db = mock.MagicMock()
+        jobs = [{'_id': ObjectId()} for i in range(3)]
+        db.jobs.find.return_value.limit.side_effect = [jobs[:2], jobs[2:], []]
+        self.assertEqual(archive_jobs(db, 90, 7, batch_size=2), 3)
+        self.assertEqual(db['jobs_archive'].insert.call_count, 2)
+        self.assertTrue(all('archived_at' in job for job in jobs))
+        removed = [call[0][0]['_id']['$in'] for call in db.jobs.remove.call_args_list]
+        self.assertEqual(removed, [[job['_id'] for job in jobs[:2]], [jobs[2]['_id']]])
+
+    def test_14_policy_catalogue(self):
+        '''
+        Test 14: Check the policies are read once and reloaded when their version changes
+        '''
+        policy = {'_id': ObjectId(), 'slug': 'printer_can_view', 'is_emitter_policy': True}
+        db = mock.MagicMock()
+        db.name = 'gecoscc'
+        db['cache_versions'].find_one.return_value = {'_id': 'policies', 'version': ObjectId()}
+        db.policies.find.return_value = [policy]
+        catalogue = PolicyCatalogue(check_interval=3600)
+        self.assertEqual(catalogue.get(db, unicode(policy['_id'])), policy)
+        self.assertEqual(catalogue.get(db, policy['_id']), policy)
+        self.assertEqual(catalogue.get_by_slug(db, 'printer_can_view'), policy)
+        self.assertEqual(catalogue.get_emitter_policies(db), [policy])
+        self.assertEqual(catalogue.get_by_slug(db, 'unknown'), None)
+        self.assertEqual(db.policies.find.call_count, 1)
+
+        catalogue.check_interval = 0
+        catalogue.get(db, policy['_id'])
+        self.assertEqual(db.policies.find.call_count, 1)
+        db['cache_versions'].find_one.return_value = {'_id': 'policies', 'version': ObjectId()}
+        catalogue.get(db, policy['_id'])
+        self.assertEqual(db.policies.find.call_count, 2)
+
+        catalogue.invalidate(db)
+        self.assertEqual(db['cache_versions'].update.call_count, 1)
+        catalogue.get(db, policy['_id'])
+        self.assertEqual(db.policies.find.call_count, 3)
+
+    def test_15_cookbook_cache(self):
+        '''
+        Test 15: Check the cookbook is downloaded once and its validator compiled once by version
+        '''
+        db = mock.MagicMock()
+        db.name = 'gecoscc'
+        db['cache_versions'].find_one.return_value = {'_id': 'cookbook', 'version': ObjectId()}
+        get_cookbook_method = mock.MagicMock(side_effect=get_cookbook_mock)
+        cache = CookbookCache(check_interval=3600)
+        cookbook = cache.get(db, None, 'gecos_ws_mgmt', get_cookbook_method)
+        self.assertEqual(cache.get(db, None, 'gecos_ws_mgmt', get_cookbook_method), cookbook)
+        self.assertEqual(get_cookbook_method.call_count, 1)
+
+        validator = cache.get_validator(cookbook)
+        self.assertTrue(cache.get_validator(cookbook) is validator)
+        self.assertFalse(validator.is_valid({}))
+        self.assertFalse(validator.is_valid({'gecos_ws_mgmt': []}))
+
+        cache.invalidate(db)
+        new_cookbook = cache.get(db, None, 'gecos_ws_mgmt', get_cookbook_method)
+        self.assertEqual(get_cookbook_method.call_count, 2)
+        self.assertTrue(cache.get_validator(new_cookbook) is validator)
+        new_cookbook['version'] = '0.4.0'
+        self.assertFalse(cache.get_validator(new_cookbook) is validator)
+
+    def test_16_policy_diff(self):
+        '''
+        Test 16: Check the policies and the fields that change in a task
+        '''
+        policy_id = unicode(ObjectId())
+        objold = {'type': 'ou',
+                  'policies': {'a': {'x': 1, 'y': 2},
+                               'b': {'x': 1},
+                               'c': {'x': 1}}}
+        obj = deepcopy(objold)
+        obj['policies']['a']['y'] = 3
+        obj['policies']['d'] = {'x': 1}
+        del obj['policies']['c']
+        policies_diff = PolicyDiff(obj, objold, 'changed')
+        self.assertEqual(sorted(policies_diff.policies), [('a', 'changed'), ('c', 'deleted'), ('d', 'changed')])
+        self.assertTrue(policies_diff.is_unchanged({'_id': 'a'}, 'x', 'changed'))
+        self.assertFalse(policies_diff.is_unchanged({'_id': 'a'}, 'y', 'changed'))
+        self.assertFalse(policies_diff.is_unchanged({'_id': 'a', 'is_mergeable': True}, 'x', 'changed'))
+        self.assertFalse(policies_diff.is_unchanged({'_id': 'd'}, 'x', 'changed'))
+
+        # Without the old object every policy is applied
+        policies_diff = PolicyDiff(obj, {}, 'changed')
+        self.assertEqual(sorted(policies_diff.policies), [('a', 'changed'), ('b', 'changed'), ('d', 'changed')])
+
+        # The patches are calculated once and copied for every computer
+        func = mock.MagicMock(return_value=[{'name': policy_id}])
+        patch = policies_diff.get_patch('key', func, 1)
+        patch[0]['name'] = 'modified'
+        self.assertEqual(policies_diff.get_patch('key', func, 1), [{'name': policy_id}])
+        self.assertEqual(func.call_count, 1)
+
+    def test_17_node_cache(self):
+        '''
+        Test 17: Check the nodes of the updated_by attributes are read with one query
+        '''
+        ou_id, group_id, computer_id = [unicode(ObjectId()) for i in range(3)]
+        attributes = {'gecos_ws_mgmt': {
+            'misc_mgmt': {'tz_date_res': {'updated_by': {'ou': [ou_id], 'computer': computer_id}}},
+            'users_mgmt': {'user_apps_autostart_res': {'users': {'user': {'updated_by': {'group': [group_id]}}}}}}}
+        self.assertEqual(get_updated_by_ids(attributes), set([ou_id, group_id, computer_id]))
+
+        collection = mock.MagicMock()
+        collection.find.return_value = [{'_id': ObjectId(ou_id), 'path': 'root'},
+                                        {'_id': ObjectId(group_id), 'path': 'root'}]
+        node_cache = NodeCache(collection)
+        node_cache.load(get_updated_by_ids(attributes))
+        self.assertEqual(node_cache.get(ou_id)['path'], 'root')
+        self.assertEqual(node_cache.get(computer_id), None)
+        self.assertEqual(len(node_cache.get_list([ou_id, group_id, computer_id])), 2)
+        node_cache.get(ou_id)['path'] = 'modified'
+        self.assertEqual(node_cache.get(ou_id)['path'], 'root')
+        self.assertEqual(collection.find.call_count, 1)
+
+    def test_18_dict_merge(self):
+        '''
+        Test 18: Check dict_merge copies the result and dict_merge_shared only the merged dicts
+        '''
+        a = {'gecos_ws_mgmt': {'misc_mgmt': {'tz_date_res': {'server': 'a'}},
+                               'network_mgmt': {'forticlientvpn_res': {'connections': []}}},
+             'cpu': {'total': 1}}
+        b = {'gecos_ws_mgmt': {'misc_mgmt': {'tz_date_res': {'server': 'b'}}},
+             'uptime': '1 day'}
+        a_original = deepcopy(a)
+        b_original = deepcopy(b)
+        merged = dict_merge(a, b)
+        self.assertEqual(merged, {'gecos_ws_mgmt': {'misc_mgmt': {'tz_date_res': {'server': 'b'}},
+                                                    'network_mgmt': {'forticlientvpn_res': {'connections': []}}},
+                                  'cpu': {'total': 1},
+                                  'uptime': '1 day'})
+        self.assertEqual(dict_merge_shared(a, b), merged)
+        self.assertEqual(a, a_original)
+        self.assertEqual(b, b_original)
+
+        self.assertFalse(merged['cpu'] is a['cpu'])
+        shared = dict_merge_shared(a, b)
+        self.assertTrue(shared['cpu'] is a['cpu'])
+        self.assertTrue(shared['gecos_ws_mgmt']['network_mgmt'] is a['gecos_ws_mgmt']['network_mgmt'])
+        self.assertFalse(shared['gecos_ws_mgmt'] is a['gecos_ws_mgmt'])
+        self.assertEqual(dict_merge(a, 'value'), 'value')
+
+    def test_19_move_ou_children(self):
+        '''
+        Test 19: Check the children of a moved OU are updated with bulk writes
+        '''
+        ou_id = ObjectId()
+        old_path = 'root,%s,%s' % (ObjectId(), ou_id)
+        new_path = 'root,%s,%s' % (ObjectId(), ou_id)
+        child_ou_id = ObjectId()
+        children = [{'_id': child_ou_id, 'path': old_path},
+                    {'_id': ObjectId(), 'path': old_path},
+                    {'_id': ObjectId(), 'path': '%s,%s' % (old_path, child_ou_id)}]
+        collection = mock.MagicMock()
+        collection.find.return_value = children
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        self.assertEqual(move_ou_children(collection, ou_id, old_path, new_path, batch_size=2), 3)
+        self.assertEqual(bulk.execute.call_count, 2)
+
+        query = collection.find.call_args[0][0]
+        self.assertEqual(query['ancestors'], unicode(ou_id))
+        self.assertTrue(re.match(query['path']['$regex'], '%s,%s' % (old_path, child_ou_id)))
+        self.assertFalse(re.match(query['path']['$regex'], '%s0' % old_path))
+        self.assertEqual(bulk.find.call_args_list[2][0][0], children[2])
+        update = bulk.find.return_value.update_one.call_args_list[2][0][0]['$set']
+        self.assertEqual(update['path'], '%s,%s' % (new_path, child_ou_id))
+        self.assertEqual(update['depth'], 4)
+
+        markers = collection.database['ou_moves']
+        markers.update.assert_called_once_with({'_id': ou_id}, {'$set': {'moved': 2}})
+        markers.remove.assert_called_once_with({'_id': ou_id})
+
+    def test_20_remove_references(self):
+        '''
+        Test 20: Check the references to the nodes of a deleted OU are removed with multi updates
+        '''
+        computer_ids = [ObjectId() for i in range(3)]
+        group_ids = [ObjectId()]
+        node_ids = computer_ids + group_ids + [ObjectId()]
+        db = mock.MagicMock()
+        with mock.patch.object(object_deleted, '_db', db, create=True):
+            object_deleted.remove_references(node_ids, computer_ids, group_ids, chunk_size=2)
+        calls = db.nodes.update.call_args_list
+        self.assertEqual(len(calls), 3 + 2 + 1)
+        self.assertEqual(calls[0], mock.call({'type': 'group', 'members': {'$in': node_ids[:2]}},
+                                             {'$pull': {'members': {'$in': node_ids[:2]}}}, multi=True))
+        self.assertEqual(calls[3], mock.call({'type': 'user', 'computers': {'$in': computer_ids[:2]}},
+                                             {'$pull': {'computers': {'$in': computer_ids[:2]}}}, multi=True))
+        self.assertEqual(calls[5], mock.call({'memberof': {'$in': group_ids}},
+                                             {'$pull': {'memberof': {'$in': group_ids}}}, multi=True))
+
+    def test_21_import_job_op(self):
+        '''
+        Test 21: Check the macrojobs of the Active Directory imports are valid jobs
+        '''
+        op = Job()['op']
+        self.assertEqual(op.deserialize('import'), 'import')
+        self.assertRaises(colander.Invalid, op.deserialize, 'imported')
+
+    def test_22_websocket_local_pubsub(self):
+        '''
+        Test 22: Check the websocket messages are delivered with the in memory redis (sockjs_url = memory://)
+        '''
+        testing.setUp(settings={'sockjs_url': 'memory://pubsub-tests'})
+        try:
+            namespace = mock.Mock()
+            namespace.is_interested.side_effect = lambda data: data.get('username') == 'test'
+            hub = PubSubHub()
+            hub.register(namespace)
+            gevent.sleep(0)
+            publisher = Publisher()
+            publisher.publish(('jobs', 'other'), {'action': 'jobs', 'username': 'other'})
+            publisher.publish(('jobs', 'test'), {'action': 'jobs', 'username': 'test'})
+            gevent.sleep(0)
+            namespace.emit.assert_called_once_with('message', {'action': 'jobs', 'username': 'test'})
+
+            hub.listener.kill()
+            self.assertIsNone(hub.listener)
+            self.assertEqual(get_manager().subscriptions, set())
+        finally:
+            testing.tearDown()
+
+    def test_23_websocket_publisher_flush_window(self):
+        '''
+        Test 23: Check the pending websocket messages of a batch are published when the flush window expires
+        '''
+        testing.setUp(settings={'sockjs_url': 'memory://utils-tests-window',
+                                'sockjs_flush_window': 0.05})
+        try:
+            manager = get_manager()
+            publisher = Publisher()
+            with publisher.batch():
+                publisher.publish(('jobs', 'test'), {'action': 'jobs', 'username': 'test'})
+                publisher.publish(('jobs', 'test'), {'action': 'jobs', 'username': 'test'})
+                self.assertEqual(manager.published, [])
+                # The last message of the burst is not held until the batch finishes
+                for _i in range(50):
+                    if manager.published:
+                        break
+                    time.sleep(0.05)
+                self.assertEqual(len(manager.published), 1)
+                publisher.publish(('update_tree', 'root'), {'action': 'update_tree', 'path': 'root'})
+            self.assertEqual(len(manager.published), 2)
+        finally:
+            testing.tearDown()
+
+    def test_24_external_related_computers(self):
+        '''
+        Test 24: Check the computers outside a deleted OU related to its users, groups and OUs are found
+        '''
+        ou = {'_id': ObjectId(), 'type': 'ou'}
+        child_ou = {'_id': ObjectId(), 'type': 'ou'}
+        inside = {'_id': ObjectId(), 'type': 'computer'}
+        outside = {'_id': ObjectId(), 'type': 'computer'}
+        user = {'_id': ObjectId(), 'type': 'user', 'computers': [inside['_id'], outside['_id']],
+                'ancestors': ['root', unicode(ou['_id']), unicode(child_ou['_id'])]}
+        user_inside = {'_id': ObjectId(), 'type': 'user', 'computers': [inside['_id']],
+                       'ancestors': ['root', unicode(ou['_id'])]}
+        group = {'_id': ObjectId(), 'type': 'group', 'members': [outside['_id']]}
+        empty_group = {'_id': ObjectId(), 'type': 'group', 'members': []}
+        nodes_by_type = {'ou': [child_ou], 'user': [user, user_inside],
+                         'group': [group, empty_group], 'computer': [inside]}
+        subtree_ids = set([child_ou['_id'], inside['_id'], user['_id'], user_inside['_id'],
+                           group['_id'], empty_group['_id']])
+        related_computers = {user['_id']: [dict(inside, user=user), dict(outside, user=user)],
+                             group['_id']: [outside]}
+        with mock.patch.object(object_deleted, 'get_related_computers',
+                               side_effect=lambda node: related_computers[node['_id']]) as get_related_computers:
+            external = object_deleted.get_external_related_computers(ou, nodes_by_type, subtree_ids)
+        # The users with computers only in the subtree and the empty groups are not resolved
+        self.assertEqual(get_related_computers.call_count, 2)
+        self.assertEqual([(node['_id'], [computer['_id'] for computer in computers]) for node, computers in external],
+                         [(user['_id'], [outside['_id']]),
+                          (group['_id'], [outside['_id']]),
+                          (ou['_id'], [outside['_id']]),
+                          (child_ou['_id'], [outside['_id']])])
+        self.assertEqual(external[2][1][0]['user'], user)
+
+    def test_25_apply_policies_to_moved_ou(self):
+        '''
+        Test 25: Check the computers of a moved OU are updated once with every OU and group with policies
+        '''
+        parent = {'_id': ObjectId(), 'type': 'ou', 'path': 'root', 'policies': {'policy': {}}}
+        ou = {'_id': ObjectId(), 'type': 'ou', 'path': 'root,%s' % parent['_id'], 'policies': {}}
+        ou_path = '%s,%s' % (ou['path'], ou['_id'])
+        child_ou = {'_id': ObjectId(), 'type': 'ou', 'path': ou_path, 'policies': {'policy': {}}}
+        group = {'_id': ObjectId(), 'type': 'group', 'policies': {'policy': {}}}
+        computer = {'_id': ObjectId(), 'type': 'computer', 'path': ou_path, 'memberof': [group['_id']],
+                    'ancestors': ou_path.split(',')}
+        outside = {'_id': ObjectId(), 'type': 'computer', 'path': 'root', 'memberof': []}
+        user_path = '%s,%s' % (ou_path, child_ou['_id'])
+        user = {'_id': ObjectId(), 'type': 'user', 'name': 'user', 'path': user_path, 'memberof': [],
+                'computers': [computer['_id'], outside['_id']], 'ancestors': user_path.split(',')}
+
+        def find(query, *args):
+            if 'ancestors' in query:
+                return [child_ou, computer, user]
+            ids = query['_id']['$in']
+            return [node for node in (parent, computer, outside, group) if node['_id'] in ids]
+
+        collection = mock.MagicMock()
+        collection.find.side_effect = find
+        with mock.patch('gecoscc.utils.visibility_group', side_effect=lambda db, obj: obj), \
+                mock.patch('gecoscc.utils.visibility_object_related', side_effect=lambda db, obj: obj), \
+                mock.patch('gecoscc.tasks.object_changed') as object_changed, \
+                mock.patch('gecoscc.tasks.object_created') as object_created, \
+                mock.patch('gecoscc.tasks.object_moved') as object_moved:
+            apply_policies_to_ou(collection, ou, {'username': 'test'}, use_celery=False)
+
+        self.assertFalse(object_moved.called)
+        changed = dict([(call[0][2]['_id'], [(target['_id'], target.get('user', {}).get('_id'))
+                                               for target in call[1]['computers']])
+                        for call in object_changed.call_args_list])
+        # The OU without policies is not applied, the others once with all their computers
+        self.assertEqual(changed, {parent['_id']: [(computer['_id'], None), (computer['_id'], user['_id']),
+                                                   (outside['_id'], user['_id'])],
+                                   child_ou['_id']: [(computer['_id'], user['_id']), (outside['_id'], user['_id'])],
+                                   group['_id']: [(computer['_id'], None)]})
+        created = [(call[0][1], call[0][2]['_id'], len(call[1]['computers'])) for call in object_created.call_args_list]
+        self.assertEqual(created, [('computer', computer['_id'], 1), ('user', user['_id'], 2)])
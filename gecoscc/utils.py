@@ -32,12 +32,17 @@ from pyramid.threadlocal import get_current_registry
 
 from collections import defaultdict
 
+from gecoscc.cache import policy_catalogue
+from gecoscc.locks import get_node_lock, is_use_node_mirrored
+
 RESOURCES_RECEPTOR_TYPES = ('computer', 'ou', 'user', 'group')
 RESOURCES_EMITTERS_TYPES = ('printer', 'storage', 'repository')
 POLICY_EMITTER_SUBFIX = '_can_view'
 USER_MGMT = 'users_mgmt'
 SOURCE_DEFAULT = MASTER_DEFAULT = 'gecos'
 USE_NODE = 'use_node'
+# Markers of the OUs whose children are being moved (see move_ou_children)
+OU_MOVES_COLLECTION = 'ou_moves'
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +50,7 @@ def get_policy_emiter_id(collection, obj):
     '''
     Get the id from a emitter policy
     '''
-    return collection.policies.find_one({'slug': emiter_police_slug(obj['type'])})['_id']
+    return policy_catalogue.get_by_slug(collection, emiter_police_slug(obj['type']))['_id']
 
 
 def get_object_related_list(collection, obj):
@@ -109,34 +114,106 @@ def get_filter_ous_from_path(path):
     return {'_id': {'$in': ou_ids}}
 
 
+def get_path_ancestors(path):
+    '''
+    Returns the ancestors of a node from its path ("root,<id>,<id>...")
+    '''
+    if not path:
+        return []
+    return path.split(',')
+
+
+def set_node_ancestors(node):
+    '''
+    Sets the ancestors and depth fields of a node from its path.
+    These fields are indexed, so the tree is queried without path regexes
+    '''
+    ancestors = get_path_ancestors(node.get('path'))
+    node['ancestors'] = ancestors
+    node['depth'] = len(ancestors)
+    return node
+
+
 def get_filter_nodes_parents_ou(db, ou_id, item_id):
-    item = db.nodes.find_one({'_id': ObjectId(item_id)})
+    item = db.nodes.find_one({'_id': ObjectId(item_id)}, {'type': 1, 'path': 1})
     if item['type'] == 'ou':
         ou = item
         ou_id = ou['_id']
     else:
-        ou = db.nodes.find_one({'_id': ObjectId(ou_id)})
-    ou_path = ou['path']
-    filters = {'$regex': '%s,%s$' % (ou_path, ou_id)}
-    path_split = ou_path.split(',')
-    for path_step in path_split:
-        filters['$regex'] += '|%s$' % path_step
-    return filters
+        ou = db.nodes.find_one({'_id': ObjectId(ou_id)}, {'path': 1})
+    path_split = get_path_ancestors('%s,%s' % (ou['path'], ou_id))
+    return {'$in': [','.join(path_split[:i]) for i in range(1, len(path_split) + 1)]}
 
 
 def get_filter_nodes_belonging_ou(ou_id):
-    if ou_id == 'root':
-        return {'$regex': '%s.*' % ou_id}
-    return {'$regex': '.*,%s.*' % ou_id}
+    '''
+    Value of the ancestors field of the nodes under an OU (at any level)
+    '''
+    return unicode(ou_id)
 
 
-def get_filter_children_ou(ou_id, next_level=True):
+def start_ou_move(collection_nodes, ou_id, old_path, new_path, username):
+    '''
+    Saves the marker of an OU move before moving the OU. old_path and new_path
+    are the paths of the children of the OU. The marker is removed by
+    move_ou_children and the resume_ou_moves command finishes the moves that
+    still have it.
+    '''
+    collection_nodes.database[OU_MOVES_COLLECTION].update({'_id': ou_id}, {
+        '$set': {'old_path': old_path,
+                 'new_path': new_path,
+                 'username': username,
+                 'moved': 0,
+                 'started_at': datetime.datetime.utcnow()}
+    }, upsert=True)
+
+
+def move_ou_children(collection_nodes, ou_id, old_path, new_path, batch_size=1000):
+    '''
+    Rewrites the path, ancestors and depth of the nodes under a moved OU.
+    The nodes are updated with bulk writes of batch_size nodes and only while
+    they have the old path, so a move can be run again after an interruption.
+    The progress is saved in the marker of the move, that is removed at the end.
+    Returns the number of moved nodes.
+    '''
+    markers = collection_nodes.database[OU_MOVES_COLLECTION]
+    children = collection_nodes.find({
+        'ancestors': get_filter_nodes_belonging_ou(ou_id),
+        'path': {'$regex': '^%s(,|$)' % re.escape(old_path)}
+    }, {'path': 1})
+    moved = 0
+    bulk = None
+    pending = 0
+    for child in children:
+        if bulk is None:
+            bulk = collection_nodes.initialize_unordered_bulk_op()
+        new_child_path = new_path + child['path'][len(old_path):]
+        bulk.find({'_id': child['_id'], 'path': child['path']}).update_one({
+            '$set': set_node_ancestors({'path': new_child_path})
+        })
+        pending += 1
+        if pending == batch_size:
+            bulk.execute()
+            moved += pending
+            bulk = None
+            pending = 0
+            markers.update({'_id': ou_id}, {'$set': {'moved': moved}})
+    if bulk is not None:
+        bulk.execute()
+        moved += pending
+    markers.remove({'_id': ou_id})
+    return moved
+
+
+def get_filter_children_ou(ou_id, next_level=True, collection_nodes=None):
     if ou_id == 'root':
-        return ou_id
-    regex = '.*,%s' % ou_id
+        return {'path': ou_id}
     if next_level:
-        regex = '%s$' % regex
-    return {'$regex': regex}
+        ou = collection_nodes.find_one({'_id': ObjectId(ou_id)}, {'path': 1})
+        if not ou:
+            return {'path': 'no-root'}
+        return {'path': '%s,%s' % (ou['path'], ou_id)}
+    return {'ancestors': get_filter_nodes_belonging_ou(ou_id)}
 
 
 def get_items_ou_children(ou_id, collection_nodes, objtype=None, filters=None, next_level=True):
@@ -144,7 +221,8 @@ def get_items_ou_children(ou_id, collection_nodes, objtype=None, filters=None, n
     if objtype:
         filters['type'] = objtype
     if ou_id:
-        filters['path'] = get_filter_children_ou(ou_id, next_level=next_level)
+        filters.update(get_filter_children_ou(ou_id, next_level=next_level,
+                                              collection_nodes=collection_nodes))
     else:
         filters['path'] = 'no-root'
     ous = collection_nodes.find(filters).sort('name')
@@ -297,17 +375,40 @@ def reserve_node_or_raise(node_id, api, controller_requestor='gcc', attempts=1):
 
 def is_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc', attempts=1):
     is_busy = True
+    settings = get_current_registry().settings
     for attempt in range(attempts):
         node, is_busy = _is_node_busy_and_reserve_it(node_id, api, controller_requestor)
-        if not is_busy:
+        if not is_busy or attempt == attempts - 1:
             break
-        settings = get_current_registry().settings
         seconds_sleep_is_busy = settings.get('chef.seconds_sleep_is_busy')
         time.sleep(int(seconds_sleep_is_busy))
     return (node, is_busy)
 
 
 def _is_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc'):
+    '''
+    Check if the node is busy, else reserve it with the lock backend (see chef.lock_backend setting).
+    '''
+    settings = get_current_registry().settings
+    node_lock = get_node_lock(settings)
+    if node_lock is None:
+        return _is_chef_node_busy_and_reserve_it(node_id, api, controller_requestor)
+
+    token = node_lock.acquire(node_id, controller_requestor)
+    node = ChefNode(node_id, api)
+    if token is None:
+        return (node, True)
+    node.gecoscc_lock = (controller_requestor, token)
+    if is_use_node_mirrored(settings):
+        seconds_block_is_busy = int(settings.get('chef.seconds_block_is_busy'))
+        exp_date = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds_block_is_busy)
+        node.attributes.set_dotted(USE_NODE, {'control': controller_requestor,
+                                              'exp_date': json.dumps(exp_date, default=json_util.default)})
+        node.save()
+    return (node, False)
+
+
+def _is_chef_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc'):
     '''
     Check if the node is busy, else try to get it and write in control and expiration date in the field USE_NODE.
     '''
@@ -349,10 +450,27 @@ def _is_node_busy_and_reserve_it(node_id, api, controller_requestor='gcc'):
 
 
 def save_node_and_free(node, api=None, refresh=False):
+    lock = getattr(node, 'gecoscc_lock', None)
     if refresh and api:
         node = ChefNode(node.name, api)
     node.attributes.set_dotted(USE_NODE, {})
     node.save()
+    node_lock = get_node_lock(get_current_registry().settings)
+    if node_lock is not None:
+        if lock:
+            node_lock.release(node.name, *lock)
+        else:
+            node_lock.release(node.name)
+
+
+def free_node(node_id, controller_requestor):
+    '''
+    Free a node reserved by other process (e.g. by the chef client of the workstation)
+    This is not needed with the chef lock backend, the chef client frees the use_node attribute.
+    '''
+    node_lock = get_node_lock(get_current_registry().settings)
+    if node_lock is not None:
+        node_lock.release(node_id, controller_requestor)
 
 
 class NodeBusyException(Exception):
@@ -374,24 +492,40 @@ def setpath(d, p, k):
         setpath(d[p[0]], p[1:], k)
 
 def to_deep_dict(node_attr):
+    '''
+    Merge the attributes of a chef node. The result shares the branches that
+    are not merged with the node, it must not be modified (see dict_merge_shared)
+    '''
     merged = {}
     for d in reversed(node_attr.search_path):
-        merged = dict_merge(merged, d)
+        merged = dict_merge_shared(merged, d)
     return merged
 
 
 def dict_merge(a, b):
     '''recursively merges dict's. not just simple a['key'] = b['key'], if
     both a and bhave a key who's value is a dict then dict_merge is called
-    on both values and the result stored in the returned dictionary.'''
+    on both values and the result stored in the returned dictionary.
+    The result is a copy, it does not share anything with a and b.'''
+    if not isinstance(b, dict):
+        return b
+    return deepcopy(dict_merge_shared(a, b))
+
+
+def dict_merge_shared(a, b):
+    '''
+    Same result than dict_merge, but only the dicts in the path of the merged
+    keys are copied. The rest of the branches of a and b are shared with the
+    result, so the result is read only: copy a branch before modifying it.
+    '''
     if not isinstance(b, dict):
         return b
-    result = deepcopy(a)
+    result = copy(a)
     for k, v in b.iteritems():
         if k in result and isinstance(result[k], dict):
-                result[k] = dict_merge(result[k], v)
+            result[k] = dict_merge_shared(result[k], v)
         else:
-            result[k] = deepcopy(v)
+            result[k] = v
     return result
 
 
@@ -456,7 +590,7 @@ def visibility_object_related(db, obj):
     policies = obj.get('policies', None)
     if not policies:
         return obj
-    emitter_policies = db.policies.find({'is_emitter_policy': True})
+    emitter_policies = policy_catalogue.get_emitter_policies(db)
     obj_id = obj['_id']
     ou_id = obj['path'].split(',')[-1]
     have_updated = False
@@ -592,7 +726,7 @@ def apply_policies_to_emitter_object(nodes_collection, obj, auth_user, slug, api
     Checks if a emitter object is within the scope of the objects that is related and then update policies
     '''
     from gecoscc.tasks import object_changed, object_created
-    policy = policies_collection.find_one({'slug': slug})
+    policy = policy_catalogue.get_by_slug(nodes_collection.database, slug)
     policy_id = unicode(policy.get('_id'))
 
     if use_celery:
@@ -667,26 +801,83 @@ def apply_policies_to_group(nodes_collection, group, auth_user, api=None, initia
 
 def apply_policies_to_ou(nodes_collection, ou, auth_user, api=None, initialize=False, use_celery=True, policies_collection=None):
     '''
-    Checks if a group is within the scope of the objects that is related and then update policies
+    Checks if a group is within the scope of the objects that is related and then update policies.
+    The computers under the OU, and the computers of its users, are updated once with the
+    new chain of OUs: every OU and group with policies is applied to all of them at once
     '''
-    from gecoscc.tasks import object_changed, object_created, object_moved
+    from gecoscc.tasks import object_changed, object_created
     if use_celery:
         object_created = object_created.delay
         object_changed = object_changed.delay
-    children_path = ou['path'] + ',' + unicode(ou['_id'])
-    ou_children = nodes_collection.find({'path': {'$regex': '.*' + unicode(ou['_id']) + '.*'}})
+    db = nodes_collection.database
+    ou = visibility_object_related(db, ou)
 
-    visibility_object_related(nodes_collection.database, ou)
+    # The children already have their new path and ancestors (see move_ou_children)
+    ou_children = list(nodes_collection.find({'ancestors': get_filter_nodes_belonging_ou(ou['_id'])}))
 
-    if ou_children.count() == 0:
+    if not ou_children:
         return
 
+    children_by_type = defaultdict(list)
     for child in ou_children:
-        child_old = nodes_collection.find_one({'_id': child['_id']})
-        child['path'] = children_path
-        object_moved(auth_user, child['type'], child, child_old)
+        children_by_type[child['type']].append(child)
+
+    # The nodes lose the groups and related objects that are not visible from their new path
+    ous = [ou] + [visibility_object_related(db, child) for child in children_by_type['ou']]
+    computers = []
+    for computer in children_by_type['computer']:
+        computer = visibility_group(db, computer)
+        computer = visibility_object_related(db, computer)
+        if api and initialize:
+            remove_chef_computer_data(computer, api)
+        computers.append(computer)
+
+    users = [visibility_object_related(db, visibility_group(db, user)) for user in children_by_type['user']]
+    users_computer_ids = list(set([computer_id for user in users for computer_id in user.get('computers', [])]))
+    users_computers = dict([(user_computer['_id'], user_computer) for user_computer in
+                            nodes_collection.find({'_id': {'$in': users_computer_ids}, 'type': 'computer'})])
+    computers_by_user = {}
+    for user in users:
+        computers_of_user = [dict(users_computers[computer_id], user=user) for computer_id in user.get('computers', [])
+                             if computer_id in users_computers]
+        if api and initialize:
+            remove_chef_user_data(user, computers_of_user, api)
+        computers_by_user[user['_id']] = computers_of_user
+
+    # The groups and the emitter objects of the subtree update their own related computers
+    for node_type in ('group', 'printer', 'storage', 'repository'):
+        for child in children_by_type[node_type]:
+            globals()['apply_policies_to_%s' % node_type](nodes_collection, child, auth_user, api, initialize=initialize,
+                                                         use_celery=use_celery, policies_collection=policies_collection)
+
+    # (computer, node whose ancestors and groups are applied): a computer of a user receives its policies
+    targets = [(target, target) for target in computers]
+    for user in users:
+        targets += [(target, user) for target in computers_by_user[user['_id']]]
+
+    ous += list(nodes_collection.find(get_filter_ous_from_path(ou['path'])))
+    for ou_node in ous:
+        if not ou_node.get('policies', {}):
+            continue
+        ou_id = unicode(ou_node['_id'])
+        ou_computers = [target for target, node in targets if ou_id in node.get('ancestors', [])]
+        if ou_computers:
+            object_changed(auth_user, 'ou', ou_node, {}, computers=ou_computers)
+
+    subtree_ids = set([child['_id'] for child in ou_children])
+    group_ids = set([group_id for target, node in targets for group_id in node.get('memberof', [])
+                     if group_id not in subtree_ids])
+    for group in nodes_collection.find({'_id': {'$in': list(group_ids)}}):
+        if not group.get('policies', {}):
+            continue
+        group_computers = [target for target, node in targets if group['_id'] in node.get('memberof', [])]
+        object_changed(auth_user, 'group', group, {}, computers=group_computers)
 
-    object_created(auth_user, 'ou', ou)
+    for computer in computers:
+        object_created(auth_user, 'computer', computer, computers=[computer])
+    for user in users:
+        if computers_by_user[user['_id']]:
+            object_created(auth_user, 'user', user, computers=computers_by_user[user['_id']])
 
 
 def update_data_ou(nodes_collection, obj, policy, api, auth_user):
@@ -721,7 +912,7 @@ def update_data_user(nodes_collection, obj, policy, api, auth_user):
     if isinstance(policy, list):
         policy_field_name = []
         for policy_id in policy:
-            policy = nodes_collection.database.policies.find_one({'_id': ObjectId(policy_id)})
+            policy = policy_catalogue.get(nodes_collection.database, policy_id)
             policy_field_name.append(policy['path'].split('.')[2])
     else:
         policy_field_name = [policy['path'].split('.')[2]]
@@ -736,7 +927,7 @@ def update_data_computer(nodes_collection, obj, policy, api, auth_user):
         if isinstance(policy, list):
             policy_field_name = []
             for policy_id in policy:
-                policy = nodes_collection.database.policies.find_one({'_id': ObjectId(policy_id)})
+                policy = policy_catalogue.get(nodes_collection.database, policy_id)
                 policy_field_name.append(policy['path'].split('.')[:3])
         else:
             policy_field_name = [policy['path'].split('.')[:3]]
@@ -809,6 +1000,7 @@ def register_node(api, node_id, ou, collection_nodes):
                                      'source': ou.get('source', SOURCE_DEFAULT),
                                      'node_chef_id': node_id})
     del computer['_id']
+    set_node_ancestors(computer)
     if check_unique_node_name_by_type_at_domain(collection_nodes, computer):
         if collection_nodes.find_one({'node_chef_id': node_id}):
             return 'duplicated-node-id'
@@ -833,6 +1025,7 @@ def update_node(api, node_id, ou, collection_nodes):
                                      'source': ou.get('source', SOURCE_DEFAULT),
                                      'node_chef_id': node_id})
     del computer['_id']
+    set_node_ancestors(computer)
     node_id = collection_nodes.update({'node_chef_id': node_id},
                                       computer)
     return node_id
@@ -867,20 +1060,25 @@ def get_domain(node, collection_node):
 
 
 def get_filter_in_domain(node):
+    '''
+    Value of the ancestors field of the nodes in the domain of a node
+    '''
     path_domain = get_domain_path(node)
-    return {'$regex': '^%s' % ','.join(path_domain)}
+    return path_domain[-1]
 
 
 def get_filter_this_domain(domain):
-    path_domain = '%s,%s' % (domain['path'], unicode(domain['_id']))
-    return {'$regex': '^%s' % path_domain}
+    '''
+    Value of the ancestors field of the nodes in a domain
+    '''
+    return unicode(domain['_id'])
 
 
 def check_unique_node_name_by_type_at_domain(collection_nodes, obj):
     filters = {}
     levels = obj['path'].count(',')
     if levels >= 2:
-        filters['path'] = get_filter_in_domain(obj)
+        filters['ancestors'] = get_filter_in_domain(obj)
     else:
         current_path = obj['path']
         filters['path'] = ','.join(current_path)
@@ -948,7 +1146,8 @@ def update_computers_of_user(db, user, api):
     from gecoscc.api.chef_status import USERS_OHAI
 
     logger.warning("utils ::: update_computers_of_user - user = %s" % str(user))
-    nodes = db.nodes.find({'path': {'$regex': '.*' + user['path'] +'.*'}, 'type':'computer'})
+    nodes = db.nodes.find({'ancestors': get_filter_nodes_belonging_ou(user['path'].split(',')[-1]),
+                           'type': 'computer'})
 
     for node in nodes:
         chef_node = ChefNode(node['node_chef_id'], api)
@@ -10,6 +10,7 @@
 #
 
 import csv
+import datetime
 
 try:
     from cStringIO import StringIO
@@ -22,6 +23,34 @@ from pyramid.view import view_config
 
 from gecoscc.i18n import gettext as _
 
+# Days of the jobs report by default
+JOBS_REPORT_DAYS = 30
+
+
+# Rows written in the buffer before sending them to the client
+CSV_CHUNK_ROWS = 1000
+
+
+def iter_csv(header, rows, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Encode the header and the rows as CSV, yields the CSV every chunk_rows rows
+    """
+    fout = StringIO()
+    writer = csv.writer(fout, delimiter=',', quotechar=',', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(header)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending == chunk_rows:
+            yield fout.getvalue()
+            fout.seek(0)
+            fout.truncate()
+            pending = 0
+    data = fout.getvalue()
+    if data:
+        yield data
+
 
 class CSVRenderer(object):
 
@@ -31,7 +60,9 @@ class CSVRenderer(object):
     def __call__(self, value, system):
         """ Returns a plain CSV-encoded string with content-type
         ``text/csv``. The content-type may be overridden by
-        setting ``request.response.content_type``."""
+        setting ``request.response.content_type``.
+        If the rows are not a list or a tuple (a generator, a cursor...)
+        the CSV is streamed with the app_iter of the response."""
 
         request = system.get('request')
         if request is not None:
@@ -40,22 +71,169 @@ class CSVRenderer(object):
             if ct == response.default_content_type:
                 response.content_type = 'text/csv'
 
-        fout = StringIO()
-        writer = csv.writer(fout, delimiter=',', quotechar=',', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(value.get('header', []))
-        writer.writerows(value.get('rows', []))
-        return fout.getvalue()
+        header = value.get('header', [])
+        rows = value.get('rows', [])
+        if request is not None and not isinstance(rows, (list, tuple)):
+            response.content_length = None
+            response.app_iter = iter_csv(header, rows)
+            return None
+        return ''.join(iter_csv(header, rows))
 
 
 @view_config(route_name='reports', renderer='templates/reports.jinja2',
              permission='edit')
 def reports(context, request):
-    return {}
+    today = datetime.date.today()
+    return {'start': (today - datetime.timedelta(days=JOBS_REPORT_DAYS)).isoformat(),
+            'end': today.isoformat()}
 
 
 def treatment_string_to_csv(item, key):
     none = '--'
-    return item.get(key, none).encode('utf-8') or none
+    return (item.get(key, none) or none).encode('utf-8')
+
+
+def encode_header(header):
+    return tuple([column.encode('utf-8') for column in header])
+
+
+def report_user(request):
+    query = request.db.nodes.find({'type': 'user'},
+                                  {'name': 1, 'first_name': 1, 'last_name': 1,
+                                   'email': 1, 'phone': 1, 'address': 1})
+    rows = ((item['_id'],
+             treatment_string_to_csv(item, 'name'),
+             treatment_string_to_csv(item, 'first_name'),
+             treatment_string_to_csv(item, 'last_name'),
+             treatment_string_to_csv(item, 'email'),
+             treatment_string_to_csv(item, 'phone'),
+             treatment_string_to_csv(item, 'address')) for item in query)
+    header = (_(u'Id'),
+              _(u'Username'),
+              _(u'First name'),
+              _(u'Last name'),
+              _(u'Email'),
+              _(u'Phone'),
+              _(u'Address'))
+    return header, rows
+
+
+def report_computer(request):
+    query = request.db.nodes.find({'type': 'computer'},
+                                  {'name': 1, 'family': 1, 'registry': 1,
+                                   'serial': 1, 'node_chef_id': 1})
+    rows = ((item['_id'],
+             treatment_string_to_csv(item, 'name'),
+             treatment_string_to_csv(item, 'family'),
+             treatment_string_to_csv(item, 'registry'),
+             treatment_string_to_csv(item, 'serial'),
+             treatment_string_to_csv(item, 'node_chef_id')) for item in query)
+    header = (_(u'Id'),
+              _(u'Name'),
+              _(u'Type'),
+              _(u'Registry number'),
+              _(u'Serial number'),
+              _(u'Node chef id'))
+    return header, rows
+
+
+def report_policies(request):
+    policies = dict([(unicode(policy['_id']), policy) for policy in
+                     request.db.policies.find({}, {'name': 1, 'slug': 1})])
+    query = request.db.nodes.find({'policies': {'$nin': [None, {}]}},
+                                  {'name': 1, 'type': 1, 'policies': 1})
+
+    def rows():
+        for item in query:
+            for policy_id in item['policies'].keys():
+                policy = policies.get(policy_id, {})
+                yield (item['_id'],
+                       treatment_string_to_csv(item, 'name'),
+                       treatment_string_to_csv(item, 'type'),
+                       policy_id,
+                       treatment_string_to_csv(policy, 'name'),
+                       treatment_string_to_csv(policy, 'slug'))
+    header = (_(u'Id'),
+              _(u'Name'),
+              _(u'Type'),
+              _(u'Policy id'),
+              _(u'Policy'),
+              _(u'Slug'))
+    return header, rows()
+
+
+def report_jobs(request):
+    try:
+        today = datetime.date.today()
+        start = request.GET.get('start', None)
+        start = (datetime.datetime.strptime(start, '%Y-%m-%d') if start else
+                 datetime.datetime.combine(today - datetime.timedelta(days=JOBS_REPORT_DAYS), datetime.time()))
+        end = request.GET.get('end', None)
+        end = datetime.datetime.strptime(end, '%Y-%m-%d') if end else datetime.datetime.combine(today, datetime.time())
+    except ValueError:
+        raise HTTPBadRequest()
+    # The end day is included
+    end += datetime.timedelta(days=1)
+    query = request.db.jobs.find({'created': {'$gte': start, '$lt': end}},
+                                 {'created': 1, 'administrator_username': 1, 'objname': 1,
+                                  'type': 1, 'op': 1, 'computername': 1, 'policyname': 1,
+                                  'status': 1, 'message': 1}).sort('created', 1)
+    rows = ((item['_id'],
+             item['created'].isoformat(),
+             treatment_string_to_csv(item, 'administrator_username'),
+             treatment_string_to_csv(item, 'objname'),
+             treatment_string_to_csv(item, 'type'),
+             treatment_string_to_csv(item, 'op'),
+             treatment_string_to_csv(item, 'computername'),
+             treatment_string_to_csv(item, 'policyname'),
+             treatment_string_to_csv(item, 'status'),
+             treatment_string_to_csv(item, 'message')) for item in query)
+    header = (_(u'Id'),
+              _(u'Created'),
+              _(u'Administrator'),
+              _(u'Object'),
+              _(u'Type'),
+              _(u'Operation'),
+              _(u'Workstation'),
+              _(u'Policy'),
+              _(u'Status'),
+              _(u'Message'))
+    return header, rows
+
+
+def report_ou_computers(request):
+    ous = dict([(unicode(ou['_id']), ou) for ou in
+                request.db.nodes.find({'type': 'ou'}, {'name': 1})])
+    query = request.db.nodes.find({'type': 'computer'},
+                                  {'name': 1, 'path': 1, 'family': 1,
+                                   'node_chef_id': 1}).sort('path', 1)
+
+    def rows():
+        for item in query:
+            ou_id = item['path'].split(',')[-1]
+            ou = ous.get(ou_id, {})
+            yield (ou_id,
+                   treatment_string_to_csv(ou, 'name'),
+                   item['_id'],
+                   treatment_string_to_csv(item, 'name'),
+                   treatment_string_to_csv(item, 'family'),
+                   treatment_string_to_csv(item, 'node_chef_id'))
+    header = (_(u'OU id'),
+              _(u'OU'),
+              _(u'Id'),
+              _(u'Name'),
+              _(u'Type'),
+              _(u'Node chef id'))
+    return header, rows()
+
+
+REPORTS = {
+    'user': report_user,
+    'computer': report_computer,
+    'policies': report_policies,
+    'jobs': report_jobs,
+    'ou_computers': report_ou_computers,
+}
 
 
 @view_config(route_name='report_file', renderer='csv',
@@ -64,36 +242,9 @@ def report_file(context, request):
     report_type = request.matchdict.get('report_type')
     filename = 'report_%s.csv' % report_type
     request.response.content_disposition = 'attachment;filename=' + filename
-    if report_type not in ('user', 'computer'):
+    if report_type not in REPORTS:
         raise HTTPBadRequest()
-    query = request.db.nodes.find({'type': report_type})
-    if report_type == 'user':
-        rows = [(item['_id'],
-                 treatment_string_to_csv(item, 'name'),
-                 treatment_string_to_csv(item, 'first_name'),
-                 treatment_string_to_csv(item, 'last_name'),
-                 treatment_string_to_csv(item, 'email'),
-                 treatment_string_to_csv(item, 'phone'),
-                 treatment_string_to_csv(item, 'address')) for item in query]
-        header = (_(u'Id').encode('utf-8'),
-                  _(u'Username').encode('utf-8'),
-                  _(u'First name').encode('utf-8'),
-                  _(u'Last name').encode('utf-8'),
-                  _(u'Email').encode('utf-8'),
-                  _(u'Phone').encode('utf-8'),
-                  _(u'Address').encode('utf-8'))
-    elif report_type == 'computer':
-        rows = [(item['_id'],
-                 treatment_string_to_csv(item, 'name'),
-                 treatment_string_to_csv(item, 'family'),
-                 treatment_string_to_csv(item, 'registry'),
-                 treatment_string_to_csv(item, 'serial'),
-                 treatment_string_to_csv(item, 'node_chef_id')) for item in query]
-        header = (_(u'Id').encode('utf-8'),
-                  _(u'Name').encode('utf-8'),
-                  _(u'Type').encode('utf-8'),
-                  _(u'Registry number').encode('utf-8'),
-                  _(u'Serial number').encode('utf-8'),
-                  _(u'Node chef id').encode('utf-8'))
-    return {'header': header,
+    # The header is translated now, the rows are read while the response is sent
+    header, rows = REPORTS[report_type](request)
+    return {'header': encode_header(header),
             'rows': rows}
@@ -0,0 +1,77 @@
+#
+# Copyright 2013, Junta de Andalucia
+# http://www.juntadeandalucia.es/
+#
+# All rights reserved - EUPL License V 1.1
+# https://joinup.ec.europa.eu/software/page/eupl/licence-eupl
+#
+#
+# Compare the merge of the chef node attributes (to_deep_dict) with the
+# previous dict_merge, that deep copied its left operand at every level.
+#
+# Usage: python utils/benchmark_dict_merge.py [policies] [repeat]
+#
+
+import sys
+import timeit
+
+from copy import deepcopy
+
+from gecoscc.utils import dict_merge, dict_merge_shared
+
+
+def dict_merge_deepcopy(a, b):
+    if not isinstance(b, dict):
+        return b
+    result = deepcopy(a)
+    for k, v in b.iteritems():
+        if k in result and isinstance(result[k], dict):
+                result[k] = dict_merge_deepcopy(result[k], v)
+        else:
+            result[k] = deepcopy(v)
+    return result
+
+
+def node_attributes(policies, value):
+    '''
+    Attributes like the ones of a chef node: ohai data and the policies of
+    the cookbook, grouped by section
+    '''
+    sections = {}
+    for i in range(policies):
+        section = sections.setdefault('section_%d' % (i % 10), {})
+        section['policy_%d' % i] = {'updated_by': {'ou': ['%024d' % j for j in range(3)]},
+                                    'job_ids': ['%024d' % j for j in range(5)],
+                                    'packages': ['package_%d_%s' % (j, value) for j in range(20)]}
+    return {'gecos_ws_mgmt': sections,
+            'ohai_gecos': {'users': [{'username': 'user%d' % i} for i in range(20)]},
+            'cpu': dict([(str(i), {'model_name': value, 'flags': ['flag'] * 50}) for i in range(8)])}
+
+
+def fold(merge, search_path):
+    merged = {}
+    for d in reversed(search_path):
+        merged = merge(merged, d)
+    return merged
+
+
+def main():
+    policies = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    # default, normal and automatic attributes
+    search_path = [node_attributes(policies, value) for value in ('default', 'normal', 'automatic')]
+
+    expected = fold(dict_merge_deepcopy, search_path)
+    for merge in (dict_merge, dict_merge_shared):
+        assert fold(merge, search_path) == expected
+
+    print "%d policies, %d merges of the search path" % (policies, repeat)
+    for name, merge in (('dict_merge (previous)', dict_merge_deepcopy),
+                        ('dict_merge', dict_merge),
+                        ('dict_merge_shared (to_deep_dict)', dict_merge_shared)):
+        seconds = timeit.timeit(lambda: fold(merge, search_path), number=repeat)
+        print "%-35s %8.2f ms" % (name, seconds * 1000 / repeat)
+
+
+if __name__ == '__main__':
+    main()